@@ -2,6 +2,7 @@
 
 import pylab as pl
 import pymc as mc
+import scipy.sparse
 
 
 def age_standardize_approx(name, age_weights, mu_age, age_start, age_end, ages):
@@ -17,32 +18,47 @@ def age_standardize_approx(name, age_weights, mu_age, age_start, age_end, ages):
     Results
     -------
     Returns dict of PyMC objects, including 'mu_interval'
-    the approximate integral of gamma  data predicted stochastic
+    the approximate integral of gamma  data predicted stochastic,
+    and 'W' and 'W_index', the sparse matrix and row index with
+    mu_interval = (W * mu_age)[W_index]
     """
+    age_weights = pl.array(age_weights, dtype=float)
     cum_sum_weights = pl.cumsum(age_weights)
 
-    @mc.deterministic(name='cum_sum_mu_%s'%name)
-    def weighted_sum_mu(mu_age=mu_age, age_weights=age_weights):
-        return pl.cumsum(mu_age*age_weights)
-
     age_start = age_start.__array__().clip(ages[0], ages[-1]) - ages[0]  # FIXME: Pandas bug, makes clip require __array__()
     age_end = age_end.__array__().clip(ages[0], ages[-1]) - ages[0]
+    age_start = pl.array(age_start, dtype=int)
+    age_end = pl.array(age_end, dtype=int)
+
+    # only compute each distinct age interval once
+    lower = pl.minimum(age_start, age_end)
+    upper = pl.maximum(age_start, age_end)
+    key, W_index = pl.unique(lower*len(ages) + upper, return_inverse=True)
+    lower = key // len(ages)
+    upper = key % len(ages)
+
+    # row i averages mu_age over ages lower[i]+1 to upper[i], the
+    # difference of the cumulative sums, or takes mu_age[lower[i]]
+    # when the interval is a single age
+    single_age = lower == upper
+    lengths = pl.where(single_age, 1, upper - lower)
+    first = pl.where(single_age, lower, lower + 1)
+
+    row = pl.repeat(pl.arange(len(lengths)), lengths)
+    col = pl.repeat(first, lengths) + pl.arange(lengths.sum()) - pl.repeat(pl.cumsum(lengths) - lengths, lengths)
+
     pl.seterr('ignore')
-    @mc.deterministic(name='mu_interval_%s'%name)
-    def mu_interval(weighted_sum_mu=weighted_sum_mu, cum_sum_weights=cum_sum_weights,
-                    mu_age=mu_age,
-                    age_start=pl.array(age_start, dtype=int),
-                    age_end=pl.array(age_end, dtype=int)):
-        mu = (weighted_sum_mu[age_end] - weighted_sum_mu[age_start]) / (cum_sum_weights[age_end] - cum_sum_weights[age_start])
-        
-        # correct cases where age_start == age_end
-        i = age_start == age_end
-        if pl.any(i):
-            mu[i] = mu_age[age_start[i]]
+    wt_sum = cum_sum_weights[upper] - cum_sum_weights[lower]
+    val = pl.where(single_age[row], 1., age_weights[col] / wt_sum[row])
 
-        return mu
+    W = interval_weight_matrix(row, col, val, len(key), len(ages))
 
-    return dict(mu_interval=mu_interval)
+    @mc.deterministic(name='mu_interval_%s'%name)
+    def mu_interval(mu_age=mu_age, W_index=W_index):
+        return (W * mu_age)[W_index]
+    mu_interval.vjp = lambda adj, mu_age, W_index: dict(mu_age=interval_weight_vjp(W, W_index, adj))
+
+    return dict(mu_interval=mu_interval, W=W, W_index=W_index)
 
 def age_integrate_approx(name, age_weights, mu_age, age_start, age_end, ages):
     """ Generate PyMC objects for approximating the integral of gamma from age_start[i] to age_end[i]
@@ -57,30 +73,89 @@ def age_integrate_approx(name, age_weights, mu_age, age_start, age_end, ages):
     Results
     -------
     Returns dict of PyMC objects, including 'mu_interval'
-    the approximate integral of gamma  data predicted stochastic
+    the approximate integral of gamma  data predicted stochastic,
+    and 'W' and 'W_index', the sparse matrix and row index with
+    mu_interval = (W * mu_age)[W_index]
     """
-    # FIXME: should use final age weight
-    age_weights = [pl.array([1.e-9+float(w_ia) for w_ia in w_i.split(';')][:-1]) for w_i in age_weights]
-    wt_sum = pl.array([sum(w_i) for w_i in age_weights])
-
     age_start = age_start.__array__().clip(ages[0], ages[-1]) - ages[0]  # FIXME: Pandas bug, makes clip require __array__()
     age_end = age_end.__array__().clip(ages[0], ages[-1]) - ages[0]
+    age_start = pl.array(age_start, dtype=int)
+    age_end = pl.array(age_end, dtype=int)
+
+    # only compute each distinct age interval and weights once
+    key_index = {}
+    W_index = pl.zeros(len(age_start), dtype=int)
+    for i, key in enumerate(zip(age_start, age_end, age_weights)):
+        W_index[i] = key_index.setdefault(key, len(key_index))
+    keys = sorted(key_index, key=key_index.get)
+
+    # row j is the weighted mean of mu_age[a0:a1] for the j-th distinct interval
+    row, col, val = [], [], []
     pl.seterr('ignore')
+    for j, (a0, a1, w_j) in enumerate(keys):
+        # FIXME: should use final age weight
+        w_j = pl.array([1.e-9+float(w_ja) for w_ja in w_j.split(';')][:-1])
+        cols_j = pl.arange(a0, a1)[:len(w_j)]
+
+        # the weights past the end of a clipped interval are dropped, so
+        # normalize by the sum of the weights that are used
+        w_j = w_j[:len(cols_j)]
+        row.append(j*pl.ones(len(cols_j), dtype=int))
+        col.append(cols_j)
+        val.append(w_j / w_j.sum())
+
+    W = interval_weight_matrix(pl.hstack([[]] + row), pl.hstack([[]] + col), pl.hstack([[]] + val),
+                               len(keys), len(ages))
+
     @mc.deterministic(name='mu_interval_%s'%name)
-    def mu_interval(age_weights=age_weights,
-                    wt_sum=wt_sum,
-                    mu_age=mu_age,
-                    age_start=pl.array(age_start, dtype=int),
-                    age_end=pl.array(age_end, dtype=int)):
-        N = len(age_weights)
-        mu = pl.zeros(N)
+    def mu_interval(mu_age=mu_age, W_index=W_index):
+        return (W * mu_age)[W_index]
+    mu_interval.vjp = lambda adj, mu_age, W_index: dict(mu_age=interval_weight_vjp(W, W_index, adj))
 
-        for i in range(N):
-            mu[i] = pl.dot(age_weights[i], mu_age[age_start[i]:age_end[i]]) / wt_sum[i]
+    return dict(mu_interval=mu_interval, W=W, W_index=W_index)
 
-        return mu
 
-    return dict(mu_interval=mu_interval)
+def interval_weight_matrix(row, col, val, n_rows, n_ages):
+    """ Generate the sparse matrix that maps the age pattern to the age-interval means
+
+    Parameters
+    ----------
+    row, col : array of ints, the row and age index of each weight
+    val : array, the weights
+    n_rows : int, number of distinct age intervals
+    n_ages : int, number of ages
+
+    Results
+    -------
+    Returns scipy.sparse.csr_matrix W with shape (n_rows, n_ages),
+    so that W * mu_age is the vector of distinct age-interval means
+
+    Notes
+    -----
+    W is not a parent of the PyMC objects that use it, because PyMC
+    does not know how to treat a sparse matrix as a parent, so it is
+    included in the closure of the deterministic instead
+    """
+    return scipy.sparse.csr_matrix((pl.array(val, dtype=float),
+                                    (pl.array(row, dtype=int), pl.array(col, dtype=int))),
+                                   shape=(n_rows, n_ages))
+
+
+def interval_weight_vjp(W, W_index, adj):
+    """ Product of adj and the jacobian of (W * mu_age)[W_index]
+    with respect to mu_age
+
+    Parameters
+    ----------
+    W : scipy.sparse.csr_matrix, from interval_weight_matrix
+    W_index : array of ints, the row of W for each data row
+    adj : array, len == len(W_index)
+
+    Results
+    -------
+    Returns array with len == number of ages
+    """
+    return W.T * pl.bincount(W_index, adj, minlength=W.shape[0])
 
 
 def midpoint_approx(name, mu_age, age_start, age_end, ages):
@@ -4,7 +4,7 @@ import pylab as pl
 import pymc as mc
 
 
-def spline(name, ages, knots, smoothing, interpolation_method='linear'):
+def spline(name, ages, knots, smoothing, interpolation_method='linear', vectorized=False):
     """ Generate PyMC objects for a piecewise constant Gaussian process (PCGP) model
 
     Parameters
@@ -14,6 +14,10 @@ def spline(name, ages, knots, smoothing, interpolation_method='linear'):
     ages : array, points to interpolate to
     smoothing : pymc.Node, smoothness parameter for smoothing spline
     interpolation_method : str, optional, one of 'linear', 'nearest', 'zero', 'slinear', 'quadratic, 'cubic'
+    vectorized : bool, optional, use a single array-valued stochastic for the knot values
+      and a precomputed interpolation basis, instead of one stochastic per knot;
+      'gamma' is then a list of one stochastic, so the initial values fit all
+      the knots at once and the step methods move them in one block
 
     Results
     -------
@@ -21,21 +25,39 @@ def spline(name, ages, knots, smoothing, interpolation_method='linear'):
     the observed stochastic likelihood and data predicted stochastic
     """
     assert pl.all(pl.diff(knots) > 0), 'Spline knots must be strictly increasing'
-    
-    gamma = [mc.Normal('gamma_%s_%d'%(name,k), 0., 10.**-2, value=-10.) for k in knots]
-    #gamma = [mc.Uniform('gamma_%s_%d'%(name,k), -20., 20., value=-10.) for k in knots]
 
-    # TODO: fix AdaptiveMetropolis so that this is not necessary
-    flat_gamma = mc.Lambda('flat_gamma_%s'%name, lambda gamma=gamma: pl.array([x for x in pl.flatten(gamma)]))
+    if vectorized:
+        gamma = [mc.Normal('gamma_%s'%name, 0., 10.**-2, value=-10.*pl.ones(len(knots)))]
+        flat_gamma = gamma[0]
 
+        basis = interpolation_basis(knots, ages, interpolation_method)
+        @mc.deterministic(name='mu_age_%s'%name)
+        def mu_age(gamma=flat_gamma, basis=basis):
+            return pl.dot(basis, pl.exp(gamma))
+        mu_age.vjp = lambda adj, gamma, basis: dict(gamma=pl.exp(gamma) * pl.dot(basis.T, adj))
 
-    import scipy.interpolate
-    @mc.deterministic(name='mu_age_%s'%name)
-    def mu_age(gamma=flat_gamma, knots=knots, ages=ages):
-        mu = scipy.interpolate.interp1d(knots, pl.exp(gamma), kind=interpolation_method, bounds_error=False, fill_value=0.)
-        return mu(ages)
+        vars = dict(gamma=gamma, mu_age=mu_age, ages=ages, knots=knots, basis=basis)
+
+    else:
+        gamma = [mc.Normal('gamma_%s_%d'%(name,k), 0., 10.**-2, value=-10.) for k in knots]
+        #gamma = [mc.Uniform('gamma_%s_%d'%(name,k), -20., 20., value=-10.) for k in knots]
+
+        # TODO: fix AdaptiveMetropolis so that this is not necessary
+        flat_gamma = mc.Lambda('flat_gamma_%s'%name, lambda gamma=gamma: pl.array([x for x in pl.flatten(gamma)]))
+        flat_gamma.vjp = lambda adj, gamma: dict(gamma=adj)
+
+
+        import scipy.interpolate
+        @mc.deterministic(name='mu_age_%s'%name)
+        def mu_age(gamma=flat_gamma, knots=knots, ages=ages):
+            mu = scipy.interpolate.interp1d(knots, pl.exp(gamma), kind=interpolation_method, bounds_error=False, fill_value=0.)
+            return mu(ages)
 
-    vars = dict(gamma=gamma, mu_age=mu_age, ages=ages, knots=knots)
+        # the interpolation is linear in the knot values, see interpolation_basis
+        basis = interpolation_basis(knots, ages, interpolation_method)
+        mu_age.vjp = lambda adj, gamma, knots, ages: dict(gamma=pl.exp(gamma) * pl.dot(basis.T, adj))
+
+        vars = dict(gamma=gamma, mu_age=mu_age, ages=ages, knots=knots)
 
     if (smoothing > 0) and (not pl.isinf(smoothing)):
         print 'adding smoothing of', smoothing
@@ -47,9 +69,88 @@ def spline(name, ages, knots, smoothing, interpolation_method='linear'):
             gamma = gamma.clip(pl.log(pl.exp(gamma).mean()/10.), pl.inf)  # only include smoothing on values within 10x of mean
 
             return mc.normal_like(pl.sqrt(pl.sum(pl.diff(gamma)**2 / pl.diff(knots))), 0, tau)
+        smooth_gamma.logp_grad = smooth_gamma_grad
         vars['smooth_gamma'] = smooth_gamma
 
     return vars
 
 # TODO: change old code to use new name, remove this legacy function name
 age_pattern = spline
+
+
+def smooth_gamma_grad(gamma, knots, tau):
+    """ Derivative of the logp of the smoothing potential of spline()
+    with respect to gamma
+
+    Parameters
+    ----------
+    gamma : array, log of the rate at each knot
+    knots : array
+    tau : float
+
+    Results
+    -------
+    Returns dict with the derivative for gamma
+
+    Notes
+    -----
+    The logp is -tau/2 times the sum of squares of the slopes of the
+    clipped gamma, and the knots held at the noise floor move with it,
+    which is the log of a tenth of the mean of exp(gamma)
+    """
+    gamma = pl.array(gamma, dtype=float)
+    floor = pl.log(pl.exp(gamma).mean()/10.)
+    clipped = gamma < floor
+    g = pl.where(clipped, floor, gamma)
+
+    slope = 2. * pl.diff(g) / pl.diff(knots)
+    d_g = -.5 * tau * (pl.hstack((0., slope)) - pl.hstack((slope, 0.)))
+
+    d_gamma = pl.where(clipped, 0., d_g)
+    d_gamma += d_g[clipped].sum() * pl.exp(gamma) / pl.exp(gamma).sum()
+    return dict(gamma=d_gamma)
+
+
+def interpolation_basis(knots, ages, interpolation_method='linear'):
+    """ Generate the matrix that maps values at the knots to values at the ages
+
+    Parameters
+    ----------
+    knots : array, strictly increasing
+    ages : array, points to interpolate to
+    interpolation_method : str, optional, one of 'linear', 'nearest', 'zero', 'slinear', 'quadratic, 'cubic'
+
+    Results
+    -------
+    Returns array B with shape (len(ages), len(knots)), so that
+    pl.dot(B, y) equals the interpolation of y from the knots to the ages
+
+    Notes
+    -----
+    All of the interpolation methods are linear in the interpolated
+    values, so interpolating the columns of the identity matrix gives
+    the same result as interpolating y directly
+    """
+    import scipy.interpolate
+    return scipy.interpolate.interp1d(knots, pl.eye(len(knots)), kind=interpolation_method, axis=0,
+                                      bounds_error=False, fill_value=0.)(ages)
+
+
+def set_knot_values(vars, gamma):
+    """ Set the values of the knot stochastics of a spline
+
+    Parameters
+    ----------
+    vars : dict of PyMC objects, from spline()
+    gamma : array, log of the rate at each knot
+
+    Notes
+    -----
+    Works for the one-stochastic-per-knot and the vectorized version
+    of the spline
+    """
+    if 'basis' in vars:
+        vars['gamma'][0].value = pl.array(gamma, dtype=float)
+    else:
+        for gamma_k, value_k in zip(vars['gamma'], gamma):
+            gamma_k.value = value_k
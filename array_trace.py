@@ -0,0 +1,112 @@
+""" Summaries of posterior samples stored as numpy arrays"""
+
+import pylab as pl
+import pymc as mc
+
+
+def batchsd(trace, batches=5):
+    """ Batch standard deviation of the mean of each column of a trace,
+    as in pymc, but for all columns at once
+
+    :Parameters:
+      - `trace` : array, with samples along the first axis
+      - `batches` : int, number of batches
+
+    :Results:
+      - Returns an array with the shape of one sample
+    """
+    trace = pl.array(trace, dtype=float)
+    if batches == 1:
+        return trace.std(0) / pl.sqrt(len(trace))
+
+    # trim excess samples if batches do not divide evenly
+    m = len(trace) / batches
+    means = trace[:batches*m].reshape((batches, m) + trace.shape[1:]).mean(1)
+    return means.std(0) / pl.sqrt(batches)
+
+
+def trace_stats(trace, alpha=0.05, start=0, batches=100, quantiles=(2.5, 25, 50, 75, 97.5)):
+    """ Generate posterior statistics for an array of samples, in the
+    same form as pymc.Node.stats
+
+    :Parameters:
+      - `trace` : array, with samples along the first axis
+      - `alpha` : float, the alpha level for the posterior intervals
+      - `start` : int, the index of the first sample to summarize
+      - `batches` : int, number of batches for the mc error
+      - `quantiles` : tuple, the quantiles to calculate
+
+    :Results:
+      - Returns dict with keys 'n', 'mean', 'standard deviation',
+        '95% HPD interval' (for alpha=.05), 'mc error', and 'quantiles';
+        or None if there are no samples
+    """
+    # trim before converting, so that only the samples summarized are
+    # copied out of a memory map
+    trace = pl.squeeze(pl.array(trace[start:], dtype=float))
+
+    n = len(trace)
+    if not n:
+        print 'Cannot generate statistics for zero-length trace'
+        return
+
+    return {
+        'n': n,
+        'standard deviation': trace.std(0),
+        'mean': trace.mean(0),
+        '%s%s HPD interval' % (int(100 * (1 - alpha)), '%'): mc.utils.hpd(trace, alpha),
+        'mc error': batchsd(trace, min(n, batches)),
+        'quantiles': mc.utils.quantiles(trace, qlist=quantiles)
+        }
+
+
+class ArrayTrace:
+    """ Trace of a node, merged from the samples of several chains
+    that were run in other processes, which supports the parts of the
+    pymc Trace interface used after fitting
+
+    node.trace() returns the samples of all chains, one chain after the
+    other, and node.stats() summarizes them like pymc.Node.stats
+
+    :Parameters:
+      - `name` : str, the name of the node
+      - `chains` : list of arrays, with samples along the first axis of each
+
+    .. note::
+      - the chains are stored as one pymc chain, so the `chain`
+        argument is accepted for compatibility but ignored
+    """
+    def __init__(self, name, chains):
+        self.name = name
+        self.__name__ = name
+        self.chains = [pl.array(c) for c in chains]
+        self._trace = pl.concatenate(self.chains)
+        self._chain = -1
+        self.db = None
+
+    def __repr__(self):
+        return '<ArrayTrace %s of %d chains>' % (self.name, len(self.chains))
+
+    def gettrace(self, burn=0, thin=1, chain=-1, slicing=None):
+        """ Return the merged samples, see pymc.database.ram.Trace.gettrace"""
+        if slicing is None:
+            slicing = slice(burn, None, thin)
+        return self._trace[slicing]
+
+    __call__ = gettrace
+
+    def __getitem__(self, index):
+        return self._trace[index]
+
+    def length(self, chain=-1):
+        return len(self._trace)
+
+    def stats(self, alpha=0.05, start=0, batches=100, chain=None, quantiles=(2.5, 25, 50, 75, 97.5)):
+        """ Generate posterior statistics of the merged samples, see pymc.Node.stats"""
+        return trace_stats(self._trace, alpha=alpha, start=start, batches=batches, quantiles=quantiles)
+
+    def chain_array(self):
+        """ Return the samples as an array with shape (chains, samples) + shape of one sample,
+        trimmed to the length of the shortest chain, for diagnostics"""
+        n = min([len(c) for c in self.chains])
+        return pl.array([c[:n] for c in self.chains])
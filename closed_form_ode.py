@@ -0,0 +1,193 @@
+""" Closed-form solution of the Dismod ODE with piecewise constant rates
+
+The Dismod ODE (see dismod_ode) is
+
+    S' = -(i + other) S + r C
+    C' =  i S - (r + other + e) C
+
+with other = m - e * S / (S + C) on an age grid, and the rates taken
+constant on each interval at their value at the start of the interval.
+
+Since other-cause mortality removes the same fraction of S and C, the
+solution on each interval is expm(B h) [S, C] with
+B = [[-i, r], [i, -(r+e)]], scaled by exp(-integral of other).  The
+2x2 matrix exponentials have a closed form, so they are computed for
+all intervals at once.  The integral of other is exact as well: along
+the solution of the linear system the total T = S + C satisfies
+T'/T = -e C/T, so the integral of e S/(S+C) over an interval is
+e h + log(T(h)/T(0)).
+"""
+
+import pylab as pl
+
+
+def sc_transition(i, r, e, h):
+    """ Matrix exponentials expm(B h) for B = [[-i, r], [i, -(r+e)]],
+    computed in closed form for all intervals at once
+
+    :Parameters:
+      - `i` : array, incidence on each interval
+      - `r` : array, remission on each interval
+      - `e` : array, excess mortality on each interval
+      - `h` : float or array, length of each interval
+
+    :Results:
+      - Returns (E00, E01, E10, E11), the arrays of matrix entries
+
+    :Notes:
+      - The eigenvalues of B are mu +/- delta, with mu = -(i+r+e)/2 and
+        delta = sqrt(((r+e-i)/2)**2 + r i), which are always real, so
+        expm(B h) = exp(mu h) [cosh(delta h) I + sinh(delta h)/delta (B - mu I)]
+    """
+    i = pl.array(i, dtype=float)
+    r = pl.array(r, dtype=float)
+    e = pl.array(e, dtype=float)
+    h = pl.array(h, dtype=float)
+
+    mu = -.5*(i + r + e)
+    half_gap = .5*(r + e - i)
+    delta = pl.sqrt(half_gap**2 + r*i)
+
+    exp_plus = pl.exp((mu + delta)*h)
+    exp_minus = pl.exp((mu - delta)*h)
+    cosh_term = .5*(exp_plus + exp_minus)
+
+    # exp(mu h) sinh(delta h) / delta, using a series expansion where delta h is tiny
+    dh = delta*h
+    small = dh < 1.e-4
+    sinh_term = pl.where(small,
+                         h*pl.exp(mu*h)*(1. + dh**2/6.),
+                         .5*(exp_plus - exp_minus) / pl.where(small, 1., delta))
+
+    return (cosh_term + half_gap*sinh_term,
+            r*sinh_term,
+            i*sinh_term,
+            cosh_term - half_gap*sinh_term)
+
+
+def solve(age, all_cause, i, r, e, s0, c0):
+    """ Solve the Dismod ODE on the age grid
+
+    :Parameters:
+      - `age` : array of ages, length N
+      - `all_cause` : array of all-cause mortality at each age
+      - `i`, `r`, `e` : arrays of incidence, remission and excess mortality at each age
+      - `s0`, `c0` : float, the initial susceptible and with-condition values
+
+    :Results:
+      - Returns (s, c), arrays of susceptible and with-condition values at each age
+    """
+    N = len(age)
+    h = pl.diff(pl.array(age, dtype=float))
+    i = pl.array(i, dtype=float)[:N-1]
+    r = pl.array(r, dtype=float)[:N-1]
+    e = pl.array(e, dtype=float)[:N-1]
+    m = pl.array(all_cause, dtype=float)[:N-1]
+
+    E00, E01, E10, E11 = sc_transition(i, r, e, h)
+    # other-cause mortality is exp(-(m-e) h) * T(h)/T(0), see module docstring
+    base_decay = pl.exp(-(m - e)*h)
+
+    # the recursion is sequential, and cheapest with python floats
+    E00, E01, E10, E11, base_decay = [v.tolist() for v in [E00, E01, E10, E11, base_decay]]
+
+    s = [float(s0)]
+    c = [float(c0)]
+    for j in range(N-1):
+        s_j = s[j]
+        c_j = c[j]
+
+        s_end = E00[j]*s_j + E01[j]*c_j
+        c_end = E10[j]*s_j + E11[j]*c_j
+        decay = base_decay[j] * (s_end + c_end) / (s_j + c_j)
+
+        s.append(s_end*decay)
+        c.append(c_end*decay)
+
+    return pl.array(s), pl.array(c)
+
+
+def solve_batch(age, all_cause, i, r, e, s0, c0):
+    """ Solve the Dismod ODE on the age grid for many sets of rates at
+    once, with the loop over ages outermost and the draws vectorized
+
+    :Parameters:
+      - `age` : array of ages, length N
+      - `all_cause` : array of all-cause mortality at each age
+      - `i`, `r`, `e` : arrays of incidence, remission and excess mortality, with shape (D, N)
+      - `s0`, `c0` : arrays of the initial susceptible and with-condition values, length D
+
+    :Results:
+      - Returns (s, c), arrays of susceptible and with-condition values with shape (D, N)
+    """
+    N = len(age)
+    h = pl.diff(pl.array(age, dtype=float))[:, None]
+
+    # work with ages along the first axis, so that each step of the recursion is a contiguous row
+    i = pl.array(pl.atleast_2d(i), dtype=float)[:, :N-1].T
+    r = pl.array(pl.atleast_2d(r), dtype=float)[:, :N-1].T
+    e = pl.array(pl.atleast_2d(e), dtype=float)[:, :N-1].T
+    m = pl.array(all_cause, dtype=float)[:N-1, None]
+
+    E00, E01, E10, E11 = sc_transition(i, r, e, h)
+    base_decay = pl.exp(-(m - e)*h)
+
+    D = i.shape[1]
+    s = pl.zeros((N, D))
+    c = pl.zeros((N, D))
+    s[0] = s0
+    c[0] = c0
+    for j in range(N-1):
+        s_end = E00[j]*s[j] + E01[j]*c[j]
+        c_end = E10[j]*s[j] + E11[j]*c[j]
+        decay = base_decay[j] * (s_end + c_end) / (s[j] + c[j])
+
+        s[j+1] = s_end*decay
+        c[j+1] = c_end*decay
+
+    return s.T, c.T
+
+
+class ClosedFormODE:
+    """ Solver for the Dismod ODE with the interface of the pycppad
+    function object from dismod_ode.ode_function, so that
+    fun.forward(0, x) returns y = [s, c] for x = [i, r, e, S(a_0), C(a_0)]
+
+    :Parameters:
+      - `age` : array of ages, length N
+      - `all_cause` : array of all-cause mortality at each age
+    """
+    def __init__(self, age, all_cause):
+        self.age = pl.array(age, dtype=float)
+        self.all_cause = pl.array(all_cause, dtype=float)
+
+    def forward(self, p, x):
+        """ Zero order forward mode, y = f(x)"""
+        assert p == 0, 'only zero order forward mode is available in closed form'
+
+        N = len(self.age)
+        s, c = solve(self.age, self.all_cause,
+                     x[(0*N):(1*N)], x[(1*N):(2*N)], x[(2*N):(3*N)],
+                     x[3*N], x[3*N+1])
+        return pl.hstack((s, c))
+
+    def forward_batch(self, X):
+        """ Zero order forward mode for many x at once
+
+        :Parameters:
+          - `X` : array with shape (D, 3N+2), one x = [i, r, e, S(a_0), C(a_0)] per row
+
+        :Results:
+          - Returns array with shape (D, 2N), one y = [s, c] per row
+        """
+        X = pl.atleast_2d(X)
+        N = len(self.age)
+        s, c = solve_batch(self.age, self.all_cause,
+                           X[:, (0*N):(1*N)], X[:, (1*N):(2*N)], X[:, (2*N):(3*N)],
+                           X[:, 3*N], X[:, 3*N+1])
+        return pl.hstack((s, c))
+
+
+def ode_function(age, all_cause):
+    """ Create a closed-form solver for the Dismod ODE, see ClosedFormODE"""
+    return ClosedFormODE(age, all_cause)
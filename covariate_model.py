@@ -4,6 +4,10 @@ import pylab as pl
 import pymc as mc
 import pandas
 import networkx as nx
+import scipy.sparse
+
+import data
+import logp_gradient
 
 sex_value = {'male': .5, 'total':0., 'female': -.5}
 
@@ -27,9 +31,307 @@ def MyTruncatedNormal(name, mu, tau, a, b, value):
             return mc.normal_like(value, mu, tau)
         else:
             return -pl.inf
+    my_trunc_norm.logp_grad = lambda value, mu, tau, a, b: logp_gradient.normal_logp_grad(value, mu, tau)
     return my_trunc_norm
 
-def mean_covariate_model(name, mu, input_data, parameters, model, root_area, root_sex, root_year, zero_re=True):
+class RandomEffectDesign(object):
+    """ Sparse version of the random effects design matrix U
+
+    Row i of U has a 1 in the column for each node on the path from
+    the top of the area hierarchy to the area of row i, minus the
+    shift for the reference area.  Instead of storing the mostly-zero
+    dense matrix, this stores the column indices of the path for each
+    row, so that dot(U, alpha) is a gather and sum along the paths
+
+    :Parameters:
+      - `index` : the index of the data rows
+      - `columns` : list of hierarchy nodes with random effects
+      - `path` : array of ints, shape (n_rows, max path length), the column indices on the path for each row,
+        padded with len(columns)
+      - `shift` : pandas.Series, the reference value for each column
+
+    """
+    def __init__(self, index, columns, path, shift):
+        self.index = index
+        self.columns = pandas.Index(columns)
+        self.path = path
+        self.shift = shift
+        self.shift_array = pl.array(shift, dtype=float)
+
+    def __contains__(self, col):
+        return col in self.columns
+
+    @property
+    def shape(self):
+        return (len(self.index), len(self.columns))
+
+    def dot(self, alpha):
+        """ Calculate dot(U, alpha)
+
+        :Parameters:
+          - `alpha` : array, len == len(columns)
+
+        """
+        alpha = pl.append(pl.array(alpha, dtype=float), 0.)  # padding points to this zero
+        return alpha[self.path].sum(axis=1) - pl.dot(self.shift_array, alpha[:-1])
+
+    def dot_transpose(self, z):
+        """ Calculate dot(U.T, z)
+
+        :Parameters:
+          - `z` : array, len == len(index)
+
+        """
+        z = pl.array(z, dtype=float)
+        rows = pl.bincount(self.path.flatten(), pl.repeat(z, self.path.shape[1]), minlength=len(self.columns)+1)
+        return rows[:-1] - self.shift_array * z.sum()
+
+    def to_dense(self):
+        """ Return U as a pandas.DataFrame """
+        U = pl.zeros((len(self.index), len(self.columns)+1))
+        rows = pl.repeat(pl.arange(len(self.index)), self.path.shape[1])
+        U[rows, self.path.flatten()] = 1.
+        return pandas.DataFrame(U[:, :-1] - self.shift_array, index=self.index, columns=self.columns)
+
+def random_effect_design(input_data, hierarchy, root_area, keep=[]):
+    """ Generate the random effects design for the areas of input_data
+
+    :Parameters:
+      - `input_data` : pandas.DataFrame with column 'area'
+      - `hierarchy` : networkx.DiGraph, with root 'all'
+      - `root_area` : str, the reference area, which has random effect 0
+      - `keep` : list of nodes to keep even if they are set for all rows (e.g. because they have an informative prior)
+
+    :Results:
+      - Returns RandomEffectDesign, with a column for each node below root_area that is set for at least one row, and not for all rows
+
+    """
+    index = data.hierarchy_index(hierarchy)
+    nodes = index.nodes
+
+    # find the path through the hierarchy once for each distinct area
+    area_path = {}
+    for area in input_data['area']:
+        if area not in area_path:
+            if area in index:
+                area_path[area] = [index.index[node] for node in index.path(area)]
+            else:
+                print 'WARNING: "%s" not in model hierarchy, skipping random effects for this observation' % area
+                area_path[area] = []
+
+    max_depth = max([len(p) for p in area_path.values()] + [0])
+    for area, p in area_path.items():
+        area_path[area] = p + [len(nodes)]*(max_depth - len(p))
+    path = pl.array([area_path[area] for area in input_data['area']], dtype=int).reshape((len(input_data.index), max_depth))
+
+    # drop columns with only zeros and which are for higher levels in hierarchy
+    # also drop random effects with all observations set to 1, unless they have an informative prior
+    n = len(input_data.index)
+    count = pl.bincount(pl.append(path.flatten(), len(nodes)))
+    root_level = index.level(root_area)
+    columns = [node for node in hierarchy.nodes() if node in index
+               and count[index.index[node]] > 0 and index.level(node) > root_level
+               and (count[index.index[node]] < n or node in keep)]
+
+    column_index = len(columns) * pl.ones(len(nodes)+1, dtype=int)
+    for k, node in enumerate(columns):
+        column_index[index.index[node]] = k
+    path = column_index[path]
+    path.sort(axis=1)
+    path = path[:, :(path < len(columns)).sum(axis=1).max()] if n > 0 else path
+
+    shift = pandas.Series(0., index=columns)
+    for node in index.path(root_area):
+        if node in shift:
+            shift[node] = 1.
+
+    return RandomEffectDesign(input_data.index, columns, path, shift)
+
+def covariate_design(input_data, model, root_area, root_sex, root_year, design_cache=None):
+    """ Generate the fixed effects design for input_data
+
+    :Parameters:
+      - `input_data` : pandas.DataFrame, with covariate columns starting with 'x_'
+      - `model` : ModelData, with output_template for finding the covariate values of the root
+      - `root_area, root_sex, root_year` : str, str, int
+      - `design_cache` : dict, optional, for sharing the output_template aggregation between calls
+
+    :Results:
+      - Returns X, X_shift, where X is shifted to have zero for the root covariates
+
+    """
+    if design_cache is None:
+        design_cache = {}
+
+    X = input_data.select(lambda col: col.startswith('x_'), axis=1)
+
+    # add sex as a fixed effect (TODO: decide if this should be in data.py, when loading gbd model)
+    X['x_sex'] = [sex_value[s] for s in input_data['sex']]
+
+    # shift columns to have zero for root covariate
+    key = ('X_shift', tuple(X.columns), root_area, root_sex, root_year)
+    if key in design_cache:
+        X_shift = design_cache[key].copy()
+    else:
+        if 'output_template' not in design_cache:
+            try:
+                design_cache['output_template'] = model.output_template.groupby(['area', 'sex', 'year']).mean()  # TODO: change to .first(), but that doesn't work with old pandas
+            except pandas.core.groupby.DataError:
+                design_cache['output_template'] = model.output_template.groupby(['area', 'sex', 'year']).first()
+        output_template = design_cache['output_template']
+
+        X_shift = pandas.Series(0., index=X.columns)
+        covs = output_template.filter(list(X.columns) + ['pop'])
+        if len(covs.columns) > 1:
+            leaves = data.hierarchy_index(model.hierarchy).leaves[root_area]
+
+            if root_sex == 'total' and root_year == 'all':  # special case for all years and sexes
+                covs = covs.delevel().drop(['year', 'sex'], axis=1).groupby('area').mean()  # TODO: change to .reset_index(), but that doesn't work with old pandas
+                leaf_covs = covs.ix[leaves]
+            elif root_sex == 'total':
+                raise Exception, 'root_sex == total, root_year != all is Not Yet Implemented'
+            elif root_year == 'all':
+                raise Exception, 'root_year == all, root_sex != total is Not Yet Implemented'
+            else:
+                leaf_covs = covs.ix[[(l, root_sex, root_year) for l in leaves]]
+
+            for cov in covs:
+                if cov != 'pop':
+                    X_shift[cov] = (leaf_covs[cov] * leaf_covs['pop']).sum() / leaf_covs['pop'].sum()
+
+        if 'x_sex' in X.columns:
+            X_shift['x_sex'] = sex_value[root_sex]
+
+        design_cache[key] = X_shift.copy()
+
+    X = X - X_shift
+
+    assert not pl.any(pl.isnan(X.__array__())), 'Covariate matrix should have no missing values'
+
+    return X, X_shift
+
+def vectorized_random_effects(name, U, hierarchy, parameters, sigma_alpha, zero_re=True):
+    """ Generate PyMC objects for the random effects, with all free
+    effects in a single array-valued stoch
+
+    :Parameters:
+      - `name` : str
+      - `U` : RandomEffectDesign
+      - `hierarchy` : networkx.DiGraph
+      - `parameters` : dict, with priors on random effects in parameters['random_effects']
+      - `sigma_alpha` : list of pymc.Nodes, the dispersion of random effects at each level of hierarchy
+      - `zero_re` : boolean, make the first effect in each set of siblings equal to minus the sum of the others
+
+    :Results:
+      - Returns alpha, alpha_free, alpha_potentials, const_alpha_sigma
+
+    .. note::
+      - alpha is a deterministic with value T * alpha_free + c, where
+        T is a sparse matrix and c is a vector which incorporates the
+        sum-to-zero constraints and the effects with dist='Constant'
+      - the priors on all of the effects which are not constant are
+        included in a single potential
+
+    """
+    index = data.hierarchy_index(hierarchy)
+    p = len(U.columns)
+    priors = parameters.get('random_effects', {})
+
+    mu = pl.zeros(p)
+    tau = pl.nan*pl.ones(p)  # nan means use sigma_alpha for this level
+    lower = -pl.inf*pl.ones(p)
+    upper = pl.inf*pl.ones(p)
+    level = pl.array([index.level(col) for col in U.columns], dtype=int)
+    const = pl.zeros(p, dtype=bool)
+    const_alpha_sigma = pl.nan*pl.ones(p)
+    for j, col in enumerate(U.columns):
+        if col in priors:
+            prior = priors[col]
+            print 'using stored RE for', 'alpha_%s_%s'%(name, col), prior
+            if prior['dist'] == 'Normal':
+                mu[j], tau[j] = prior['mu'], pl.maximum(prior['sigma'], .001)**-2
+            elif prior['dist'] == 'TruncatedNormal':
+                mu[j], tau[j] = prior['mu'], pl.maximum(prior['sigma'], .001)**-2
+                lower[j], upper[j] = prior['lower'], prior['upper']
+            elif prior['dist'] == 'Constant':
+                mu[j], const[j] = float(prior['mu']), True
+                const_alpha_sigma[j] = float(prior['sigma'])
+            else:
+                assert 0, 'ERROR: prior distribution "%s" is not implemented' % prior['dist']
+
+    # change one effect from each set of siblings in area hierarchy to a 'sum to zero' constraint,
+    # unless its prior has dist='Constant'
+    siblings = {}
+    if zero_re:
+        column_map = dict([(n,i) for i,n in enumerate(U.columns)])
+        for parent in hierarchy:
+            nodes = [column_map[n] for n in index.children.get(parent, []) if n in U]
+            if len(nodes) > 0 and not const[nodes[0]]:
+                siblings[nodes[0]] = nodes[1:]
+
+    # the truncation is only applied to free effects, as it is for the
+    # potentials on sum-to-zero effects in mean_covariate_model
+    lower[siblings.keys()] = -pl.inf
+    upper[siblings.keys()] = pl.inf
+
+    free = [j for j in range(p) if not const[j] and j not in siblings]
+    free_index = dict([(j, k) for k, j in enumerate(free)])
+    row, col, val = [], [], []
+    c = pl.where(const, mu, 0.)
+    for j in free:
+        row.append(j)
+        col.append(free_index[j])
+        val.append(1.)
+    for j, others in siblings.items():
+        for k in others:
+            if const[k]:
+                c[j] -= mu[k]
+            else:
+                row.append(j)
+                col.append(free_index[k])
+                val.append(-1.)
+    T = scipy.sparse.csr_matrix((pl.array(val, dtype=float), (pl.array(row, dtype=int), pl.array(col, dtype=int))),
+                                shape=(p, len(free)))
+
+    if len(free) > 0:
+        alpha_free = mc.Uninformative('alpha_free_%s'%name, value=pl.zeros(len(free)))
+    else:
+        alpha_free = pl.zeros(0)
+
+    @mc.deterministic(name='alpha_%s'%name)
+    def alpha(alpha_free=alpha_free):
+        return T * alpha_free + c
+    alpha.vjp = lambda adj, alpha_free: dict(alpha_free=T.T * adj)
+
+    J = pl.where(~const)[0]
+    if len(J) == 0:
+        return alpha, alpha_free, [], list(const_alpha_sigma)
+
+    default = pl.isnan(tau[J])
+    @mc.potential(name='alpha_pot_%s'%name)
+    def alpha_potential(alpha=alpha, sigma_alpha=sigma_alpha,
+                        mu=mu[J], tau=tau[J], level=level[J], lower=lower[J], upper=upper[J]):
+        alpha = alpha[J]
+        if pl.any(alpha < lower) or pl.any(alpha > upper):
+            return -pl.inf
+        tau = pl.where(default, pl.array(sigma_alpha, dtype=float)[level]**-2, tau)
+        return mc.normal_like(alpha, mu, tau)
+
+    def alpha_potential_grad(alpha, sigma_alpha, mu, tau, level, lower, upper):
+        sigma_alpha = pl.array(sigma_alpha, dtype=float)
+        tau = pl.where(default, sigma_alpha[level]**-2, tau)
+        d_alpha = pl.zeros(len(alpha))
+        d_alpha[J], d_mu, d_tau = logp_gradient.normal_grad(alpha[J], mu, tau)
+
+        # the levels that use sigma_alpha have tau = sigma_alpha**-2
+        d_sigma = pl.where(default, -2. * sigma_alpha[level]**-3 * d_tau, 0.)
+        return dict(alpha=d_alpha, sigma_alpha=pl.bincount(level, d_sigma, minlength=len(sigma_alpha)))
+    alpha_potential.logp_grad = alpha_potential_grad
+
+    return alpha, alpha_free, [alpha_potential], list(const_alpha_sigma)
+
+def mean_covariate_model(name, mu, input_data, parameters, model, root_area, root_sex, root_year, zero_re=True,
+                         design_cache=None, vectorized_re=False):
     """ Generate PyMC objects covariate adjusted version of mu
 
     :Parameters:
@@ -38,55 +340,35 @@ def mean_covariate_model(name, mu, input_data, parameters, model, root_area, roo
       - `model` : ModelData to use for covariates
       - `root_area, root_sex, root_year` : str, str, int
       - `zero_re` : boolean, change one stoch from each set of siblings in area hierarchy to a 'sum to zero' deterministic
+      - `design_cache` : dict, optional, for sharing the U and X designs between calls for the same model
+      - `vectorized_re` : boolean, keep the free random effects in a single array-valued stoch, see vectorized_random_effects
 
     :Results:
       - Returns dict of PyMC objects, including 'pi', the covariate adjusted predicted values for the mu and X provided
 
+    .. note::
+      - the designs depend only on the rows of input_data, the
+        reference area/sex/year and the model's hierarchy and
+        output_template, so design_cache must only be shared between
+        calls for a single model (see ism.consistent)
+
     """
-    n = len(input_data.index)
+    if design_cache is None:
+        design_cache = {}
+    rows = (tuple(input_data.index), tuple(input_data['area']))
 
     # make U and alpha
-    p_U = model.hierarchy.number_of_nodes()  # random effects for area
-    U = pandas.DataFrame(pl.zeros((n, p_U)), columns=model.hierarchy.nodes(), index=input_data.index)
-    for i, row in input_data.T.iteritems():
-        if row['area'] not in model.hierarchy:
-            print 'WARNING: "%s" not in model hierarchy, skipping random effects for this observation' % row['area']
-            continue
-        
-        for level, node in enumerate(nx.shortest_path(model.hierarchy, 'all', input_data.ix[i, 'area'])):
-            model.hierarchy.node[node]['level'] = level
-            U.ix[i, node] = 1.
-            
-    for n2 in model.hierarchy.nodes():
-        for level, node in enumerate(nx.shortest_path(model.hierarchy, 'all', n2)):
-                        model.hierarchy.node[node]['level'] = level
-                        
-    #U = U.select(lambda col: U[col].std() > 1.e-5, axis=1)  # drop constant columns
-    if len(U.index) == 0:
-        U = pandas.DataFrame()
-    else:
-        U = U.select(lambda col: (U[col].max() > 0) and (model.hierarchy.node[col].get('level') > model.hierarchy.node[root_area]['level']), axis=1)  # drop columns with only zeros and which are for higher levels in hierarchy
-        #U = U.select(lambda col: model.hierarchy.node[col].get('level') <= 2, axis=1)  # drop country-level REs
-        #U = U.drop(['super-region_0', 'north_america_high_income', 'USA'], 1)
-
-        #U = U.drop(['super-region_0', 'north_america_high_income'], 1)
-        #U = U.drop(U.columns, 1)
-
-
-        ## drop random effects with less than 1 observation or with all observations set to 1, unless they have an informative prior
-        keep = []
-        if 'random_effects' in parameters:
-            for re in parameters['random_effects']:
-                if parameters['random_effects'][re].get('dist') == 'Constant':
-                    keep.append(re)
-        U = U.select(lambda col: 1 <= U[col].sum() < len(U[col]) or col in keep, axis=1)
-
-
-    U_shift = pandas.Series(0., index=U.columns)
-    for level, node in enumerate(nx.shortest_path(model.hierarchy, 'all', root_area)):
-        if node in U_shift:
-            U_shift[node] = 1.
-    U = U - U_shift
+    ## keep random effects with all observations set to 1 if they have an informative prior
+    keep = []
+    if 'random_effects' in parameters:
+        for re in parameters['random_effects']:
+            if parameters['random_effects'][re].get('dist') == 'Constant':
+                keep.append(re)
+    key = ('U', rows, root_area, tuple(sorted(keep)))
+    if key not in design_cache:
+        design_cache[key] = random_effect_design(input_data, model.hierarchy, root_area, keep)
+    U = design_cache[key]
+    U_shift = U.shift
 
     sigma_alpha = []
     for i in range(5):  # max depth of hierarchy is 5
@@ -104,13 +386,19 @@ def mean_covariate_model(name, mu, input_data, parameters, model, root_area, roo
     alpha = pl.array([])
     const_alpha_sigma = pl.array([])
     alpha_potentials = []
-    if len(U.columns) > 0:
+    index = data.hierarchy_index(model.hierarchy)
+    if len(U.columns) > 0 and vectorized_re:
+        alpha, alpha_free, alpha_potentials, const_alpha_sigma = \
+            vectorized_random_effects(name, U, model.hierarchy, parameters, sigma_alpha, zero_re)
+    elif len(U.columns) > 0:
         tau_alpha_index = []
         for alpha_name in U.columns:
-            tau_alpha_index.append(model.hierarchy.node[alpha_name]['level'])
+            tau_alpha_index.append(index.level(alpha_name))
         tau_alpha_index=pl.array(tau_alpha_index, dtype=int)
 
         tau_alpha_for_alpha = [sigma_alpha[i]**-2 for i in tau_alpha_index]
+        for tau_alpha_i in tau_alpha_for_alpha:
+            tau_alpha_i.vjp = lambda adj, a, b: dict(a=b * a**(b-1.) * adj)
 
         alpha = []
         for i, tau_alpha_i in enumerate(tau_alpha_for_alpha):
@@ -148,7 +436,7 @@ def mean_covariate_model(name, mu, input_data, parameters, model, root_area, roo
             column_map = dict([(n,i) for i,n in enumerate(U.columns)])
             # change one stoch from each set of siblings in area hierarchy to a 'sum to zero' deterministic
             for parent in model.hierarchy:
-                node_names = model.hierarchy.successors(parent)
+                node_names = index.children.get(parent, [])
                 nodes = [column_map[n] for n in node_names if n in U]
                 if len(nodes) > 0:
                     i = nodes[0]
@@ -160,56 +448,26 @@ def mean_covariate_model(name, mu, input_data, parameters, model, root_area, roo
 
                     alpha[i] = mc.Lambda('alpha_det_%s_%d'%(name, i),
                                                 lambda other_alphas_at_this_level=[alpha[n] for n in nodes[1:]]: -sum(other_alphas_at_this_level))
+                    alpha[i].vjp = lambda adj, other_alphas_at_this_level: \
+                        dict(other_alphas_at_this_level=-adj * pl.ones(len(other_alphas_at_this_level)))
 
                     if isinstance(old_alpha_i, mc.Stochastic):
                         @mc.potential(name='alpha_pot_%s_%s'%(name, U.columns[i]))
                         def alpha_potential(alpha=alpha[i], mu=old_alpha_i.parents['mu'], tau=old_alpha_i.parents['tau']):
                             return mc.normal_like(alpha, mu, tau)
+                        alpha_potential.logp_grad = lambda alpha, mu, tau: \
+                            dict(zip(['alpha', 'mu', 'tau'], logp_gradient.normal_grad(alpha, mu, tau)))
                         alpha_potentials.append(alpha_potential)
 
     # make X and beta
-    X = input_data.select(lambda col: col.startswith('x_'), axis=1)
-
-    # add sex as a fixed effect (TODO: decide if this should be in data.py, when loading gbd model)
-    X['x_sex'] = [sex_value[row['sex']] for i, row in input_data.T.iteritems()]
+    key = ('X', rows, root_area, root_sex, root_year)
+    if key not in design_cache:
+        design_cache[key] = covariate_design(input_data, model, root_area, root_sex, root_year, design_cache)
+    X, X_shift = design_cache[key]
 
     beta = pl.array([])
     const_beta_sigma = pl.array([])
-    X_shift = pandas.Series(0., index=X.columns)
     if len(X.columns) > 0:
-        # shift columns to have zero for root covariate
-        try:
-            output_template = model.output_template.groupby(['area', 'sex', 'year']).mean()  # TODO: change to .first(), but that doesn't work with old pandas
-        except pandas.core.groupby.DataError:
-            output_template = model.output_template.groupby(['area', 'sex', 'year']).first()
-        covs = output_template.filter(list(X.columns) + ['pop'])
-        if len(covs.columns) > 1:
-            leaves = [n for n in nx.traversal.bfs_tree(model.hierarchy, root_area) if model.hierarchy.successors(n) == []]
-            if len(leaves) == 0:
-                # networkx returns an empty list when the bfs tree is a single node
-                leaves = [root_area]
-
-            if root_sex == 'total' and root_year == 'all':  # special case for all years and sexes
-                covs = covs.delevel().drop(['year', 'sex'], axis=1).groupby('area').mean()  # TODO: change to .reset_index(), but that doesn't work with old pandas
-                leaf_covs = covs.ix[leaves]
-            elif root_sex == 'total':
-                raise Exception, 'root_sex == total, root_year != all is Not Yet Implemented'
-            elif root_year == 'all':
-                raise Exception, 'root_year == all, root_sex != total is Not Yet Implemented'
-            else:
-                leaf_covs = covs.ix[[(l, root_sex, root_year) for l in leaves]]
-
-            for cov in covs:
-                if cov != 'pop':
-                    X_shift[cov] = (leaf_covs[cov] * leaf_covs['pop']).sum() / leaf_covs['pop'].sum()
-
-        if 'x_sex' in X.columns:
-            X_shift['x_sex'] = sex_value[root_sex]
-
-        X = X - X_shift
-
-        assert not pl.any(pl.isnan(X.__array__())), 'Covariate matrix should have no missing values'
-
         beta = []
         for i, effect in enumerate(X.columns):
             name_i = 'beta_%s_%s'%(name, effect)
@@ -241,12 +499,45 @@ def mean_covariate_model(name, mu, input_data, parameters, model, root_area, roo
                 const_beta_sigma.append(pl.nan)
                 
     @mc.deterministic(name='pi_%s'%name)
-    def pi(mu=mu, U=pl.array(U, dtype=float), alpha=alpha, X=pl.array(X, dtype=float), beta=beta):
-        return mu * pl.exp(pl.dot(U, [float(x) for x in alpha]) + pl.dot(X, [float(x) for x in beta]))
+    def pi(mu=mu, alpha=alpha, X=pl.array(X, dtype=float), beta=beta):
+        return mu * pl.exp(U.dot(alpha) + pl.dot(X, pl.array(beta, dtype=float)))
+
+    def pi_vjp(adj, mu, alpha, X, beta):
+        effect = pl.exp(U.dot(alpha) + pl.dot(X, pl.array(beta, dtype=float)))
+        z = adj * mu * effect
+        return dict(mu=adj * effect, alpha=U.dot_transpose(z), beta=pl.dot(X.T, z))
+    pi.vjp = pi_vjp
+
+    vars = dict(pi=pi, U=U, U_shift=U_shift, sigma_alpha=sigma_alpha, alpha=alpha, alpha_potentials=alpha_potentials, X=X, X_shift=X_shift, beta=beta, hierarchy=model.hierarchy, const_alpha_sigma=const_alpha_sigma, const_beta_sigma=const_beta_sigma)
+    if isinstance(alpha, mc.Node) and isinstance(alpha_free, mc.Stochastic):
+        vars['alpha_free'] = alpha_free
+    return vars
 
-    return dict(pi=pi, U=U, U_shift=U_shift, sigma_alpha=sigma_alpha, alpha=alpha, alpha_potentials=alpha_potentials, X=X, X_shift=X_shift, beta=beta, hierarchy=model.hierarchy, const_alpha_sigma=const_alpha_sigma, const_beta_sigma=const_beta_sigma)
 
 
+def alpha_stats(vars):
+    """ Summarize the random effects, whether they are stored as a
+    list of pymc.Nodes and floats or as a single array-valued pymc.Node
+
+    :Parameters:
+      - `vars` : dict, including entries for alpha, U, and const_alpha_sigma
+
+    :Results:
+      - Returns list of (stats, value) pairs, one for each column of vars['U'], where stats is a dict with
+        keys 'mean' and 'standard deviation', or None if the effect is constant or has not been sampled
+
+    """
+    if isinstance(vars['alpha'], mc.Node):
+        stats = vars['alpha'].stats()
+        results = []
+        for j, sigma in enumerate(vars['const_alpha_sigma']):
+            if stats and pl.isnan(sigma):
+                results.append((dict([(k, stats[k][j]) for k in ['mean', 'standard deviation']]), vars['alpha'].value[j]))
+            else:
+                results.append((None, vars['alpha'].value[j]))
+        return results
+    else:
+        return [(isinstance(n, mc.Node) and n.stats() or None, float(n)) for n in vars['alpha']]
 
 def dispersion_covariate_model(name, input_data, delta_lb, delta_ub):
     lower = pl.log(delta_lb)
@@ -262,12 +553,18 @@ def dispersion_covariate_model(name, input_data, delta_lb, delta_ub):
         def delta(eta=eta, zeta=zeta, Z=Z.__array__()):
             return pl.exp(eta + pl.dot(Z, zeta))
 
+        def delta_vjp(adj, eta, zeta, Z):
+            z = adj * pl.exp(eta + pl.dot(Z, zeta))
+            return dict(eta=z.sum(), zeta=pl.dot(Z.T, z))
+        delta.vjp = delta_vjp
+
         return dict(eta=eta, Z=Z, zeta=zeta, delta=delta)
 
     else:
         @mc.deterministic(name='delta_%s'%name)
         def delta(eta=eta):
             return pl.exp(eta) * pl.ones_like(input_data.index)
+        delta.vjp = lambda adj, eta: dict(eta=pl.exp(eta) * pl.sum(adj))
         return dict(eta=eta, delta=delta)
 
 
@@ -298,6 +595,7 @@ def predict_for(model, parameters,
 
     """
     area_hierarchy = model.hierarchy
+    index = data.hierarchy_index(area_hierarchy)
     output_template = model.output_template.copy()
 
     # find number of samples from posterior
@@ -308,7 +606,7 @@ def predict_for(model, parameters,
     # a column for each random effect (e.g. countries with data, regions with countries with data, etc)
     #
     # there are several cases to handle, or at least at one time there were:
-    #   vars['alpha'] is a pymc Stochastic with an array for its value (no longer used?)
+    #   vars['alpha'] is a pymc Deterministic with an array for its value (see vectorized_random_effects)
     #   vars['alpha'] is a list of pymc Nodes
     #   vars['alpha'] is a list of floats
     #   vars['alpha'] is a list of some floats and some pymc Nodes
@@ -319,8 +617,12 @@ def predict_for(model, parameters,
     # the prediction
     
     if 'alpha' in vars and isinstance(vars['alpha'], mc.Node):
-        assert 0, 'No longer used'
-        alpha_trace = vars['alpha'].trace()
+        alpha_trace = pl.array(vars['alpha'].trace(), dtype=float)
+        for j, sigma in enumerate(vars['const_alpha_sigma']):
+            if not pl.isnan(sigma):
+                # uncertainty of constant alpha incorporated here
+                sigma = max(sigma, 1.e-9) # make sure sigma is non-zero
+                alpha_trace[:, j] = mc.rnormal(alpha_trace[0, j], sigma**-2, size=len_trace)
     elif 'alpha' in vars and isinstance(vars['alpha'], list):
         alpha_trace = []
         for n, sigma in zip(vars['alpha'], vars['const_alpha_sigma']):
@@ -373,10 +675,7 @@ def predict_for(model, parameters,
     # the prediction for the requested area is produced by aggregating predictions for all of the childred
     # of that area in the area_hierarchy (a networkx.DiGraph)
 
-    leaves = [n for n in nx.traversal.bfs_tree(area_hierarchy, area) if area_hierarchy.successors(n) == []]
-    if len(leaves) == 0:
-        # networkx returns an empty list when the bfs tree is a single node
-        leaves = [area]
+    leaves = index.leaves[area]
 
 
     # initialize covariate_shift and total_population
@@ -419,11 +718,11 @@ def predict_for(model, parameters,
         log_shift_l = pl.zeros(len_trace)
         U_l.ix[0,:] = 0.
 
-        root_to_leaf = nx.shortest_path(area_hierarchy, root_area, l)
+        root_to_leaf = index.path(l, start=root_area)
         for node in root_to_leaf[1:]:
             if node not in U_l.columns:
                 ## Add a columns U_l[node] = rnormal(0, appropriate_tau)
-                level = len(nx.shortest_path(area_hierarchy, 'all', node))-1
+                level = index.level(node)
                 if 'sigma_alpha' in vars:
                     tau_l = vars['sigma_alpha'][level].trace()**-2
                     
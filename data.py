@@ -7,6 +7,7 @@ import pylab as pl
 import simplejson as json
 
 import graphics
+import diagnostics
 
 def describe_vars(d):
     m = mc.Model(d)
@@ -32,24 +33,135 @@ def describe_vars(d):
 
 def check_convergence(vars):
     """ Apply a simple test of convergence to the model: compare
-    autocorrelation at 25 lags to zero lags.  warn about convergence if it exceeds
-    10% for any stoch """
+    autocorrelation at lags 50 to 100 to zero lags.  warn about convergence if it exceeds
+    50% for any stoch
+
+    the traces of all stochs are stacked, and their autocorrelations
+    found at once with the fft, see diagnostics.autocorrelation """
     import dismod3
     cells, stochs = dismod3.graphics.tally_stochs(vars)
+    stochs = sorted(stochs, key=lambda s: s.__name__)
+    if len(stochs) == 0:
+        return True
+
+    traces = [pl.array(s.trace(), dtype=float) for s in stochs]
+    traces = [tr.reshape((len(tr), -1)) for tr in traces]
+    acorr = diagnostics.autocorrelation(pl.hstack(traces))[50:100]
+
+    col = 0
+    for s, tr in zip(stochs, traces):
+        acorr_s = acorr[:, col:col+tr.shape[1]]
+        col += tr.shape[1]
+        if pl.any(pl.absolute(acorr_s) > .5):
+            print 'potential non-convergence', s, acorr_s.flat[pl.absolute(acorr_s).argmax()]
+            return False
 
-    for s in sorted(stochs, key=lambda s: s.__name__):
-        tr = s.trace()
-        if len(tr.shape) == 1:
-            tr = tr.reshape((len(tr), 1))
-        for d in range(len(pl.atleast_1d(s.value))):
-            for k in range(50,100):
-                acorr = pl.dot(tr[:-k,d]-tr[:k,d].mean(), tr[k:,d]-tr[k:,d].mean()) / pl.dot(tr[k:,d]-tr[k:,d].mean(), tr[k:,d]-tr[k:,d].mean())
-                if abs(acorr) > .5:
-                    print 'potential non-convergence', s, acorr
-                    return False
-            
     return True
 
+class HierarchyIndex:
+    """ Array-backed index of a tree-structured area hierarchy
+
+    Precomputes everything the model needs to know about the
+    hierarchy, so that building and predicting from a model does not
+    need to traverse the networkx graph again
+
+    :Parameters:
+      - `G` : networkx.DiGraph, a tree
+      - `root` : str, optional, the root of the tree
+
+    .. note::
+      - nodes are numbered in depth-first preorder, so the subtree
+        rooted at node j is the nodes numbered tin[j] to tout[j]-1
+      - nodes that are not reachable from root are not included
+
+    """
+    def __init__(self, G, root='all'):
+        self.root = root
+        self.nodes = []
+        self.parent = []
+        self.depth = []
+        self.children = {}
+
+        stack = [(root, -1, 0)]
+        while stack:
+            node, parent, depth = stack.pop()
+            self.nodes.append(node)
+            self.parent.append(parent)
+            self.depth.append(depth)
+            self.children[node] = G.successors(node)
+            j = len(self.nodes) - 1
+            stack += [(c, j, depth+1) for c in reversed(self.children[node])]
+
+        self.index = dict([(node, j) for j, node in enumerate(self.nodes)])
+        self.parent = pl.array(self.parent, dtype=int)
+        self.depth = pl.array(self.depth, dtype=int)
+
+        # Euler-tour intervals, from the preorder numbering
+        n = len(self.nodes)
+        self.tin = pl.arange(n)
+        self.tout = pl.arange(n) + 1
+        for j in reversed(range(1, n)):
+            self.tout[self.parent[j]] = max(self.tout[self.parent[j]], self.tout[j])
+
+        self.paths = {}
+        for j, node in enumerate(self.nodes):
+            if self.parent[j] == -1:
+                self.paths[node] = [node]
+            else:
+                self.paths[node] = self.paths[self.nodes[self.parent[j]]] + [node]
+
+        is_leaf = [len(self.children[node]) == 0 for node in self.nodes]
+        self.leaves = {}
+        for j, node in enumerate(self.nodes):
+            self.leaves[node] = [self.nodes[k] for k in range(self.tin[j], self.tout[j]) if is_leaf[k]]
+
+    def __contains__(self, node):
+        return node in self.index
+
+    def level(self, node):
+        """ Return the depth of node below the root """
+        return self.depth[self.index[node]]
+
+    def path(self, node, start=None):
+        """ Return the list of nodes from start (default the root) to node """
+        path = self.paths[node]
+        if start is not None:
+            assert self.is_ancestor(start, node), '"%s" is not an ancestor of "%s"' % (start, node)
+            path = path[self.level(start):]
+        return path
+
+    def is_ancestor(self, a, b):
+        """ Return True if b is in the subtree rooted at a """
+        i, j = self.index[a], self.index[b]
+        return self.tin[i] <= self.tin[j] < self.tout[i]
+
+    def subtree(self, node):
+        """ Return the list of nodes in the subtree rooted at node, in breadth-first order """
+        j = self.index[node]
+        sub = range(self.tin[j], self.tout[j])
+        return [self.nodes[k] for k in sorted(sub, key=lambda k: self.depth[k])]
+
+    def nodes_at_level(self, level):
+        return [node for node, d in zip(self.nodes, self.depth) if d == level]
+
+def hierarchy_index(G, root='all'):
+    """ Return the HierarchyIndex for G, building it only if G has changed since it was last built
+
+    :Parameters:
+      - `G` : networkx.DiGraph, a tree
+      - `root` : str, optional, the root of the tree
+
+    .. note::
+      - the index is cached in G.graph, so it is shared by every
+        function that is passed the same graph
+
+    """
+    key = (root, frozenset(G.nodes()), frozenset(G.edges()))
+    if G.graph.get('hierarchy_index_key') != key:
+        G.graph['hierarchy_index'] = HierarchyIndex(G, root)
+        G.graph['hierarchy_index_key'] = key
+    return G.graph['hierarchy_index']
+
 class ModelVars(dict):
     """ Container class for PyMC Node objects that make up the model
 
@@ -99,11 +211,12 @@ class ModelVars(dict):
                 pdt = dict(random_effects={}, fixed_effects={})
 
                 if 'U' in self[t]:
-                    for i, re in enumerate(self[t]['U'].columns):
-                        if isinstance(self[t]['alpha'][i], mc.Node):
-                            pdt['random_effects'][re] = dict(dist='Constant', mu=self[t]['alpha'][i].stats()['mean'])
+                    import covariate_model
+                    for re, (stats, value) in zip(self[t]['U'].columns, covariate_model.alpha_stats(self[t])):
+                        if stats:
+                            pdt['random_effects'][re] = dict(dist='Constant', mu=stats['mean'])
                         else:
-                            pdt['random_effects'][re] = dict(dist='Constant', mu=self[t]['alpha'][i])
+                            pdt['random_effects'][re] = dict(dist='Constant', mu=value)
 
                 if 'X' in self[t]:
                     for i, fe in enumerate(self[t]['X'].columns):
@@ -148,17 +261,24 @@ class ModelData:
         else:
             return self.input_data
 
+    def hierarchy_index(self):
+        """ Return the HierarchyIndex of the area hierarchy, rebuilding it if the hierarchy has changed """
+        return hierarchy_index(self.hierarchy)
+
     def describe(self, data_type):
-        G = self.hierarchy
+        index = self.hierarchy_index()
         df = self.get_data(data_type)
 
-        for n in nx.dfs_postorder_nodes(G, 'all'):
-            G.node[n]['cnt'] = len(df[df['area']==n].index) + pl.sum([G.node[c]['cnt'] for c in G.successors(n)])
-            G.node[n]['depth'] = nx.shortest_path_length(G, 'all', n)
-        
-        for n in nx.dfs_preorder_nodes(G, 'all'):
-            if G.node[n]['cnt'] > 0:
-                print ' *'*G.node[n]['depth'], n, int(G.node[n]['cnt'])
+        cnt = pl.zeros(len(index.nodes))
+        for area in df['area']:
+            if area in index:
+                cnt[index.index[area]] += 1
+        for j in reversed(range(1, len(index.nodes))):
+            cnt[index.parent[j]] += cnt[j]
+
+        for j, n in enumerate(index.nodes):
+            if cnt[j] > 0:
+                print ' *'*index.depth[j], n, int(cnt[j])
 
     def keep(self, areas=['all'], sexes=['male', 'female', 'total'], start_year=-pl.inf, end_year=pl.inf):
         """ Modify model to feature only desired area/sex/year(s)
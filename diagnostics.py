@@ -0,0 +1,242 @@
+""" Convergence diagnostics for MCMC samples stored as numpy arrays"""
+
+import numpy as np
+import pylab as pl
+import pymc as mc
+import pandas
+
+import array_trace
+
+
+def as_chains(chains):
+    """ Arrange samples from several chains as a 3-d array
+
+    :Parameters:
+      - `chains` : array or list of arrays, with one chain of samples
+        along the first axis of each
+
+    :Results:
+      - Returns a float array with shape (chains, samples, columns),
+        and the shape of one sample
+    """
+    chains = pl.array(chains, dtype=float)
+    shape = chains.shape[2:]
+    return chains.reshape(chains.shape[:2] + (-1,)), shape
+
+def autocorrelation(x):
+    """ Autocorrelation of each column of a trace, at all lags, found
+    with the fft
+
+    :Parameters:
+      - `x` : array, with samples along the first axis
+
+    :Results:
+      - Returns an array with the shape of x, where row t is the
+        autocorrelation at lag t
+    """
+    x = pl.array(x, dtype=float)
+    n = len(x)
+    x = x - x.mean(0)
+
+    # pad to a power of two at least 2n, so the circular correlation is not wrapped
+    n_fft = 2**int(pl.ceil(pl.log2(2*n)))
+    f = np.fft.rfft(x, n=n_fft, axis=0)
+    acov = np.fft.irfft(f * pl.conjugate(f), n=n_fft, axis=0)[:n]
+    var = acov[0]
+    return acov / pl.where(var > 0, var, 1.)
+
+def split_rhat(chains):
+    """ Potential scale reduction factor of Gelman and Rubin, with
+    each chain split in halves, so that it also detects drift within
+    a chain
+
+    :Parameters:
+      - `chains` : array, with shape (chains, samples) + shape of one sample
+
+    :Results:
+      - Returns an array with the shape of one sample, which is near 1
+        when the chains have mixed, and nan for constant columns
+
+    .. note::
+      - a single chain gives the R-hat of its two halves
+    """
+    x, shape = as_chains(chains)
+    m, n = x.shape[:2]
+    half = n / 2
+    assert half >= 2, 'need at least 4 samples per chain'
+    x = pl.concatenate([x[:, :half], x[:, n-half:]])
+
+    B = half * x.mean(1).var(0, ddof=1)
+    W = x.var(1, ddof=1).mean(0)
+    var_plus = (half - 1.) / half * W + B / half
+    return pl.sqrt(var_plus / W).reshape(shape)
+
+def integrated_autocorrelation_time(chains):
+    """ Integrated autocorrelation time of all chains together, from
+    the autocorrelation within each chain and the variance between
+    them, with Geyer's initial positive sequence to truncate the sum
+
+    :Parameters:
+      - `chains` : array, with shape (chains, samples) + shape of one sample
+
+    :Results:
+      - Returns an array with the shape of one sample, which is 1 for
+        independent samples, and nan for constant columns
+    """
+    x, shape = as_chains(chains)
+    m, n = x.shape[:2]
+
+    W = x.var(1, ddof=1).mean(0)
+    var_plus = (n - 1.) / n * W
+    if m > 1:
+        var_plus += x.mean(1).var(0, ddof=1)
+
+    acov = pl.array([autocorrelation(x_i) * x_i.var(0) for x_i in x]).mean(0)
+    rho = 1. - (W - acov) / pl.where(var_plus > 0, var_plus, 1.)
+    rho[0] = 1.
+
+    # sum the autocorrelations in pairs, up to the first pair that is
+    # not positive, with each pair at most the one before it
+    pairs = rho[:n/2*2].reshape((n/2, 2, -1)).sum(1)
+    positive = pl.cumprod(pairs > 0, axis=0)
+    positive[0] = 1
+    pairs = pl.minimum.accumulate(pairs, axis=0)
+    tau = -1. + 2*(pairs * positive).sum(0)
+
+    tau[~(var_plus > 0)] = pl.nan
+    return tau.reshape(shape)
+
+def effective_sample_size(chains):
+    """ Effective sample size of all chains together, see
+    integrated_autocorrelation_time
+
+    :Parameters:
+      - `chains` : array, with shape (chains, samples) + shape of one sample
+
+    :Results:
+      - Returns an array with the shape of one sample, of numbers no
+        more than chains*samples, and nan for constant columns
+    """
+    x, shape = as_chains(chains)
+    m, n = x.shape[:2]
+    tau = integrated_autocorrelation_time(x)
+    return (m*n / pl.maximum(tau, 1.)).reshape(shape)
+
+def geweke(chains, first=.1, last=.5):
+    """ Geweke's test of the equality of the means of the start and
+    the end of each chain, with the variance of each mean from its
+    integrated autocorrelation time
+
+    :Parameters:
+      - `chains` : array, with shape (chains, samples) + shape of one sample
+      - `first` : float, the fraction of each chain at the start
+      - `last` : float, the fraction of each chain at the end
+
+    :Results:
+      - Returns an array with the shape of one sample, of the z-score
+        of the chain where it is largest in absolute value, which is
+        approximately standard normal for chains that have converged,
+        and nan for constant columns
+    """
+    x, shape = as_chains(chains)
+    m, n = x.shape[:2]
+    a = x[:, :int(first*n)]
+    b = x[:, n-int(last*n):]
+    assert a.shape[1] >= 4, 'need at least 4 samples in the first part of each chain'
+
+    z = []
+    for a_i, b_i in zip(a, b):
+        var_a = a_i.var(0) * integrated_autocorrelation_time([a_i]) / len(a_i)
+        var_b = b_i.var(0) * integrated_autocorrelation_time([b_i]) / len(b_i)
+        z.append((a_i.mean(0) - b_i.mean(0)) / pl.sqrt(var_a + var_b))
+    z = pl.array(z)
+    i = pl.where(pl.isnan(z), -1., pl.absolute(z)).argmax(0)
+    return z[i, range(z.shape[1])].reshape(shape)
+
+def traced_nodes(vars, nodes=None):
+    """ List the unobserved nodes with saved samples in a dict of
+    model vars, such as model.vars, in order of their keys and
+    without repeats
+
+    :Parameters:
+      - `vars` : dict, with nodes, lists of nodes or dicts of them as values
+
+    :Results:
+      - Returns a list of mc.Node
+    """
+    if nodes is None:
+        nodes = []
+    if isinstance(vars, dict):
+        for k in sorted(vars.keys()):
+            traced_nodes(vars[k], nodes)
+    elif isinstance(vars, (list, tuple)):
+        for v in vars:
+            traced_nodes(v, nodes)
+    elif isinstance(vars, mc.Node) and not getattr(vars, 'observed', False) \
+            and vars.__name__ not in [n.__name__ for n in nodes]:
+        try:
+            if len(vars.trace()) > 0:
+                nodes.append(vars)
+        except TypeError:
+            # untallied nodes have a trace that returns None
+            pass
+    return nodes
+
+def node_chains(n):
+    """ Return the samples of a node as a float array with shape
+    (chains, samples, columns), with one chain unless it is an
+    array_trace.ArrayTrace of several"""
+    if isinstance(n.trace, array_trace.ArrayTrace):
+        x = n.trace.chain_array()
+    else:
+        x = pl.array(n.trace())[None]
+    x = pl.array(x, dtype=float)
+    return x.reshape(x.shape[:2] + (-1,))
+
+def convergence_table(vars, block=1000):
+    """ Convergence diagnostics of every entry of every traced node
+
+    :Parameters:
+      - `vars` : dict of model vars, such as model.vars, see traced_nodes
+      - `block` : int, the largest number of columns to transform at
+        once, which bounds the memory used by the fft
+
+    :Results:
+      - Returns a pandas.DataFrame with one row for each entry of each
+        node, and columns node, index, mean, sd, iat, ess, geweke and rhat;
+        the diagnostics are nan for constant entries, and for chains
+        too short to test
+
+    .. note::
+      - the traces of all nodes with the same number of chains and
+        samples are stacked, so each diagnostic takes a few fft passes
+        over the whole model, instead of one for each node
+    """
+    groups = {}
+    for n in traced_nodes(vars):
+        x = node_chains(n)
+        groups.setdefault(x.shape[:2], []).append([n, x])
+
+    tables = []
+    for (m, n), node_list in sorted(groups.items()):
+        x = pl.concatenate([x_i for n_i, x_i in node_list], axis=2)
+        k = x.shape[2]
+        stats = dict([[col, pl.zeros(k)*pl.nan] for col in 'iat ess geweke rhat'.split()])
+        for j in range(0, k, block):
+            x_j = x[:, :, j:j+block]
+            if n >= 4:
+                stats['iat'][j:j+block] = integrated_autocorrelation_time(x_j)
+                stats['ess'][j:j+block] = effective_sample_size(x_j)
+                stats['rhat'][j:j+block] = split_rhat(x_j)
+            if int(.1*n) >= 4:
+                stats['geweke'][j:j+block] = geweke(x_j)
+
+        stats['node'] = [n_i.__name__ for n_i, x_i in node_list for i in range(x_i.shape[2])]
+        stats['index'] = [i for n_i, x_i in node_list for i in range(x_i.shape[2])]
+        stats['mean'] = x.mean(1).mean(0)
+        stats['sd'] = x.reshape((m*n, k)).std(0)
+        tables.append(pandas.DataFrame(stats, columns='node index mean sd iat ess geweke rhat'.split()))
+
+    if len(tables) == 0:
+        return pandas.DataFrame(columns='node index mean sd iat ess geweke rhat'.split())
+    return pandas.concat(tables, ignore_index=True)
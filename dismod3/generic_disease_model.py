@@ -97,7 +97,7 @@ def setup(dm, key='%s+north_america_high_income+2005+male', data_list=None):
     
     
     # iterative solution to difference equations to obtain bin sizes for all ages
-    import scipy.linalg
+    import closed_form_ode
     @mc.deterministic(name=key % 'bins')
     def SCpm(SC_0=SC_0, i=i, r=r, f=f, m_all_cause=m_all_cause, age_mesh=dm.get_param_age_mesh()):
         SC = pl.zeros([2, len(age_mesh)])
@@ -110,11 +110,16 @@ def setup(dm, key='%s+north_america_high_income+2005+male', data_list=None):
                                   .1*m_all_cause[age_mesh[0]],
                                   1-dismod3.settings.NEARLY_ZERO)  # trim m[0] to avoid numerical instability
 
-        for ii, a in enumerate(age_mesh[:-1]):
-            A = pl.array([[-i[a]-m[ii], r[a]           ],
-                          [ i[a]     , -r[a]-m[ii]-f[a]]]) * (age_mesh[ii+1] - age_mesh[ii])
+        # expm(A) for A = [[-i-m, r], [i, -r-m-f]] * h is exp(-m*h) times the closed-form
+        # exponential of the matrix without m, which does not depend on m, so find all at once
+        start = pl.array(age_mesh[:-1])
+        h = pl.diff(age_mesh)
+        E00, E01, E10, E11 = closed_form_ode.sc_transition(i[start], r[start], f[start], h)
 
-            SC[:,ii+1] = pl.dot(scipy.linalg.expm(A), SC[:,ii])
+        for ii in range(len(age_mesh)-1):
+            decay = pl.exp(-m[ii] * h[ii])
+            SC[0,ii+1] = decay * (E00[ii]*SC[0,ii] + E01[ii]*SC[1,ii])
+            SC[1,ii+1] = decay * (E10[ii]*SC[0,ii] + E11[ii]*SC[1,ii])
             
             p[ii+1] = dismod3.utils.trim(SC[1,ii+1] / (SC[0,ii+1] + SC[1,ii+1]),
                                          dismod3.settings.NEARLY_ZERO,
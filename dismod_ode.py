@@ -38,6 +38,8 @@
 # $codei%
 #	%[ age%[%j%+1] - %age%[%j%]  %]
 # %$$
+# It may also be an integer array of length $icode%N%-1%$$, with
+# $icode%num_step%[%j%]%$$ the number of steps for the $th j$$ interval.
 #
 # $head age$$
 # is $code numpy.array$$ of $code float$$ values.
@@ -93,6 +95,30 @@
 # This may change in future implementations; e.g., perhaps a piecewise
 # linear approximation will be used in the future.
 #
+# $head Reentrance$$
+# All of the state used while taping is held by a $code TapedODE$$
+# object, and $icode fun$$ is its $code fun$$ attribute, so several
+# function objects (for example, one per sex or year) can be created
+# and evaluated side by side.
+#
+# $head Batched Evaluation$$
+# $codei%%Y% = forward_batch(%num_step%, %age%, %all_cause%, %X%)%$$
+# takes the same integration steps as $icode fun$$, in numpy, for
+# every row of the array $icode X$$, which has shape (draws, 3 N + 2).
+# The result $icode Y$$ has shape (draws, 2 N) with rows
+# $latex y = [ s , c ]$$ as above.
+#
+# $head Step Selection$$
+# $codei%%num_step%, %error% = choose_num_step(%age%, %all_cause%, %X%, %tolerance%)%$$
+# picks the number of steps for each interval by step doubling,
+# starting from one step and doubling (up to $icode max_step$$) until
+# the change in $latex [ S , C ]$$ over the interval, relative to
+# $latex S + C$$, is at most $icode tolerance$$ for every row of
+# $icode X$$.  The result $icode error$$ is that relative change for
+# the chosen number of steps, which estimates the error in each
+# interval.  Since the rates are fixed when $icode X$$ is chosen,
+# the tolerance only holds for rates near those in $icode X$$.
+#
 # $children%
 #	dismod_ode_test.py
 # %$$
@@ -104,8 +130,6 @@
 import numpy
 import pycppad
 
-N = 0
-
 # copied from http://www.seanet.com/~bradbell/pycppad/runge_kutta_4.xml
 def runge_kutta_4(f, ti, yi, dt) :
 	k1 = dt * f(ti         , yi)
@@ -117,56 +141,135 @@ def runge_kutta_4(f, ti, yi, dt) :
 
 #
 
-def ode_fun(a, susceptible_condition) :
-	global age, incidence, remission, excess, all_cause
-	s      = susceptible_condition[0]
-	c      = susceptible_condition[1]
-	i      = incidence[a]
-	r      = remission[a]
-	e      = excess[a]
-	m      = all_cause[a];
-	other  = m - e * s / (s + c)
-	ds_da  = - (i + other) * s +              r  * c
-	dc_da  = +           i * s - (r + other + e) * c
-	return numpy.array( [ ds_da , dc_da ] )
+class TapedODE :
+	"""
+	Pycppad function object for the Dismod ODE, which owns all of the
+	state used while taping, so that several can be built and
+	evaluated side by side; fun.forward(0, x) returns y as above.
+	"""
+	def __init__(self, num_step, age, all_cause) :
+		self.num_step  = interval_steps(num_step, len(age))
+		self.age       = age
+		self.all_cause = all_cause
+		self.fun       = self.tape()
+
+	def ode_fun(self, j, susceptible_condition, incidence, remission, excess) :
+		s      = susceptible_condition[0]
+		c      = susceptible_condition[1]
+		i      = incidence[j]
+		r      = remission[j]
+		e      = excess[j]
+		m      = self.all_cause[j];
+		other  = m - e * s / (s + c)
+		ds_da  = - (i + other) * s +              r  * c
+		dc_da  = +           i * s - (r + other + e) * c
+		return numpy.array( [ ds_da , dc_da ] )
+
+	def integrate(self, incidence, remission, excess, s0, c0) :
+		age            = self.age
+		N              = len( self.all_cause )
+		susceptible    = pycppad.ad( numpy.zeros(N) )
+		condition      = pycppad.ad( numpy.zeros(N) )
+		susceptible[0] = s0
+		condition[0]   = c0
+		sc             = numpy.array( [s0, c0] )
+		f              = lambda j, sc : self.ode_fun(j, sc, incidence, remission, excess)
+		for j in range(N-1) :
+			sc     = integrate_interval(f, j, age, sc, self.num_step[j])
+			susceptible[j+1] = sc[0]
+			condition[j+1]   = sc[1]
+		return susceptible, condition
+
+	def tape(self) :
+		N            = len( self.age )
+		x            = numpy.hstack( (numpy.zeros(3*N), 0., 0.) )
+		x            = pycppad.independent( x )
+		incidence    = x[(0*N):(1*N)]
+		remission    = x[(1*N):(2*N)]
+		excess       = x[(2*N):(3*N)]
+		s0           = x[3*N]
+		c0           = x[3*N+1]
+		susceptible, condition = self.integrate(incidence, remission, excess, s0, c0)
+		y            = numpy.hstack( (susceptible, condition) )
+		return pycppad.adfun(x, y)
+
+	def forward(self, p, x) :
+		return self.fun.forward(p, x)
 
-def ode_integrate(N, num_step, s0, c0) :
-	global age, incidence, remission, excess, all_cause
-	global susceptible, condition
-	susceptible[0] = s0
-	condition[0]   = c0
-	sc             = numpy.array( [s0, c0] )
-	N              = len( all_cause )
+	# w^T times the jacobian at the x of the last forward call
+	def reverse(self, p, w) :
+		return self.fun.reverse(p, w)
+
+def interval_steps(num_step, N) :
+	return numpy.ones(N-1, dtype=int) * numpy.array(num_step, dtype=int)
+
+def ode_function(num_step, age_local, all_local) :
+	return TapedODE(num_step, age_local, all_local).fun
+
+# Right hand side of the ODE for every row of x at once
+def batch_ode(N, all_cause, x) :
+	inc        = x[:, (0*N):(1*N)].T
+	rem        = x[:, (1*N):(2*N)].T
+	exc        = x[:, (2*N):(3*N)].T
+	def batch_fun(j, sc) :
+		s      = sc[0]
+		c      = sc[1]
+		other  = all_cause[j] - exc[j] * s / (s + c)
+		ds_da  = - (inc[j] + other) * s +                 rem[j]  * c
+		dc_da  = +         inc[j] * s - (rem[j] + other + exc[j]) * c
+		return numpy.array( [ ds_da , dc_da ] )
+	return batch_fun
+
+# Runge-Kutta steps across the j-th age interval, where f(j, sc) uses
+# the rates at the start of the interval
+def integrate_interval(f, j, age, sc, num_step) :
+	f_j    = lambda a, sc : f(j, sc)
+	a_step = (age[j+1] - age[j]) / num_step
+	a_tmp  = age[j]
+	for step in range(num_step) :
+		sc    = runge_kutta_4(f_j, a_tmp, sc, a_step)
+		a_tmp = a_tmp + a_step
+	return sc
+
+# Evaluate the same Runge-Kutta steps as the tape, in numpy, for many
+# x vectors at once.  x is a (draws x 3N+2) array, one row per draw,
+# and the result is a (draws x 2N) array; the loop over ages is
+# outermost and the draws are vectorized.
+def forward_batch(num_step, age, all_cause, x) :
+	x          = numpy.atleast_2d( numpy.array(x, dtype=float) )
+	N          = len( age )
+	num_step   = interval_steps(num_step, N)
+	batch_fun  = batch_ode(N, all_cause, x)
+	sc         = numpy.array( [ x[:, 3*N], x[:, 3*N+1] ] )
+	susceptible = numpy.zeros( (N, len(x)) )
+	condition   = numpy.zeros( (N, len(x)) )
+	susceptible[0] = sc[0]
+	condition[0]   = sc[1]
 	for j in range(N-1) :
-		a_step = (age[j+1] - age[j]) / num_step
-		a_tmp  = age[j]
-		for step in range(num_step) :
-			sc    = runge_kutta_4(ode_fun, a_tmp, sc, a_step)
-			a_tmp = a_tmp + a_step
+		sc    = integrate_interval(batch_fun, j, age, sc, num_step[j])
 		susceptible[j+1] = sc[0]
 		condition[j+1]   = sc[1]
+	return numpy.hstack( (susceptible.T, condition.T) )
 
-def ode_function(num_step, age_local, all_local) :
-	global age, incidence, remission, excess, all_cause
-	global susceptible, condition
-	N            = len( age_local )
-	age          = age_local
-	all_cause    = all_local
-	susceptible  = pycppad.ad( numpy.zeros(N) )
-	condition    = pycppad.ad( numpy.zeros(N) )
-	incidence    = .00 * numpy.ones(N)
-	remission    = .00 * numpy.ones(N)
-	excess       = .00 * numpy.ones(N)
-	s0           = 0.
-	c0           = 0.
-	x            = numpy.hstack( (incidence, remission, excess, s0, c0) )
-	x            = pycppad.independent( x )
-	incidence    = x[(0*N):(1*N)]
-	remission    = x[(1*N):(2*N)]
-	excess       = x[(2*N):(3*N)]
-	s0           = x[3*N]
-	c0           = x[3*N+1]
-	ode_integrate(N, num_step, s0, c0)
-	y            = numpy.hstack( (susceptible, condition) )
-	fun          = pycppad.adfun(x, y)
-	return fun
+def choose_num_step(age, all_cause, x, tolerance, max_step=1024) :
+	x          = numpy.atleast_2d( numpy.array(x, dtype=float) )
+	N          = len( age )
+	batch_fun  = batch_ode(N, all_cause, x)
+	sc         = numpy.array( [ x[:, 3*N], x[:, 3*N+1] ] )
+	num_step   = numpy.ones(N-1, dtype=int)
+	error      = numpy.zeros(N-1)
+	for j in range(N-1) :
+		n      = 1
+		sc_n   = integrate_interval(batch_fun, j, age, sc, n)
+		while True :
+			sc_2n = integrate_interval(batch_fun, j, age, sc, 2*n)
+			err   = ( numpy.abs(sc_n - sc_2n) / (sc_2n[0] + sc_2n[1]) ).max()
+			if err <= tolerance or n >= max_step :
+				break
+			n     = 2*n
+			sc_n  = sc_2n
+		num_step[j] = n
+		error[j]    = err
+		# continue from the solution the tape will compute
+		sc     = sc_n
+	return num_step, error
@@ -3,6 +3,7 @@
 import pylab as pl
 import pymc as mc
 
+import data
 import similarity_prior_model
 
 def level_constraints(name, parameters, unconstrained_mu_age, ages):
@@ -35,6 +36,15 @@ def level_constraints(name, parameters, unconstrained_mu_age, ages):
         if age_after < len(mu_age)-1:
             mu_age[(age_after+1):] = value
         return mu_age.clip(lower, upper)
+
+    # pymc does not keep the parent called value, as it is the name of the value of a node
+    def mu_age_vjp(adj, unconstrained_mu_age, age_before, age_after, lower, upper, value=None):
+        free = (unconstrained_mu_age >= lower) & (unconstrained_mu_age <= upper)
+        free[:age_before] = False
+        if age_after < len(free)-1:
+            free[(age_after+1):] = False
+        return dict(unconstrained_mu_age=adj*free)
+    mu_age.vjp = mu_age_vjp
     mu_sim = similarity_prior_model.similar('value_constrained_mu_age_%s'%name, mu_age, unconstrained_mu_age, 0., .01, 1.e-6)
 
     return dict(mu_age=mu_age, unconstrained_mu_age=unconstrained_mu_age, mu_sim=mu_sim)
@@ -75,9 +85,9 @@ def covariate_level_constraints(name, model, vars, ages):
     sex_index = index_map['x_sex']
     
     U_all = []
-    nodes = ['all']
+    index = data.hierarchy_index(model.hierarchy)
     for l in range(1,4):
-        nodes = [n for n in pl.flatten([model.hierarchy.successors(n) for n in nodes])]
+        nodes = index.nodes_at_level(l)
         U_i = pl.array([col in nodes for col in vars['U'].columns])
         if U_i.sum() > 0:
             U_all.append(U_i)
@@ -110,6 +120,41 @@ def covariate_level_constraints(name, model, vars, ages):
         lower_violation = min(0., log_mu_min - lower)
         upper_violation = max(0., log_mu_max - upper)
         return mc.normal_like([lower_violation, upper_violation], 0., 1.e-6**-2)
+
+    def covariate_constraint_grad(mu, alpha, beta, U_all, X_sex_max, X_sex_min, lower, upper):
+        log_mu_max = pl.log(mu.max())
+        log_mu_min = pl.log(mu.min())
+
+        alpha = pl.array([float(x) for x in alpha])
+        if len(alpha) > 0:
+            for U_i in U_all:
+                log_mu_max += max(0, alpha[U_i].max())
+                log_mu_min += min(0, alpha[U_i].min())
+
+        log_mu_max += X_sex_max*float(beta[sex_index])
+        log_mu_min += X_sex_min*float(beta[sex_index])
+
+        # derivatives with respect to log_mu_max and log_mu_min
+        d_max = -1.e12 * max(0., log_mu_max - upper)
+        d_min = -1.e12 * min(0., log_mu_min - lower)
+
+        d_mu = pl.zeros(len(mu))
+        d_mu[mu.argmax()] += d_max / mu.max()
+        d_mu[mu.argmin()] += d_min / mu.min()
+
+        d_alpha = pl.zeros(len(alpha))
+        if len(alpha) > 0:
+            for U_i in U_all:
+                j = pl.where(U_i)[0]
+                if alpha[j].max() > 0:
+                    d_alpha[j[alpha[j].argmax()]] += d_max
+                if alpha[j].min() < 0:
+                    d_alpha[j[alpha[j].argmin()]] += d_min
+
+        d_beta = pl.zeros(len(beta))
+        d_beta[sex_index] = X_sex_max*d_max + X_sex_min*d_min
+        return dict(mu=d_mu, alpha=d_alpha, beta=d_beta)
+    covariate_constraint.logp_grad = covariate_constraint_grad
     
     return dict(covariate_constraint=covariate_constraint)
 
@@ -144,5 +189,17 @@ def derivative_constraints(name, parameters, mu_age, ages):
         dec_violation = mu_prime[decreasing_a0:decreasing_a1].clip(0., pl.inf).sum()
         return -1.e12 * (inc_violation**2 + dec_violation**2)
 
+    def mu_age_derivative_potential_grad(mu_age, increasing_a0, increasing_a1, decreasing_a0, decreasing_a1):
+        mu_prime = pl.diff(mu_age)
+        inc = mu_prime[increasing_a0:increasing_a1].clip(-pl.inf, 0.)
+        dec = mu_prime[decreasing_a0:decreasing_a1].clip(0., pl.inf)
+
+        # derivative with respect to mu_prime, then to mu_age
+        d_prime = pl.zeros(len(mu_prime))
+        d_prime[increasing_a0:increasing_a1] += -2.e12 * inc.sum() * (inc < 0)
+        d_prime[decreasing_a0:decreasing_a1] += -2.e12 * dec.sum() * (dec > 0)
+        return dict(mu_age=pl.hstack((0., d_prime)) - pl.hstack((d_prime, 0.)))
+    mu_age_derivative_potential.logp_grad = mu_age_derivative_potential_grad
+
     return dict(mu_age_derivative_potential=mu_age_derivative_potential)
 
@@ -8,10 +8,11 @@ import dismod3
 
 import fit_model
 reload(fit_model)
+import npy_trace
 
 import sys
 
-def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, verbose=False):
+def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, verbose=False, map_method='fmin_powell', init='sequential', hessian_cov=False, chains=1, ess=None, auto_burn=False, trace_dir=None, checkpoint=None, resume=False):
     """ Fit data model for one epidemiologic parameter using MCMC
     
     :Parameters:
@@ -22,6 +23,15 @@ def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, v
       - `thin` : int, samples thinned by this number
       - `tune_interval` : int
       - `verbose` : boolean
+      - `map_method` : str, optional. The optimizer for the initial values and MAP, 'fmin_powell' or 'fmin_l_bfgs_b', see fit_model.map_fit
+      - `init` : str, optional. 'sequential' to fit the knots and effects with a sequence of MAP fits, or 'wls' to set them in a single weighted least squares pass, see fit_model.find_wls_initial_vals
+      - `hessian_cov` : boolean, optional. Start each AdaptiveMetropolis step method from the covariance of the Hessian at the MAP, see fit_model.hessian_cov
+      - `chains` : int, optional. The number of chains to run in parallel from dispersed starting points, each of `iter` samples, see fit_model.sample_chains
+      - `ess` : int, optional. Sample in chunks until the effective sample size of each stoch reaches `ess`, with `iter` as the largest number of iterations, see fit_model.sample_to_ess
+      - `auto_burn` : boolean, optional. End the burn-in as soon as the deviance is stationary, with `burn` as the longest burn-in, see fit_model.find_burn_in
+      - `trace_dir` : str, optional. Store the traces in .npy files in this directory, instead of in memory, see npy_trace
+      - `checkpoint` : int, optional. Save the state of the sampler in `trace_dir` every `checkpoint` iterations
+      - `resume` : boolean, optional. Continue the run checkpointed in `trace_dir`, if there is one, see fit_model.resume_sampling
 
     :Results:
       - returns a pymc.MCMC object created from vars, that has been fit with MCMC
@@ -29,37 +39,68 @@ def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, v
     .. note::
       - `burn` must be less than `iter`
       - `thin` must be less than `iter` minus `burn`
+      - with more than one chain, the traces of the nodes hold the
+        samples of all chains, and the split R-hat and effective sample
+        size of each node are in m.rhat and m.ess
+      - with `ess`, m.iter is the number of iterations run, and
+        m.ess_met is False if the target was not reached
+      - `ess` runs a single chain, so it cannot be combined with `chains`
+      - with `auto_burn`, m.burn is the burn-in found, m.burn_detected
+        is False if it reached `burn`, and the number of samples saved
+        is the same as without it
+      - with `trace_dir`, the traces are read back through memory maps;
+        the merged traces of `chains` and `ess` are held in memory
+      - `checkpoint` and `resume` need `trace_dir`, and a single chain
+        without `ess`; a resumed run skips the initial values and MAP,
+        so model.map is not fit
+      - the posterior-predictive p_pred of each data type is drawn from
+        the traces after sampling if the model vars were built with
+        lazy_pred, see ism.age_specific_rate and the lazy_pred option
+        of fit_posterior, fit_world and fit_emp_prior
 
     """
     assert burn < iter, 'burn must be less than iter'
     assert thin < iter - burn, 'thin must be less than iter-burn'
+    assert ess is None or chains == 1, 'ess cannot be combined with chains'
+    assert trace_dir or not (checkpoint or resume), 'checkpoint and resume need trace_dir'
 
     vars = model.vars[data_type]
     
     start_time = time.time()
     map = mc.MAP(vars)
-    m = mc.MCMC(vars)
+    m = resume and fit_model.load_checkpoint(vars, trace_dir)
+    if m:
+        fit_model.logger.info('resuming from checkpoint\n')
+        fit_model.setup_asr_step_methods(m, vars)
+        fit_model.resume_sampling(m, tune_interval, verbose, checkpoint)
+        m.wall_time = time.time() - start_time
+
+        model.map = map
+        model.mcmc = m
+
+        return model.map, model.mcmc
+    elif trace_dir:
+        m = mc.MCMC(vars, db=npy_trace, dbname=trace_dir)
+    else:
+        m = mc.MCMC(vars)
 
     ## use MAP to generate good initial conditions
     try:
-        method='fmin_powell'
+        method=map_method
         tol=.001
 
         fit_model.logger.info('finding initial values')
-        fit_model.find_asr_initial_vals(vars, method, tol, verbose)
+        fit_model.find_asr_initial_vals(vars, method, tol, verbose, init)
 
         fit_model.logger.info('\nfinding MAP estimate')
-        map.fit(method=method, tol=tol, verbose=verbose)
+        fit_model.map_fit(map, method, tol, verbose)
         
         if verbose:
             fit_model.print_mare(vars)
-        fit_model.logger.info('\nfinding step covariances estimate')
-        fit_model.setup_asr_step_methods(m, vars)
-
-        fit_model.logger.info('\nresetting initial values (1)')
-        fit_model.find_asr_initial_vals(vars, method, tol, verbose)
-        fit_model.logger.info('\nresetting initial values (2)\n')
-        map.fit(method=method, tol=tol, verbose=verbose)
+        # the step methods are set up at the MAP and do not move the
+        # values, so the MAP fit does not need to be repeated
+        fit_model.logger.info('\nfinding step covariances estimate\n')
+        fit_model.setup_asr_step_methods(m, vars, hessian=hessian_cov)
     except KeyboardInterrupt:
         fit_model.logger.warning('Initial condition calculation interrupted')
 
@@ -67,16 +108,7 @@ def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, v
     fit_model.print_mare(vars)
 
     fit_model.logger.info('sampling from posterior\n')
-    m.iter=iter
-    m.burn=burn
-    m.thin=thin
-    if verbose:
-        try:
-            m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=True, progress_bar_fd=sys.stdout)
-        except TypeError:
-            m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False, verbose=verbose)
-    else:
-        m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False)
+    fit_model.sample_posterior(m, iter, burn, thin, tune_interval, verbose, chains, ess, auto_burn, checkpoint)
 
     m.wall_time = time.time() - start_time
     
@@ -86,7 +118,7 @@ def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, v
     return model.map, model.mcmc
 
 # TODO: move fit_model.fit_consistent_model to fit.fit_consistent
-def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbose=False):
+def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbose=False, map_method='fmin_powell', init='sequential', hessian_cov=False, chains=1, ess=None, auto_burn=False, trace_dir=None, checkpoint=None, resume=False):
     """Fit data model for all epidemiologic parameters using MCMC
     
     :Parameters:
@@ -96,6 +128,15 @@ def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbo
       - `thin` : int, samples thinned by this number
       - `tune_interval` : int
       - `verbose` : boolean
+      - `map_method` : str, optional. The optimizer for the initial values and MAP, 'fmin_powell' or 'fmin_l_bfgs_b', see fit_model.map_fit
+      - `init` : str, optional. 'sequential' to fit the knots and effects with a sequence of MAP fits, or 'wls' to set them in a single weighted least squares pass, see fit_model.find_wls_initial_vals
+      - `hessian_cov` : boolean, optional. Start each AdaptiveMetropolis step method from the covariance of the Hessian at the MAP, see fit_model.hessian_cov
+      - `chains` : int, optional. The number of chains to run in parallel from dispersed starting points, each of `iter` samples, see fit_model.sample_chains
+      - `ess` : int, optional. Sample in chunks until the effective sample size of each stoch reaches `ess`, with `iter` as the largest number of iterations, see fit_model.sample_to_ess
+      - `auto_burn` : boolean, optional. End the burn-in as soon as the deviance is stationary, with `burn` as the longest burn-in, see fit_model.find_burn_in
+      - `trace_dir` : str, optional. Store the traces in .npy files in this directory, instead of in memory, see npy_trace
+      - `checkpoint` : int, optional. Save the state of the sampler in `trace_dir` every `checkpoint` iterations
+      - `resume` : boolean, optional. Continue the run checkpointed in `trace_dir`, if there is one, see fit_model.resume_sampling
 
     :Results:
       - returns a pymc.MCMC object created from vars, that has been fit with MCMC
@@ -103,10 +144,30 @@ def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbo
     .. note::
       - `burn` must be less than `iter`
       - `thin` must be less than `iter` minus `burn`
+      - with more than one chain, the traces of the nodes hold the
+        samples of all chains, and the split R-hat and effective sample
+        size of each node are in m.rhat and m.ess
+      - with `ess`, m.iter is the number of iterations run, and
+        m.ess_met is False if the target was not reached
+      - `ess` runs a single chain, so it cannot be combined with `chains`
+      - with `auto_burn`, m.burn is the burn-in found, m.burn_detected
+        is False if it reached `burn`, and the number of samples saved
+        is the same as without it
+      - with `trace_dir`, the traces are read back through memory maps;
+        the merged traces of `chains` and `ess` are held in memory
+      - `checkpoint` and `resume` need `trace_dir`, and a single chain
+        without `ess`; a resumed run skips the initial values and MAP,
+        so model.map is not fit
+      - the posterior-predictive p_pred of each data type is drawn from
+        the traces after sampling if the model vars were built with
+        lazy_pred, see ism.age_specific_rate and the lazy_pred option
+        of fit_posterior, fit_world and fit_emp_prior
 
     """
     assert burn < iter, 'burn must be less than iter'
     assert thin < iter - burn, 'thin must be less than iter-burn'
+    assert ess is None or chains == 1, 'ess cannot be combined with chains'
+    assert trace_dir or not (checkpoint or resume), 'checkpoint and resume need trace_dir'
 
     param_types = 'i r f p pf rr smr m_with X'.split()
 
@@ -114,36 +175,66 @@ def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbo
     
     start_time = time.time()
     map = mc.MAP(vars)
-    m = mc.MCMC(vars)
+    m = resume and fit_model.load_checkpoint(vars, trace_dir)
+    if m:
+        fit_model.logger.info('resuming from checkpoint\n')
+        # with vectorized splines, gamma is one stoch for each type, so
+        # this is a single block of all the knots, as when sampling began
+        max_knots = max([len(vars[t]['gamma']) for t in 'irf'])
+        for i in range(max_knots):
+            # the adaptive covariances are restored from the checkpoint
+            stoch = [vars[t]['gamma'][i] for t in 'ifr' if i < len(vars[t]['gamma'])]
+            m.use_step_method(mc.AdaptiveMetropolis, stoch)
+        for t in param_types:
+            fit_model.setup_asr_step_methods(m, vars[t])
+        fit_model.resume_sampling(m, tune_interval, verbose, checkpoint)
+        m.wall_time = time.time() - start_time
+
+        model.map = map
+        model.mcmc = m
+
+        return model.map, model.mcmc
+    elif trace_dir:
+        m = mc.MCMC(vars, db=npy_trace, dbname=trace_dir)
+    else:
+        m = mc.MCMC(vars)
 
     ## use MAP to generate good initial conditions
     try:
-        method='fmin_powell'
+        method=map_method
         tol=.001
 
         fit_model.logger.info('fitting submodels')
-        fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
-
-        for t in param_types:
-            fit_model.find_re_initial_vals(vars[t], method, tol, verbose)
-            fit_model.logger.info('.')
+        if init == 'wls':
+            # i, r and f come first in param_types, so the
+            # compartmental rates are set from their own data before
+            # the effects of the rates derived from them
+            for t in param_types:
+                fit_model.find_wls_initial_vals(vars[t], verbose)
+                fit_model.logger.info('.')
+        else:
+            fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
 
-        fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
-        fit_model.logger.info('.')
+            for t in param_types:
+                fit_model.find_re_initial_vals(vars[t], method, tol, verbose)
+                fit_model.logger.info('.')
 
-        for t in param_types:
-            fit_model.find_fe_initial_vals(vars[t], method, tol, verbose)
+            fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
             fit_model.logger.info('.')
 
-        fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
-        fit_model.logger.info('.')
+            for t in param_types:
+                fit_model.find_fe_initial_vals(vars[t], method, tol, verbose)
+                fit_model.logger.info('.')
 
-        for t in param_types:
-            fit_model.find_dispersion_initial_vals(vars[t], method, tol, verbose)
+            fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
             fit_model.logger.info('.')
 
+            for t in param_types:
+                fit_model.find_dispersion_initial_vals(vars[t], method, tol, verbose)
+                fit_model.logger.info('.')
+
         fit_model.logger.info('\nfitting all stochs\n')
-        map.fit(method=method, tol=tol, verbose=verbose)
+        fit_model.map_fit(map, method, tol, verbose)
 
         if verbose:
             from fit_posterior import inspect_vars
@@ -156,8 +247,17 @@ def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbo
 
     try:
         fit_model.logger.info('finding step covariances')
+
+        # the normal approximations refit the knots, so keep the MAP
+        # values to start from, instead of fitting the MAP again
+        index = fit_model.map_index(map)
+        map_values = pl.hstack([pl.ravel(s.value) for s, i in index])
+
         vars_to_fit = [[vars[t].get('p_obs'), vars[t].get('pi_sim'), vars[t].get('smooth_gamma'), vars[t].get('parent_similarity'),
                         vars[t].get('mu_sim'), vars[t].get('mu_age_derivative_potential'), vars[t].get('covariate_constraint')] for t in param_types]
+        # one block for each knot, with the knot of i, f and r; with
+        # vectorized splines, gamma is one stoch for each type, so
+        # there is a single block of all the knots of the three types
         max_knots = max([len(vars[t]['gamma']) for t in 'irf'])
         for i in range(max_knots):
             stoch = [vars[t]['gamma'][i] for t in 'ifr' if i < len(vars[t]['gamma'])]
@@ -165,9 +265,14 @@ def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbo
             if verbose:
                 print 'finding Normal Approx for', [n.__name__ for n in stoch]
             try:
-                na = mc.NormApprox(vars_to_fit + stoch)
-                na.fit(method='fmin_powell', verbose=verbose)
-                cov = pl.array(pl.inv(-na.hess), order='F')
+                if hessian_cov:
+                    cov = fit_model.hessian_cov(stoch)
+                    if cov is None:
+                        raise ValueError
+                else:
+                    na = mc.NormApprox(vars_to_fit + stoch)
+                    na.fit(method='fmin_powell', verbose=verbose)
+                    cov = pl.array(pl.inv(-na.hess), order='F')
                 if pl.all(pl.eigvals(cov) >= 0):
                     m.use_step_method(mc.AdaptiveMetropolis, stoch, cov=cov)
                 else:
@@ -180,27 +285,16 @@ def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbo
             fit_model.logger.info('.')
 
         for t in param_types:
-            fit_model.setup_asr_step_methods(m, vars[t], vars_to_fit)
-
-            # reset values to MAP
-            fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
+            fit_model.setup_asr_step_methods(m, vars[t], hessian=hessian_cov)
             fit_model.logger.info('.')
-        map.fit(method=method, tol=tol, verbose=verbose)
-        fit_model.logger.info('.')
+
+        # reset values to MAP
+        fit_model.set_map_values(index, map_values)
     except KeyboardInterrupt:
         fit_model.logger.warning('Initial condition calculation interrupted')
 
     fit_model.logger.info('\nsampling from posterior distribution\n')
-    m.iter=iter
-    m.burn=burn
-    m.thin=thin
-    if verbose:
-        try:
-            m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=True, progress_bar_fd=sys.stdout)
-        except TypeError:
-            m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False, verbose=verbose)
-    else:
-        m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False)
+    fit_model.sample_posterior(m, iter, burn, thin, tune_interval, verbose, chains, ess, auto_burn, checkpoint)
     m.wall_time = time.time() - start_time
 
     model.map = map
@@ -26,7 +26,7 @@ reload(fit_model)
 reload(graphics)
 
 def fit_emp_prior(id, param_type, fast_fit=False, generate_emp_priors=True,
-                  zero_re=True, alt_prior=False, global_heterogeneity='Slightly'):
+                  zero_re=True, alt_prior=False, global_heterogeneity='Slightly', lazy_pred=False, auto_burn=False):
     """ Fit empirical prior of specified type for specified model
 
     Parameters
@@ -35,6 +35,10 @@ def fit_emp_prior(id, param_type, fast_fit=False, generate_emp_priors=True,
       The model id number for the job to fit
     param_type : str, one of incidence, prevalence, remission, excess-mortality, prevalence_x_excess-mortality
       The disease parameter to generate empirical priors for
+    lazy_pred : bool, optional
+      Draw p_pred from the traces after sampling, instead of at every iteration
+    auto_burn : bool, optional
+      End the burn-in when the deviance is stationary, with 10000 as the longest burn-in, and save the burn-in found with the priors
 
     Example
     -------
@@ -115,7 +119,7 @@ def fit_emp_prior(id, param_type, fast_fit=False, generate_emp_priors=True,
                                  reference_area='all', reference_sex='total', reference_year='all',
                                  mu_age=None, mu_age_parent=None, sigma_age_parent=None,
                                  rate_type=(t == 'rr') and 'log_normal' or 'neg_binom',
-                                 zero_re=zero_re)
+                                 zero_re=zero_re, lazy_pred=lazy_pred)
     # for backwards compatibility, should be removed eventually
     dm.model = model
     dm.vars = model.vars[t]
@@ -124,7 +128,8 @@ def fit_emp_prior(id, param_type, fast_fit=False, generate_emp_priors=True,
     if fast_fit:
         dm.map, dm.mcmc = dismod3.fit.fit_asr(model, t, iter=101, burn=0, thin=1, tune_interval=100)
     else:
-        dm.map, dm.mcmc = dismod3.fit.fit_asr(model, t, iter=50000, burn=10000, thin=40, tune_interval=1000, verbose=True)
+        dm.map, dm.mcmc = dismod3.fit.fit_asr(model, t, iter=50000, burn=10000, thin=40, tune_interval=1000, verbose=True,
+                                              auto_burn=auto_burn)
 
     stats = dm.vars['p_pred'].stats(batches=5)
     dm.vars['data']['mu_pred'] = stats['mean']
@@ -248,12 +253,10 @@ def store_effect_coefficients(dm, vars, param_type):
 
     prior_vals['new_alpha'] = {}
     if 'alpha' in vars:
-        for n, col in zip(vars['alpha'], vars['U'].columns):
-            if isinstance(n, mc.Node):
-                stats = n.stats()
-                if stats:
-                    #prior_vals['new_alpha'][col] = dict(dist='TruncatedNormal', mu=stats['mean'], sigma=stats['standard deviation'], lower=-5., upper=5.)
-                    prior_vals['new_alpha'][col] = dict(dist='Constant', mu=stats['mean'], sigma=stats['standard deviation'])
+        for (stats, value), col in zip(covariate_model.alpha_stats(vars), vars['U'].columns):
+            if stats:
+                #prior_vals['new_alpha'][col] = dict(dist='TruncatedNormal', mu=stats['mean'], sigma=stats['standard deviation'], lower=-5., upper=5.)
+                prior_vals['new_alpha'][col] = dict(dist='Constant', mu=stats['mean'], sigma=stats['standard deviation'])
 
         # uncomment below to save empirical prior on sigma_alpha, the dispersion of the random effects
         for n in vars['sigma_alpha']:
@@ -298,6 +301,8 @@ def store_effect_coefficients(dm, vars, param_type):
     except:
         print 'Saving DIC failed'
 
+    prior_vals['burn'] = dm.mcmc.burn
+
     try:
         prior_vals['converged'] = dismod3.data.check_convergence({'_': dm.vars})
     except:
@@ -322,6 +327,10 @@ def main():
                       help='use population weighted aggregation for empirical prior')
     parser.add_option('-g', '--globalheterogeneity', default='Slightly',
                       help='negative binomial heterogeneity for global estimate')
+    parser.add_option('-l', '--lazypred', default='false',
+                      help='generate posterior-predictive draws from the traces after sampling')
+    parser.add_option('--autoburn', default='false',
+                      help='end the burn-in when the deviance is stationary')
 
     (options, args) = parser.parse_args()
 
@@ -338,7 +347,9 @@ def main():
                        generate_emp_priors=True,
                        zero_re=options.zerore.lower() == 'true',
                        alt_prior=options.altprior.lower() == 'true',
-                       global_heterogeneity=options.globalheterogeneity)
+                       global_heterogeneity=options.globalheterogeneity,
+                       lazy_pred=options.lazypred.lower() == 'true',
+                       auto_burn=options.autoburn.lower() == 'true')
 
     
     return dm
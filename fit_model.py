@@ -1,12 +1,23 @@
 """ Routines for fitting disease models"""
+import os
 import sys
 import time
+import multiprocessing
 
+import numpy as np
 import pylab as pl
 import pymc as mc
 import pandas
 import networkx as nx
 
+import data
+import rate_model
+import age_pattern
+import array_trace
+import diagnostics
+import npy_trace
+import logp_gradient
+
 ## set number of threads to avoid overburdening cluster computers
 try:
     import mkl
@@ -29,6 +40,119 @@ logger = Log()
 
 param_types = 'i r f p pf rr smr m_with X'.split()
 
+def stoch_bounds(s):
+    """ Bounds on each entry of the value of a stoch, from its lower
+    and upper (or a and b) parents
+
+    :Parameters:
+      - `s` : mc.Stochastic
+
+    :Results:
+      - Returns arrays lower and upper, with the size of the value of s,
+        which are -inf and inf if s is unbounded
+    """
+    n = pl.size(s.value)
+    for lower, upper in [['lower', 'upper'], ['a', 'b']]:
+        if lower in s.parents and upper in s.parents:
+            return (pl.ones(n) * mc.utils.value(s.parents[lower]),
+                    pl.ones(n) * mc.utils.value(s.parents[upper]))
+    return -pl.inf*pl.ones(n), pl.inf*pl.ones(n)
+
+def map_index(map):
+    """ Position of the value of each stoch of a MAP object in its
+    parameter vector, in the order of map.stochastics, which is also
+    the order of mc.MAP.fit
+
+    :Parameters:
+      - `map` : mc.MAP
+
+    :Results:
+      - Returns list of (stoch, slice) pairs
+    """
+    index = []
+    n = 0
+    for s in map.stochastics:
+        index.append((s, slice(n, n + pl.size(s.value))))
+        n += pl.size(s.value)
+    return index
+
+def set_map_values(index, x):
+    """ Set the values of the stochs of a MAP object from its
+    parameter vector x, with the index from map_index"""
+    for s, i in index:
+        if pl.ndim(s.value) == 0:
+            s.value = x[i][0]
+        else:
+            s.value = pl.reshape(x[i], pl.shape(s.value))
+
+def map_bounds(map):
+    """ Bounds on each entry of the MAP parameter vector, from the
+    lower and upper (or a and b) parents of bounded stochs
+
+    :Parameters:
+      - `map` : mc.MAP
+
+    :Results:
+      - Returns list of (lower, upper) pairs, with None for unbounded
+    """
+    bounds = []
+    for s, i in map_index(map):
+        for l, u in zip(*stoch_bounds(s)):
+            bounds.append((l if pl.isfinite(l) else None, u if pl.isfinite(u) else None))
+    return bounds
+
+def map_fit(map, method, tol, verbose):
+    """ Fit a MAP object with one of the scipy.optimize methods that
+    pymc provides
+
+    :Parameters:
+      - `map` : mc.MAP
+      - `method` : str, 'fmin_powell' or 'fmin_l_bfgs_b' (or any method of mc.MAP.fit)
+      - `tol` : float, ftol for Powell's method, or the tolerance on
+        the projected gradient for L-BFGS-B
+      - `verbose` : boolean
+
+    .. note::
+      - L-BFGS-B is given the bounds of uniform and truncated stochs,
+        so that its line search does not leave their support, and the
+        gradient of the log-posterior from logp_gradient, which sums
+        the analytic derivatives of the model nodes in one reverse
+        pass, with the pycppad tape for the ODE of the consistent model
+      - if a node that depends on the stochs has no gradient rule,
+        L-BFGS-B falls back to the finite difference gradient of pymc
+        over the Markov blanket of each stoch
+    """
+    if method != 'fmin_l_bfgs_b':
+        map.fit(method=method, tol=tol, verbose=verbose)
+        return
+
+    index = map_index(map)
+    grad = logp_gradient.LogpGradient([s for s, i in index], map.stochastics | map.potentials | map.observed_stochastics)
+    if grad.missing:
+        if verbose:
+            print 'no gradient rule for %s, using finite differences' % ', '.join(grad.missing)
+        map.fit(method=method, tol=tol, verbose=verbose, bounds=map_bounds(map))
+        return
+
+    def func(x):
+        set_map_values(index, x)
+        try:
+            logp = map.logp
+        except mc.ZeroProbability:
+            return pl.inf, pl.zeros(len(x))
+        return -logp, -pl.hstack([pl.ravel(g) for g in grad()])
+
+    import scipy.optimize
+    x0 = pl.hstack([pl.ravel(s.value) for s, i in index])
+    x, f, info = scipy.optimize.fmin_l_bfgs_b(func, x0, bounds=map_bounds(map), pgtol=tol, iprint=verbose-1)
+    set_map_values(index, x)
+
+    # the summaries that mc.MAP.fit leaves on map
+    map.logp_at_max = map.logp
+    map.lnL = sum([s.logp for s in map.observed_stochastics])
+    map.AIC = 2. * (map.len - map.lnL)
+    map.BIC = map.len * pl.log(map.data_len) - 2. * map.lnL
+
 def find_consistent_spline_initial_vals(vars, method, tol, verbose):
     ## generate initial value by fitting knots sequentially
     vars_to_fit = [vars['logit_C0']]
@@ -36,21 +160,245 @@ def find_consistent_spline_initial_vals(vars, method, tol, verbose):
         vars_to_fit += [vars[t].get('covariate_constraint'),
                         vars[t].get('mu_age_derivative_potential'), vars[t].get('mu_sim'),
                         vars[t].get('p_obs'), vars[t].get('parent_similarity'), vars[t].get('smooth_gamma'),]
+    # max_knots is 1 for vectorized splines, whose knots are one stoch
     max_knots = max([len(vars[t]['gamma']) for t in 'irf'])
     for i in [max_knots]: #range(1, max_knots+1):
         if verbose:
             print 'fitting first %d knots of %d' % (i, max_knots)
         vars_to_fit += [vars[t]['gamma'][:i] for t in 'irf']
-        mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+        map_fit(mc.MAP(vars_to_fit), method, tol, verbose)
 
         if verbose:
             from fit_posterior import inspect_vars
             print inspect_vars({}, vars)[-10:]
+            if 'ode_cache' in vars['p']:
+                print 'ode cache: %d hits, %d misses' % (vars['p']['ode_cache'].hits, vars['p']['ode_cache'].misses)
         else:
             logger.info('.')
 
 
-def find_asr_initial_vals(vars, method, tol, verbose):
+def free_coordinates(nodes):
+    """ List the (stoch, index) pairs for the entries of the values of
+    the stochs in nodes, skipping deterministics and constants"""
+    coords = []
+    for n in nodes:
+        if isinstance(n, mc.Stochastic):
+            coords += [(n, j) for j in range(pl.size(n.value))]
+    return coords
+
+def get_coordinates(coords):
+    return pl.array([pl.ravel(n.value)[j] for n, j in coords], dtype=float)
+
+def set_coordinates(coords, x):
+    for (n, j), x_j in zip(coords, x):
+        if pl.ndim(n.value) == 0:
+            n.value = x_j
+        else:
+            value = pl.array(n.value, dtype=float)
+            value.flat[j] = x_j
+            n.value = value
+
+def linear_effect_map(coords, effect_value):
+    """ Find T and c with effect_value() == T x + c, for the values x of
+    the free coordinates of an effect that is linear in them, such as
+    the random effects with sum-to-zero constraints
+
+    :Parameters:
+      - `coords` : list of (stoch, index) pairs, from free_coordinates
+      - `effect_value` : function returning the effect as an array
+
+    :Results:
+      - Returns T and c, and leaves the coordinates unchanged
+    """
+    x = get_coordinates(coords)
+    set_coordinates(coords, pl.zeros(len(coords)))
+    c = effect_value()
+    T = pl.zeros((len(c), len(coords)))
+    for k in range(len(coords)):
+        set_coordinates(coords[k:k+1], [1.])
+        T[:, k] = effect_value() - c
+        set_coordinates(coords[k:k+1], [0.])
+    set_coordinates(coords, x)
+    return T, c
+
+def find_wls_initial_vals(vars, verbose, iters=20):
+    """ Set initial values for the knots, random effects, fixed effects
+    and dispersion of an age-specific rate model in a single
+    weighted least squares pass on the log of the data
+
+    :Parameters:
+      - `vars` : dict of PyMC objects, from ism.age_specific_rate
+      - `verbose` : boolean
+      - `iters` : int, maximum number of Gauss-Newton steps in each
+        round of reweighting
+
+    .. note::
+      - the model log(pi) = log(W * B * exp(gamma)) + U alpha + X beta,
+        with W the age-integrating matrix and B the spline basis, is
+        fit by penalized Gauss-Newton to log(value), with weights from
+        the delta-method variance 1/(ess*value) + 1/delta
+      - the penalties are the priors on gamma, beta and alpha (with the
+        current sigma_alpha), and the smoothing prior on gamma, or a
+        weak one if there is none, so that knots without data follow
+        their neighbors
+      - when the model has no knots (e.g. prevalence in the consistent
+        model) mu_interval is held fixed and only the effects are fit
+      - eta is then set by moments of the negative binomial, and the
+        fit is reweighted once with the new dispersion
+      - rows with value or effective sample size that is not positive
+        are left out
+    """
+    input_data = vars.get('data')
+    if input_data is None or len(input_data) == 0 or 'mu_interval' not in vars:
+        return
+
+    value = pl.array(input_data['value'], dtype=float)
+    ess = pl.array(input_data['effective_sample_size'], dtype=float)
+    se = pl.array(input_data['standard_error'], dtype=float)
+    var_log = pl.where((ess > 0) & pl.isfinite(ess), 1. / (ess*value), (se/value)**2)
+    rows = (value > 0) & pl.isfinite(var_log) & (var_log > 0)
+
+    # mu_interval = M * exp(gamma), or fixed if there are no knots
+    g_coords = free_coordinates(vars.get('gamma', []))
+    if 'knots' in vars and len(g_coords) == len(vars['knots']):
+        B = vars.get('basis')
+        if B is None:
+            B = age_pattern.interpolation_basis(vars['knots'], vars['ages'])
+        M = pl.asarray(vars['W'] * B)[vars['W_index']]
+        rows &= M.sum(1) > 0
+    else:
+        g_coords = []
+        M = pl.zeros((len(value), 0))
+        rows &= vars['mu_interval'].value > 0
+    if rows.sum() == 0:
+        return
+
+    y = pl.log(value[rows])
+    offset = pl.zeros(len(value))
+    K = len(g_coords)
+    if K == 0:
+        offset += pl.log(pl.maximum(vars['mu_interval'].value, 1.e-300))
+
+    # random effects, U alpha = U T_a a + U c_a for the free coordinates a
+    Z = [pl.zeros((len(value), 0))]
+    P = [pl.zeros(0)]
+    prior_mean = [pl.zeros(0)]
+    a_coords, b_coords = [], []
+    P_a = pl.zeros((0, 0))
+    lin_a = pl.zeros(0)
+    if 'U' in vars and len(vars['U'].columns) > 0:
+        alpha = vars['alpha']
+        if isinstance(alpha, mc.Node):
+            a_coords = free_coordinates([vars.get('alpha_free')])
+            alpha_value = lambda: pl.array(alpha.value, dtype=float)
+        else:
+            a_coords = free_coordinates(alpha)
+            alpha_value = lambda: pl.array([mc.utils.value(a) for a in alpha], dtype=float)
+        T_a, c_a = linear_effect_map(a_coords, alpha_value)
+        U = pl.array(vars['U'].to_dense(), dtype=float)
+        Z.append(pl.dot(U, T_a))
+        offset += pl.dot(U, c_a)
+
+        index = data.hierarchy_index(vars['hierarchy'])
+        tau = pl.array([mc.utils.value(vars['sigma_alpha'][index.level(col)])**-2. for col in vars['U'].columns])
+        P_a = pl.dot(T_a.T * tau, T_a)
+        lin_a = -pl.dot(T_a.T, tau * c_a)
+
+    # fixed effects, X beta = X T_b b + X c_b
+    if 'X' in vars and len(vars['X'].columns) > 0:
+        beta = vars['beta']
+        b_coords = free_coordinates(beta)
+        T_b, c_b = linear_effect_map(b_coords, lambda: pl.array([mc.utils.value(b) for b in beta], dtype=float))
+        X = pl.array(vars['X'], dtype=float)
+        Z.append(pl.dot(X, T_b))
+        offset += pl.dot(X, c_b)
+        P.append(pl.array([mc.utils.value(n.parents.get('tau', 0.)) for n, j in b_coords], dtype=float))
+        prior_mean.append(pl.array([pl.ravel(mc.utils.value(n.parents.get('mu', 0.)))[0] for n, j in b_coords], dtype=float))
+
+    Z = pl.hstack(Z)[rows]
+    offset = offset[rows]
+    M = M[rows]
+    L = Z.shape[1]
+
+    # penalty theta' Q theta - 2 lin' theta, with theta = [gamma, a, b]
+    Q = pl.zeros((K+L, K+L))
+    lin = pl.zeros(K+L)
+    if K > 0:
+        smoothing = vars.get('smooth_gamma')
+        tau_smooth = 1.
+        if smoothing is not None:
+            tau_smooth = mc.utils.value(smoothing.parents['tau'])
+        D = pl.diff(pl.eye(K), axis=0) / pl.sqrt(pl.diff(vars['knots']))[:, None]
+        Q[:K, :K] = 10.**-2 * pl.eye(K) + tau_smooth * pl.dot(D.T, D)
+    n_a = len(a_coords)
+    Q[K:K+n_a, K:K+n_a] = P_a
+    lin[K:K+n_a] = lin_a
+    tau_b = pl.hstack(P)
+    Q[K+n_a:, K+n_a:] = pl.diag(tau_b)
+    lin[K+n_a:] = tau_b * pl.hstack(prior_mean)
+
+    def predict(theta):
+        log_pi = offset + pl.dot(Z, theta[K:])
+        if K > 0:
+            log_pi += pl.log(pl.dot(M, pl.exp(theta[:K])))
+        return log_pi
+
+    def objective(theta, w):
+        return pl.dot(w, (y - predict(theta))**2) + pl.dot(theta, pl.dot(Q, theta)) - 2*pl.dot(lin, theta)
+
+    theta = pl.zeros(K+L)
+    theta[:K] = pl.log(pl.dot(value[rows], 1./var_log[rows]) / pl.sum(1./var_log[rows]))
+    theta[K:] = get_coordinates(a_coords + b_coords)
+
+    eta = vars.get('eta')
+    for outer_reps in range(isinstance(eta, mc.Stochastic) and 2 or 1):
+        delta = pl.ones(len(value)) * vars['delta'].value if 'delta' in vars else pl.inf*pl.ones(len(value))
+        w = 1. / (var_log[rows] + 1. / delta[rows])
+
+        for i in range(iters):
+            if K + L == 0:
+                break
+            r = y - predict(theta)
+            J = Z
+            if K > 0:
+                e_gamma = pl.exp(theta[:K])
+                J = pl.hstack((M * e_gamma / pl.dot(M, e_gamma)[:, None], Z))
+            step = pl.solve(pl.dot(J.T * w, J) + Q, pl.dot(J.T, w * r) - pl.dot(Q, theta) + lin)
+
+            # halve the step until the penalized sum of squares decreases
+            f = objective(theta, w)
+            t = 1.
+            while objective(theta + t*step, w) > f and t > 1.e-3:
+                t /= 2.
+            theta += t*step
+            if pl.absolute(t*step).max() < 1.e-4:
+                break
+
+        gamma = theta[:K].clip(-12, 6)
+        set_coordinates(g_coords, gamma)
+        effects = theta[K:]
+        for k, (n, j) in enumerate(a_coords + b_coords):
+            lower, upper = stoch_bounds(n)
+            effects[k] = effects[k].clip(lower[j], upper[j])
+        set_coordinates(a_coords + b_coords, effects)
+
+        if isinstance(eta, mc.Stochastic):
+            # var(k) = n pi + (n pi)^2 / delta, solved for a common delta
+            n_pi = ess[rows] * pl.exp(predict(theta))
+            excess = ((value[rows]*ess[rows] - n_pi)**2 - n_pi).sum() / (n_pi**2).sum()
+            lower, upper = stoch_bounds(eta)
+            eta.value = (-pl.log(max(excess, 1.e-12))).clip(lower[0], upper[0])
+
+    if verbose:
+        print 'wls initial values:', pl.round_(theta, 2)
+        print_mare(vars)
+
+def find_asr_initial_vals(vars, method, tol, verbose, init='sequential'):
+    if init == 'wls':
+        find_wls_initial_vals(vars, verbose)
+        logger.info('.')
+        return
+
     for outer_reps in range(3):
         find_spline_initial_vals(vars, method, tol, verbose)
         find_re_initial_vals(vars, method, tol, verbose)
@@ -65,11 +413,13 @@ def find_spline_initial_vals(vars, method, tol, verbose):
     vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
                    vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
 
+    # a vectorized spline has a single stoch in gamma, so all of its
+    # knots are fitted at once, instead of one more knot at a time
     for i, n in enumerate(vars['gamma']):
         if verbose:
             print 'fitting first %d knots of %d' % (i+1, len(vars['gamma']))
         vars_to_fit.append(n)
-        mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+        map_fit(mc.MAP(vars_to_fit), method, tol, verbose)
         if verbose:
             print_mare(vars)
 
@@ -78,30 +428,38 @@ def find_re_initial_vals(vars, method, tol, verbose):
         return
 
     col_map = dict([[key, i] for i,key in enumerate(vars['U'].columns)])
+    index = data.hierarchy_index(vars['hierarchy'])
 
-    for reps in range(3):
-        for p in nx.traversal.bfs_tree(vars['hierarchy'], 'all'):
-            successors = vars['hierarchy'].successors(p)
-            if successors:
-                #print successors
+    if 'alpha_free' in vars:
+        # all of the free random effects are in a single stoch, so fit them together
+        vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
+                       vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
+        vars_to_fit += [vars.get('alpha_potentials'), vars['alpha_free']]
+        map_fit(mc.MAP(vars_to_fit), method, tol, verbose)
+    else:
+        for reps in range(3):
+            for p in index.subtree('all'):
+                successors = index.children[p]
+                if successors:
+                    #print successors
 
-                vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
-                               vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
-                vars_to_fit += [vars.get('alpha_potentials')]
+                    vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
+                                   vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
+                    vars_to_fit += [vars.get('alpha_potentials')]
 
-                re_vars = [vars['alpha'][col_map[n]] for n in successors + [p] if n in vars['U']]
-                vars_to_fit += re_vars
-                if len(re_vars) > 0:
-                    mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+                    re_vars = [vars['alpha'][col_map[n]] for n in successors + [p] if n in vars['U']]
+                    vars_to_fit += re_vars
+                    if len(re_vars) > 0:
+                        map_fit(mc.MAP(vars_to_fit), method, tol, verbose)
 
-                #print pl.round_([re.value for re in re_vars if isinstance(re, mc.Node)], 2)
-                #print_mare(vars)
+                    #print pl.round_([re.value for re in re_vars if isinstance(re, mc.Node)], 2)
+                    #print_mare(vars)
 
     #print 'sigma_alpha'
     vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
                    vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
     vars_to_fit += [vars.get('sigma_alpha')]
-    mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+    map_fit(mc.MAP(vars_to_fit), method, tol, verbose)
     #print pl.round_([s.value for s in vars['sigma_alpha']])
     #print_mare(vars)
 
@@ -110,31 +468,101 @@ def find_fe_initial_vals(vars, method, tol, verbose):
     vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
                    vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
     vars_to_fit += [vars.get('beta')]  # include fixed effects in sequential fit
-    mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+    map_fit(mc.MAP(vars_to_fit), method, tol, verbose)
     #print_mare(vars)
 
 def find_dispersion_initial_vals(vars, method, tol, verbose):
     vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
                    vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
     vars_to_fit += [vars.get('eta'), vars.get('zeta')]
-    mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+    map_fit(mc.MAP(vars_to_fit), method, tol, verbose)
     #print_mare(vars)
 
 
-def setup_asr_step_methods(m, vars, additional_stochs=[]):
+def block_logp(stochs, children):
+    try:
+        return sum([n.logp for n in stochs]) + sum([c.logp for c in children])
+    except mc.ZeroProbability:
+        return -pl.inf
+
+def hessian_cov(stochs, rel_step=1.e-3, min_eig=1.e-8):
+    """ Proposal covariance for a block of stochs, from a finite
+    difference Hessian of the log-probability of the block and its
+    children at the current values, which should be near the MAP
+
+    :Parameters:
+      - `stochs` : list of mc.Stochastic, the block of an AdaptiveMetropolis step method
+      - `rel_step` : float, the difference step, relative to the larger of 1 and the size of each value
+      - `min_eig` : float, smallest eigenvalue of the negative Hessian, relative to the largest
+
+    :Results:
+      - Returns the covariance, scaled by 2.4**2/d as the
+        AdaptiveMetropolis updates are, or None if the block has no
+        curvature or the log-probability is not finite
+
+    .. note::
+      - the Hessian takes 2*d*d + 1 evaluations of the log-probability
+        of the Markov blanket, with no optimization, where the normal
+        approximation refits the block first
+      - the eigenvalues of the negative Hessian are clipped from below,
+        so that flat or non-concave directions get a large but finite
+        variance
+    """
+    coords = free_coordinates(stochs)
+    children = set()
+    for n in stochs:
+        children |= n.extended_children
+    children -= set(stochs)
+
+    x = get_coordinates(coords)
+    d = len(x)
+    h = rel_step * pl.maximum(1., pl.absolute(x))
+    def f(dx):
+        set_coordinates(coords, x + dx)
+        return block_logp(stochs, children)
+
+    f0 = f(pl.zeros(d))
+    H = pl.zeros((d, d))
+    E = pl.diag(h)
+    for i in range(d):
+        H[i, i] = (f(E[i]) - 2*f0 + f(-E[i])) / h[i]**2
+        for j in range(i):
+            H[i, j] = H[j, i] = (f(E[i]+E[j]) - f(E[i]-E[j]) - f(E[j]-E[i]) + f(-E[i]-E[j])) / (4*h[i]*h[j])
+    set_coordinates(coords, x)
+
+    if not pl.isfinite(f0) or not pl.all(pl.isfinite(H)):
+        return None
+    eig, V = pl.eigh(-H)
+    if eig.max() <= 0:
+        return None
+    eig = pl.maximum(eig, min_eig * eig.max())
+    return pl.array(pl.dot(V / eig, V.T) * 2.4**2 / d, order='F')
+
+def setup_asr_step_methods(m, vars, hessian=False):
     # groups RE stochastics that are suspected of being dependent
     groups = []
     fe_group = [n for n in vars.get('beta', []) if isinstance(n, mc.Stochastic)]
+    # a vectorized spline has a single stoch in gamma, so there are no
+    # pairs of adjacent knots, only the block of all of them
     ap_group = [n for n in vars.get('gamma', []) if isinstance(n, mc.Stochastic)]
     groups += [[g_i, g_j] for g_i, g_j in zip(ap_group[1:], ap_group[:-1])] + [fe_group, ap_group, fe_group+ap_group]
 
-    for a in vars.get('hierarchy', []):
+    if 'hierarchy' in vars:
+        index = data.hierarchy_index(vars['hierarchy'])
+        col_map = dict([[key, i] for i,key in enumerate(vars['U'].columns)])
+
+    if 'alpha_free' in vars:
+        # all of the free random effects are in a single stoch
+        groups.append([vars['alpha_free']])
+        hierarchy = []
+    else:
+        hierarchy = vars.get('hierarchy', [])
+
+    for a in hierarchy:
         group = []
 
-        col_map = dict([[key, i] for i,key in enumerate(vars['U'].columns)])
-        
         if a in vars['U']:
-            for b in nx.shortest_path(vars['hierarchy'], 'all', a):
+            for b in index.path(a):
                 if b in vars['U']:
                     n = vars['alpha'][col_map[b]]
                     if isinstance(n, mc.Stochastic):
@@ -154,25 +582,421 @@ def setup_asr_step_methods(m, vars, additional_stochs=[]):
             #    m.use_step_method(mc.NoStepper, stoch)
             #    continue
 
-            #print 'finding Normal Approx for', [n.__name__ for n in stoch]
-            if additional_stochs == []:
-                vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
-                               vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
+            # the normal approximation refits each block, which is too
+            # slow and unstable, so start from the Hessian at the
+            # current values instead, if requested
+            cov = None
+            if hessian:
+                cov = hessian_cov(stoch)
+            if cov is not None:
+                m.use_step_method(mc.AdaptiveMetropolis, stoch, cov=cov)
             else:
-                vars_to_fit = additional_stochs
-
-            try:
-                raise ValueError
-                na = mc.NormApprox(vars_to_fit + stoch)
-                na.fit(method='fmin_powell', verbose=0)
-                cov = pl.array(pl.inv(-na.hess), order='F')
-                #print 'opt:', pl.round_([n.value for n in stoch], 2)
-                #print 'cov:\n', cov.round(4)
-                if pl.all(pl.eigvals(cov) >= 0):
-                    m.use_step_method(mc.AdaptiveMetropolis, stoch, cov=cov)
-                else:
-                    raise ValueError
-            except ValueError:
-                #print 'cov matrix is not positive semi-definite'
                 m.use_step_method(mc.AdaptiveMetropolis, stoch)
 
+    # latent rates of the beta-binomial model are drawn from their conjugate posterior in one block
+    if isinstance(vars.get('pi_latent'), mc.Stochastic):
+        m.use_step_method(rate_model.BetaBinomialGibbs, vars['pi_latent'], vars['pi'], vars['p_n'], vars['p_obs'])
+
+
+def disperse_initial_vals(stochs, scale=.1, tries=10):
+    """ Move each stoch to a random point near its current value, so
+    that chains started from the MAP do not all start from the same
+    place
+
+    :Parameters:
+      - `stochs` : list of mc.Stochastic, observed stochs are skipped
+      - `scale` : float, the standard deviation of the normal
+        perturbation, relative to the larger of 1 and the size of each
+        value; most stochs of the model are on the log scale
+      - `tries` : int, the number of perturbations to try, before
+        leaving a stoch at its current value
+
+    .. note::
+      - perturbations are clipped to the bounds of the stoch, and
+        rejected if the log-probability of the stoch or its children
+        is not finite
+    """
+    for s in stochs:
+        if s.observed:
+            continue
+        coords = free_coordinates([s])
+        x = get_coordinates(coords)
+        lower, upper = stoch_bounds(s)
+        children = s.extended_children - set([s])
+        for i in range(tries):
+            dx = scale * pl.maximum(1., pl.absolute(x)) * pl.randn(len(x))
+            set_coordinates(coords, pl.clip(x + dx, lower, upper))
+            if pl.isfinite(block_logp([s], children)):
+                break
+        else:
+            set_coordinates(coords, x)
+
+## the sampler to run in the worker processes of the pool, which is
+## inherited when they are forked, instead of pickled
+pool_sampler = None
+
+def sample_chain(args):
+    """ Run one chain of pool_sampler in a worker process, and return
+    its samples as a dict of arrays keyed by node name"""
+    seed, iter, burn, thin, tune_interval, dispersion = args
+    m = pool_sampler
+    if isinstance(m.db, npy_trace.Database):
+        # keep the files of each chain apart
+        m.db._directory = os.path.join(m.db.dbname, 'seed_%d' % seed)
+    pl.seed(seed)
+    disperse_initial_vals(m.stochastics, dispersion)
+    m.sample(iter, burn, thin, tune_interval=tune_interval, progress_bar=False)
+    return dict([[name, pl.array(m.trace(name)())] for name in m._funs_to_tally])
+
+def sample_chains(m, chains, iter, burn, thin, tune_interval, verbose, dispersion=.1, processes=None):
+    """ Run several chains of an MCMC from dispersed starting points in
+    a pool of processes, and merge their samples
+
+    :Parameters:
+      - `m` : mc.MCMC, with its step methods set up and its stochs at good initial values, such as the MAP
+      - `chains` : int, the number of chains
+      - `iter`, `burn`, `thin`, `tune_interval` : int, as for mc.MCMC.sample, for each chain
+      - `verbose` : boolean
+      - `dispersion` : float, the scale of the perturbation of the starting points, see disperse_initial_vals
+      - `processes` : int, optional, the size of the pool, which is the number of cpus by default
+
+    :Results:
+      - the trace of each tallied node of m is replaced by an
+        array_trace.ArrayTrace of the samples of all chains, which
+        covariate_model.predict_for and pymc.Node.stats use as the trace
+        of a single chain
+      - m.rhat and m.ess are dicts of the split R-hat and effective
+        sample size of each tallied node, keyed by node name, see
+        diagnostics.split_rhat and diagnostics.effective_sample_size
+
+    .. note::
+      - the pool forks the current process, so this only works on
+        platforms with fork, and each chain starts from the state of m
+        at the time of the call
+    """
+    global pool_sampler
+    pool_sampler = m
+    seeds = pl.randint(0, 2**30, chains)
+    # a fresh fork for each chain, so that each starts from the state of m
+    pool = multiprocessing.Pool(min(chains, processes or multiprocessing.cpu_count()), maxtasksperchild=1)
+    try:
+        results = pool.map(sample_chain, [(s, iter, burn, thin, tune_interval, dispersion) for s in seeds])
+    finally:
+        pool.terminate()
+        pool_sampler = None
+
+    merge_traces(m, results)
+    if verbose:
+        print_convergence(m)
+
+def merge_traces(m, chains):
+    """ Replace the trace of each tallied node of m with the samples of
+    several chains, and find their convergence diagnostics
+
+    :Parameters:
+      - `m` : mc.MCMC
+      - `chains` : list of dicts of arrays of samples, keyed by node name, one for each chain
+
+    :Results:
+      - the trace of each tallied node, and its entry in the database
+        of m, is an array_trace.ArrayTrace
+      - m.rhat and m.ess are dicts of the split R-hat and effective
+        sample size of each tallied node with at least 4 samples in each
+        chain, keyed by node name
+    """
+    nodes = dict([[n.__name__, n] for n in m._variables_to_tally])
+    m.rhat = {}
+    m.ess = {}
+    m.db.chains = 1
+    for name in chains[0]:
+        trace = array_trace.ArrayTrace(name, [c[name] for c in chains])
+        trace.db = m.db
+        m.db._traces[name] = trace
+        if name in nodes:
+            nodes[name].trace = trace
+
+        x = trace.chain_array()
+        if len(x[0]) >= 4:
+            m.rhat[name] = diagnostics.split_rhat(x)
+            m.ess[name] = diagnostics.effective_sample_size(x)
+
+def sample_to_ess(m, ess, iter, burn, thin, tune_interval, verbose, chunk=None, monitor=None):
+    """ Sample from an MCMC in chunks, until the effective sample size
+    of each monitored node reaches a target, or the iterations run out
+
+    :Parameters:
+      - `m` : mc.MCMC, with its step methods set up and its stochs at good initial values, such as the MAP
+      - `ess` : int, the target effective sample size of every entry of the monitored nodes
+      - `iter` : int, the largest number of iterations to run, including burn-in
+      - `burn`, `thin`, `tune_interval` : int, as for mc.MCMC.sample
+      - `verbose` : boolean
+      - `chunk` : int, optional, the number of iterations between checks of the effective
+        sample size, which is a tenth of iter minus burn by default
+      - `monitor` : list of node names, optional, all tallied stochs that are not observed by default
+
+    :Results:
+      - the trace of each tallied node of m is an
+        array_trace.ArrayTrace of the samples of all chunks, and m.rhat
+        and m.ess are dicts of diagnostics of each, as for merge_traces
+      - m.iter is the number of iterations run, and m.ess_met is True
+        if the target was reached, otherwise a warning lists the nodes
+        that fall short
+
+    .. note::
+      - the effective sample size is found again from all samples
+        after each chunk, with the fft, which is fast compared to
+        sampling
+      - the step methods keep tuning from chunk to chunk, as in a
+        single call to mc.MCMC.sample
+    """
+    if chunk is None:
+        chunk = (iter - burn) / 10
+    chunk = max(thin, chunk - chunk % thin)
+    assert burn + chunk <= iter, 'iter must leave room for a chunk after burn'
+    if monitor is None:
+        monitor = [n.__name__ for n in m._variables_to_tally if isinstance(n, mc.Stochastic) and not n.observed]
+
+    samples = dict([[name, []] for name in m._funs_to_tally])
+    n_iter = 0
+    m.ess_met = False
+    while n_iter == 0 or n_iter + chunk <= iter:
+        # only the first chunk is burned, and pymc saves every thin-th
+        # sample after burn, so the later chunks continue the thinning
+        b = burn if n_iter == 0 else 0
+        m.sample(chunk + b, b, thin, tune_interval=tune_interval, progress_bar=False)
+        n_iter += chunk + b
+        for name in samples:
+            samples[name].append(pl.array(m.trace(name)()))
+
+        min_ess = {}
+        for name in monitor:
+            x = pl.concatenate(samples[name])
+            if len(x) < 4:
+                continue
+            e = pl.atleast_1d(diagnostics.effective_sample_size([x]))
+            e = e[pl.isfinite(e)]
+            if len(e) > 0:
+                min_ess[name] = e.min()
+        if verbose:
+            print 'iteration %d: min ESS %.0f' % (n_iter, min(min_ess.values() or [0.]))
+
+        if min_ess and min(min_ess.values()) >= ess:
+            m.ess_met = True
+            break
+
+    m.iter = n_iter
+    merge_traces(m, [dict([[name, pl.concatenate(samples[name])] for name in samples])])
+
+    if not m.ess_met:
+        short = sorted([name for name in min_ess if min_ess[name] < ess])
+        logger.warning('effective sample size below %d after %d iterations for %s' % (ess, n_iter, ', '.join(short)))
+    if verbose:
+        print_convergence(m)
+
+def find_burn_in(m, max_burn, tune_interval, verbose, window=None, z=2.):
+    """ Sample from an MCMC in windows, without keeping the samples,
+    until a Geweke test finds the deviance of the last two windows
+    stationary, or max_burn iterations have run
+
+    :Parameters:
+      - `m` : mc.MCMC, with its step methods set up and its stochs at good initial values, such as the MAP
+      - `max_burn` : int, the largest number of iterations to run
+      - `tune_interval` : int, as for mc.MCMC.sample
+      - `verbose` : boolean
+      - `window` : int, optional, the number of iterations between tests, a tenth of max_burn by default
+      - `z` : float, the largest absolute z-score of a stationary deviance
+
+    :Results:
+      - Returns the number of iterations run, and sets
+        m.burn_detected to False if the deviance was not found
+        stationary, in which case a warning is printed
+
+    .. note::
+      - only 50 samples of each window are saved, for the test, and
+        they are discarded from the database of m at the end, so that
+        the traces and stats of the nodes hold only the samples after
+        burn-in
+      - the deviance is the log-likelihood of the data, which is the
+        part of the log-posterior that pymc keeps a trace of
+    """
+    if window is None:
+        window = max_burn / 10
+    m.burn_detected = False
+    if window < 50:
+        # too short to test, so do not burn at all
+        return 0
+
+    start = m.db.chains
+    deviance = []
+    n_iter = 0
+    while n_iter + window <= max_burn:
+        m.sample(window, 0, window / 50, tune_interval=tune_interval, progress_bar=False)
+        n_iter += window
+        deviance.append(pl.array(m.trace('deviance')(), dtype=float))
+        if len(deviance) < 2:
+            continue
+
+        z_k = diagnostics.geweke([pl.concatenate(deviance[-2:])], first=.5, last=.5)
+        if verbose:
+            print 'iteration %d: deviance z-score %.2f' % (n_iter, z_k)
+
+        # a constant deviance, such as that of a model with no data, has a z-score of nan
+        if not pl.absolute(z_k) >= z:
+            m.burn_detected = True
+            break
+
+    discard_chains(m, start)
+    if not m.burn_detected:
+        logger.warning('deviance not stationary after %d iterations of burn-in' % n_iter)
+    return n_iter
+
+def discard_chains(m, start):
+    """ Remove the chains from index start on from the database of
+    m, which is a pymc ram database or a npy_trace database"""
+    if isinstance(m.db, npy_trace.Database):
+        m.db.discard_chains(start)
+        return
+    for trace in m.db._traces.values():
+        for chain in range(start, m.db.chains):
+            trace._trace.pop(chain, None)
+            trace._index.pop(chain, None)
+    del m.db.trace_names[start:]
+    m.db.chains = start
+
+def sample_posterior(m, iter, burn, thin, tune_interval, verbose, chains=1, ess=None, auto_burn=False, checkpoint=None):
+    """ Sample from an MCMC with the options of fit.fit_asr and fit.fit_consistent
+
+    :Parameters:
+      - `m` : mc.MCMC, with its step methods set up and its stochs at good initial values, such as the MAP
+      - `iter`, `burn`, `thin`, `tune_interval` : int, as for mc.MCMC.sample
+      - `verbose` : boolean
+      - `chains` : int, optional, the number of chains to run in parallel, see sample_chains
+      - `ess` : int, optional, the target effective sample size, see sample_to_ess
+      - `auto_burn` : boolean, optional, end the burn-in once the
+        deviance is stationary, with `burn` as the longest burn-in,
+        see find_burn_in
+      - `checkpoint` : int, optional, the number of iterations between
+        checkpoints of a single chain, which needs the database of m to
+        be a npy_trace.Database, see resume_sampling
+
+    :Results:
+      - m.iter, m.burn and m.thin are the number of iterations run,
+        the number of them discarded, and the thinning
+      - with `auto_burn`, m.burn_detected is False if the burn-in
+        reached `burn` without the deviance becoming stationary
+    """
+    assert not checkpoint or (isinstance(m.db, npy_trace.Database) and not ess and chains == 1), \
+        'checkpoints need a single chain stored with npy_trace'
+
+    m.iter = iter
+    m.burn = burn
+    m.thin = thin
+    warm_up = 0
+    if auto_burn:
+        # keep the number of samples saved, and start them after the warm-up
+        m.burn = warm_up = find_burn_in(m, burn, tune_interval, verbose)
+        iter, burn = iter - burn, 0
+        m.iter = m.burn + iter
+
+    if checkpoint:
+        m.db.run = dict(iter=iter, burn=burn, thin=thin, done=0, warm_up=warm_up)
+        save_adaptive_state(m)
+        m.sample(iter, burn, thin, tune_interval=tune_interval, save_interval=checkpoint, progress_bar=False)
+    elif ess:
+        sample_to_ess(m, ess, iter, burn, thin, tune_interval, verbose)
+        m.iter += m.burn - burn
+    elif chains > 1:
+        sample_chains(m, chains, iter, burn, thin, tune_interval, verbose)
+    elif verbose:
+        try:
+            m.sample(iter, burn, thin, tune_interval=tune_interval, progress_bar=True, progress_bar_fd=sys.stdout)
+        except TypeError:
+            m.sample(iter, burn, thin, tune_interval=tune_interval, progress_bar=False, verbose=verbose)
+    else:
+        m.sample(iter, burn, thin, tune_interval=tune_interval, progress_bar=False)
+
+def save_adaptive_state(m):
+    """ Add the running mean of each AdaptiveMetropolis step method of
+    m to the state that pymc saves, which its covariance updates need
+    after a resume; m.step_methods only exists once m has sampled, so
+    the step methods are found in m.step_method_dict"""
+    for sms in m.step_method_dict.values():
+        for sm in sms:
+            if isinstance(sm, mc.AdaptiveMetropolis) and 'chain_mean' not in sm._state:
+                sm._state.append('chain_mean')
+
+def load_checkpoint(vars, trace_dir):
+    """ Create an MCMC from the last checkpoint of a run of
+    sample_posterior with a checkpoint interval
+
+    :Parameters:
+      - `vars` : dict of model vars, the same as those of the checkpointed run
+      - `trace_dir` : str, the directory of its npy_trace database
+
+    :Results:
+      - Returns an mc.MCMC with the values of the stochs at the
+        checkpoint and its traces so far, or None if there is no
+        checkpoint of a run in trace_dir; its step methods must be set
+        up as they were in the run, and then resume_sampling continues
+        the run
+    """
+    if not trace_dir or not npy_trace.has_checkpoint(trace_dir):
+        return None
+    db = npy_trace.load(trace_dir)
+    if not db.run:
+        return None
+    return mc.MCMC(vars, db=db)
+
+def resume_sampling(m, tune_interval, verbose, checkpoint):
+    """ Continue a checkpointed run, see load_checkpoint
+
+    :Parameters:
+      - `m` : mc.MCMC, from load_checkpoint, with its step methods set up
+      - `tune_interval` : int, as for mc.MCMC.sample
+      - `verbose` : boolean
+      - `checkpoint` : int, the number of iterations between further checkpoints
+
+    :Results:
+      - m.iter, m.burn and m.thin are as for sample_posterior, and the
+        trace of each node has as many samples as the run would have
+        had without stopping
+
+    .. note::
+      - the stochs, the adaptive state of the step methods, and the
+        random number generator continue from the checkpoint, but the
+        thinning restarts, so the samples after the resume are not the
+        ones the run would have saved
+    """
+    state = m.db.getstate()
+    run = m.db.run
+    m.iter = run['warm_up'] + run['iter']
+    m.burn = run['warm_up'] + run['burn']
+    m.thin = run['thin']
+
+    # pymc saves the state after the step and tally of the current
+    # iteration while running, and after the last iteration at the end
+    done = run['done'] + state['sampler']['_current_iter'] + (state['sampler']['status'] == 'running')
+    n_total = len(range(run['burn'] + (-run['burn']) % run['thin'], run['iter'], run['thin']))
+    n_left = n_total - m.db._traces['deviance'].length()
+    if verbose:
+        print 'resuming at iteration %d of %d, with %d samples left' % (done, run['iter'], n_left)
+    if n_left <= 0:
+        return
+
+    burn = max(0, run['burn'] - done)
+    burn += (-burn) % run['thin']
+    m.db.run = dict(run, done=done)
+    save_adaptive_state(m)
+    np.random.set_state(state['rng'])
+    m.sample(burn + (n_left - 1)*run['thin'] + 1, burn, run['thin'], tune_interval=tune_interval,
+             save_interval=checkpoint, progress_bar=False)
+
+def print_convergence(m):
+    """ Print the largest split R-hat and smallest effective sample size of each node of m"""
+    print '%-30s %8s %8s' % ('node', 'max R-hat', 'min ESS')
+    for name in sorted(m.rhat):
+        rhat = pl.atleast_1d(m.rhat[name])
+        ess = pl.atleast_1d(m.ess[name])
+        if pl.all(pl.isnan(rhat)):
+            continue
+        print '%-30s %8.3f %8.0f' % (name, pl.nanmax(rhat), pl.nanmin(ess))
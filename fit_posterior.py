@@ -17,6 +17,7 @@ import ism
 import covariate_model
 import fit_model
 import graphics
+import diagnostics
 
 reload(covariate_model)
 reload(ism)
@@ -55,7 +56,7 @@ def inspect_node(n):
 
 def fit_posterior(dm, region, sex, year, fast_fit=False, 
                   inconsistent_fit=False, params_to_fit=['p', 'r', 'i'], zero_re=True,
-                  posteriors_only=False):
+                  posteriors_only=False, resume=False, lazy_pred=False, auto_burn=False):
     """ Fit posterior of specified region/sex/year for specified model
 
     Parameters
@@ -72,6 +73,9 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
 
     zero_re : bool, if true, enforce constraint that sibling area REs sum to zero
     posteriors_only : bool, if tru use data from 1997-2007 for 2005 and from 2007 on for 2010
+    resume : bool, if true continue the posterior fit from its last checkpoint, if there is one
+    lazy_pred : bool, if true draw p_pred from the traces after sampling, instead of at every iteration
+    auto_burn : bool, if true end the burn-in when the deviance is stationary, with burn as the longest burn-in, and save the burn-in found with the estimates
 
     Example
     -------
@@ -209,6 +213,9 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
     # replace area 'all' with predict_area
     model.input_data['area'][model.input_data['area'] == 'all'] = predict_area
 
+    # burn-in of the fit of each rate type, to save with its estimates
+    fit_burn = {}
+
     if inconsistent_fit:
         # generate fits for requested parameters inconsistently
         for t in params_to_fit:
@@ -218,22 +225,28 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
                                             mu_age_parent=emp_priors.get((t, 'mu')),
                                             sigma_age_parent=emp_priors.get((t, 'sigma')),
                                             rate_type=(t == 'rr') and 'log_normal' or 'neg_binom',
-                                            zero_re=zero_re)
+                                            zero_re=zero_re, lazy_pred=lazy_pred)
             if fast_fit:
                 dismod3.fit.fit_asr(model, t, iter=101, burn=0, thin=1, tune_interval=100)
             else:
-                dismod3.fit.fit_asr(model, t, iter=iter, burn=burn, thin=thin, tune_interval=100)
+                dismod3.fit.fit_asr(model, t, iter=iter, burn=burn, thin=thin, tune_interval=100,
+                                    trace_dir=dir + '/posterior/trace-%s-%s+%s+%s'%(t, predict_area, predict_sex, predict_year),
+                                    checkpoint=1000, resume=resume, auto_burn=auto_burn)
+            fit_burn[t] = model.mcmc.burn
 
     else:
         model.vars += ism.consistent(model,
                                      reference_area=predict_area, reference_sex=predict_sex, reference_year=predict_year,
-                                     priors=emp_priors, zero_re=zero_re)
+                                     priors=emp_priors, zero_re=zero_re, lazy_pred=lazy_pred)
 
         ## fit model to data
         if fast_fit:
             dm.map, dm.mcmc = dismod3.fit.fit_consistent(model, 105, 0, 1, 100)
         else:
-            dm.map, dm.mcmc = dismod3.fit.fit_consistent(model, iter=iter, burn=burn, thin=thin, tune_interval=100, verbose=True)
+            dm.map, dm.mcmc = dismod3.fit.fit_consistent(model, iter=iter, burn=burn, thin=thin, tune_interval=100, verbose=True,
+                                                         trace_dir=dir + '/posterior/trace-%s+%s+%s'%(predict_area, predict_sex, predict_year),
+                                                         checkpoint=1000, resume=resume, auto_burn=auto_burn)
+        fit_burn = dict([[t, dm.mcmc.burn] for t in model.vars])
 
 
     # generate estimates
@@ -295,16 +308,16 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
                 print 'WARNING: could not save file'
                 print e
         if 'U' in dm.vars[t]:
-            re = dm.vars[t]['U'].T
+            re = dm.vars[t]['U'].to_dense().T
             columns = list(re.columns)
             mu = []
             sigma = []
-            for n in dm.vars[t]['alpha']:
-                if isinstance(n, mc.Node):
-                    mu.append(n.stats()['mean'])
-                    sigma.append(n.stats()['standard deviation'])
+            for stats, value in covariate_model.alpha_stats(dm.vars[t]):
+                if stats:
+                    mu.append(stats['mean'])
+                    sigma.append(stats['standard deviation'])
                 else:
-                    mu.append(n)
+                    mu.append(value)
                     sigma.append(0.)
 
             re['mu_coeff'] = mu
@@ -352,6 +365,13 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
             except IOError, e:
                 print 'WARNING: could not save file'
                 print e
+
+    print 'saving convergence diagnostics'
+    try:
+        diagnostics.convergence_table(model.vars).to_csv(dir + '/posterior/convergence-%s+%s+%s.csv'%(predict_area, predict_sex, predict_year))
+    except IOError, e:
+        print 'WARNING: could not save file'
+        print e
                                     
 
     save_country_level_posterior(dm, model, model.vars, predict_area, predict_sex, predict_year, ['incidence', 'prevalence', 'remission', 'excess-mortality', 'duration', 'prevalence_x_excess-mortality'])
@@ -382,11 +402,9 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
                 effects['alpha'] = {}
                 effects['sigma_alpha'] = {}
                 if 'alpha' in vars:
-                    for n, col in zip(vars['alpha'], vars['U'].columns):
-                        if isinstance(n, mc.Node):
-                            stats = n.stats()
-                            if stats:
-                                effects['alpha'][col] = dict(mu=stats['mean'], sigma=stats['standard deviation'])
+                    for (stats, value), col in zip(covariate_model.alpha_stats(vars), vars['U'].columns):
+                        if stats:
+                            effects['alpha'][col] = dict(mu=stats['mean'], sigma=stats['standard deviation'])
                     for n in vars['sigma_alpha']:
                         stats = n.stats()
                         effects['sigma_alpha'][n.__name__] = dict(mu=stats['mean'], sigma=stats['standard deviation'])
@@ -400,6 +418,7 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
                                 effects['beta'][col] = dict(mu=stats['mean'], sigma=stats['standard deviation'])
                                 
                 dm.set_key_by_type('effects', key, effects)
+                dm.set_key_by_type('mcmc_burn', key, fit_burn.get(type))
 
     # save results (do this last, because it removes things from the disease model that plotting function, etc, might need
     try:
@@ -492,6 +511,12 @@ def main():
                       help='enforce zero constraint on random effects')
     parser.add_option('-o', '--onlyposterior', default='False',
                       help='skip empirical prior phase')
+    parser.add_option('--resume', default='False',
+                      help='continue the posterior fit from its last checkpoint')
+    parser.add_option('-l', '--lazypred', default='false',
+                      help='generate posterior-predictive draws from the traces after sampling')
+    parser.add_option('--autoburn', default='false',
+                      help='end the burn-in when the deviance is stationary')
     
     (options, args) = parser.parse_args()
 
@@ -515,7 +540,10 @@ def main():
                        inconsistent_fit=options.inconsistent.lower() == 'true',
                        params_to_fit=options.types.split(),
                        posteriors_only=(options.onlyposterior.lower()=='true'),
-                       zero_re=options.zerore.lower() == 'true')
+                       zero_re=options.zerore.lower() == 'true',
+                       resume=options.resume.lower() == 'true',
+                       lazy_pred=options.lazypred.lower() == 'true',
+                       auto_burn=options.autoburn.lower() == 'true')
     
     return dm
 
@@ -25,13 +25,17 @@ import graphics
 reload(fit_model)
 
 
-def fit_world(id, fast_fit=False, zero_re=True, alt_prior=False, global_heterogeneity='Slightly'):
+def fit_world(id, fast_fit=False, zero_re=True, alt_prior=False, global_heterogeneity='Slightly', lazy_pred=False, auto_burn=False):
     """ Fit consistent for all data in world
 
     Parameters
     ----------
     id : int
       The model id number for the job to fit
+    lazy_pred : bool, optional
+      Draw p_pred from the traces after sampling, instead of at every iteration
+    auto_burn : bool, optional
+      End the burn-in when the deviance is stationary, with 10000 as the longest burn-in
 
     Example
     -------
@@ -82,13 +86,15 @@ def fit_world(id, fast_fit=False, zero_re=True, alt_prior=False, global_heteroge
                                          reference_sex='total',
                                          reference_year='all',
                                          priors={},
-                                         zero_re=zero_re)
+                                         zero_re=zero_re,
+                                         lazy_pred=lazy_pred)
 
     ## fit model to data
     if fast_fit:
         dm.map, dm.mcmc = dismod3.fit.fit_consistent(model, 105, 0, 1, 100)
     else:
-        dm.map, dm.mcmc = dismod3.fit.fit_consistent(model, iter=50000, burn=10000, thin=40, tune_interval=1000, verbose=True)
+        dm.map, dm.mcmc = dismod3.fit.fit_consistent(model, iter=50000, burn=10000, thin=40, tune_interval=1000, verbose=True,
+                                                     auto_burn=auto_burn)
 
     dm.model = model
 
@@ -98,8 +104,12 @@ def fit_world(id, fast_fit=False, zero_re=True, alt_prior=False, global_heteroge
     alpha_vals = []
     for type in types_with_re:
         if 'alpha' in model.vars[type]:
-            for alpha_i in model.vars[type]['alpha']:
-                alpha_vals += [a for a in alpha_i.trace() if a != 0]  # remove zeros because areas with no siblings are included for convenience but are pinned to zero
+            if isinstance(model.vars[type]['alpha'], mc.Node):
+                alpha_traces = model.vars[type]['alpha'].trace().T
+            else:
+                alpha_traces = [alpha_i.trace() for alpha_i in model.vars[type]['alpha']]
+            for alpha_i_trace in alpha_traces:
+                alpha_vals += [a for a in alpha_i_trace if a != 0]  # remove zeros because areas with no siblings are included for convenience but are pinned to zero
     ## then blend sigma_alpha_i and sigma_alpha_bar for each sigma_alpha_i
     if len(alpha_vals) > 0:
         sigma_alpha_bar = pl.std(alpha_vals)
@@ -206,6 +216,10 @@ def main():
                       help='use alternative aggregation for empirical prior')
     parser.add_option('-g', '--globalheterogeneity', default='Slightly',
                       help='negative binomial heterogeneity for global estimate')
+    parser.add_option('-l', '--lazypred', default='false',
+                      help='generate posterior-predictive draws from the traces after sampling')
+    parser.add_option('--autoburn', default='false',
+                      help='end the burn-in when the deviance is stationary')
 
     (options, args) = parser.parse_args()
 
@@ -220,7 +234,9 @@ def main():
     dm = fit_world(id, options.fast.lower() == 'true',
                    zero_re=options.zerore.lower() == 'true',
                    alt_prior=options.altprior.lower() == 'true',
-                   global_heterogeneity=options.globalheterogeneity)
+                   global_heterogeneity=options.globalheterogeneity,
+                   lazy_pred=options.lazypred.lower() == 'true',
+                   auto_burn=options.autoburn.lower() == 'true')
     return dm
       
 
@@ -24,7 +24,8 @@ reload(rate_model)
 def age_specific_rate(model, data_type, reference_area='all', reference_sex='total', reference_year='all',
                       mu_age=None, mu_age_parent=None, sigma_age_parent=None, 
                       rate_type='neg_binom', lower_bound=None, interpolation_method='linear',
-                      include_covariates=True, zero_re=False):
+                      include_covariates=True, zero_re=False, vectorized_spline=False, design_cache=None,
+                      vectorized_re=False, lazy_pred=False):
     # TODO: expose (and document) interface for alternative rate_type as well as other options,
     # record reference values in the model
     """ Generate PyMC objects for model of epidemological age-interval data
@@ -36,11 +37,16 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
       - `mu_age` : pymc.Node, will be used as the age pattern, set to None if not needed
       - `mu_age_parent` : pymc.Node, will be used as the age pattern of the parent of the root area, set to None if not needed
       - `sigma_age_parent` : pymc.Node, will be used as the standard deviation of the age pattern, set to None if not needed
-      - `rate_type` : str, optional. One of 'beta_binom', 'binom', 'log_normal_model', 'neg_binom', 'neg_binom_lower_bound_model', 'neg_binom_model', 'normal_model', 'offest_log_normal', or 'poisson'
+      - `rate_type` : str, optional. One of 'beta_binom', 'beta_binom_collapsed', 'binom', 'log_normal_model', 'neg_binom', 'neg_binom_lower_bound_model', 'neg_binom_model', 'normal_model', 'offest_log_normal', or 'poisson'
       - `lower_bound` : 
       - `interpolation_method` : str, optional, one of 'linear', 'nearest', 'zero', 'slinear', 'quadratic, or 'cubic'
       - `include_covariates` : boolean
       - `zero_re` : boolean, change one stoch from each set of siblings in area hierarchy to a 'sum to zero' deterministic
+      - `vectorized_spline` : boolean, use a single array-valued stoch for the age pattern knots, see age_pattern.spline;
+        the knots are then fitted and stepped together, not knot by knot
+      - `design_cache` : dict, optional, for sharing covariate designs between data types of the same model, see covariate_model.mean_covariate_model
+      - `vectorized_re` : boolean, keep the free random effects in a single array-valued stoch, see covariate_model.vectorized_random_effects
+      - `lazy_pred` : boolean, generate the posterior-predictive 'p_pred' from the traces after sampling, see rate_model.PosteriorPredictive
 
     :Results:
       - Returns dict of PyMC objects, including 'pi', the covariate adjusted predicted values for each row of data
@@ -79,7 +85,8 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
 
     if mu_age == None:
         vars.update(
-            age_pattern.age_pattern(name, ages=ages, knots=knots, smoothing=smoothing, interpolation_method=interpolation_method)
+            age_pattern.age_pattern(name, ages=ages, knots=knots, smoothing=smoothing, interpolation_method=interpolation_method,
+                                    vectorized=vectorized_spline)
             )
     else:
         vars.update(dict(mu_age=mu_age, ages=ages))
@@ -104,8 +111,7 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
             else:
                 initial_mu = mu_age_parent
                 
-            for i, k_i in enumerate(knots):
-                vars['gamma'][i].value = (pl.log(initial_mu[k_i-ages[0]])).clip(-12,6)
+            age_pattern.set_knot_values(vars, (pl.log(initial_mu[knots-ages[0]])).clip(-12,6))
 
     age_weights = pl.ones_like(vars['mu_age'].value) # TODO: use age pattern appropriate to the rate type
     if len(data) > 0:
@@ -124,7 +130,8 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
 
         if include_covariates:
             vars.update(
-                covariate_model.mean_covariate_model(name, vars['mu_interval'], data, parameters, model, reference_area, reference_sex, reference_year, zero_re=zero_re)
+                covariate_model.mean_covariate_model(name, vars['mu_interval'], data, parameters, model, reference_area, reference_sex, reference_year, zero_re=zero_re,
+                                                     design_cache=design_cache, vectorized_re=vectorized_re)
                 )
         else:
             vars.update({'pi': vars['mu_interval']})
@@ -168,7 +175,8 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
                 )
 
             vars.update(
-                rate_model.neg_binom_model(name, vars['pi'], vars['delta'], data['value'], data['effective_sample_size'])
+                rate_model.neg_binom_model(name, vars['pi'], vars['delta'], data['value'], data['effective_sample_size'],
+                                           lazy_pred=lazy_pred)
                 )
         elif rate_type == 'log_normal':
 
@@ -182,7 +190,8 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
             vars['sigma'] = mc.Uniform('sigma_%s'%name, lower=.0001, upper=1., value=.01)
             #vars['sigma'] = mc.Exponential('sigma_%s'%name, beta=100., value=.01)
             vars.update(
-                rate_model.log_normal_model(name, vars['pi'], vars['sigma'], data['value'], data['standard_error'])
+                rate_model.log_normal_model(name, vars['pi'], vars['sigma'], data['value'], data['standard_error'],
+                                            lazy_pred=lazy_pred)
                 )
         elif rate_type == 'normal':
 
@@ -194,28 +203,33 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
 
             vars['sigma'] = mc.Uniform('sigma_%s'%name, lower=.0001, upper=.1, value=.01)
             vars.update(
-                rate_model.normal_model(name, vars['pi'], vars['sigma'], data['value'], data['standard_error'])
+                rate_model.normal_model(name, vars['pi'], vars['sigma'], data['value'], data['standard_error'],
+                                        lazy_pred=lazy_pred)
                 )
         elif rate_type == 'binom':
-            vars += rate_model.binom(name, vars['pi'], data['value'], data['effective_sample_size'])
+            vars += rate_model.binom(name, vars['pi'], data['value'], data['effective_sample_size'], lazy_pred=lazy_pred)
         elif rate_type == 'beta_binom':
-            vars += rate_model.beta_binom(name, vars['pi'], data['value'], data['effective_sample_size'])
+            vars += rate_model.beta_binom(name, vars['pi'], data['value'], data['effective_sample_size'], lazy_pred=lazy_pred)
+        elif rate_type == 'beta_binom_collapsed':
+            vars += rate_model.beta_binom(name, vars['pi'], data['value'], data['effective_sample_size'], collapsed=True,
+                                          lazy_pred=lazy_pred)
         elif rate_type == 'poisson':
             missing_ess = pl.isnan(data['effective_sample_size']) | (data['effective_sample_size'] < 0)
             if sum(missing_ess) > 0:
                 print 'WARNING: %d rows of %s data has invalid quantification of uncertainty.' % (sum(missing_ess), name)
                 data['effective_sample_size'][missing_ess] = 0.0
 
-            vars += rate_model.poisson(name, vars['pi'], data['value'], data['effective_sample_size'])
+            vars += rate_model.poisson(name, vars['pi'], data['value'], data['effective_sample_size'], lazy_pred=lazy_pred)
         elif rate_type == 'offset_log_normal':
             vars['sigma'] = mc.Uniform('sigma_%s'%name, lower=.0001, upper=10., value=.01)
-            vars += rate_model.offset_log_normal(name, vars['pi'], vars['sigma'], data['value'], data['standard_error'])
+            vars += rate_model.offset_log_normal(name, vars['pi'], vars['sigma'], data['value'], data['standard_error'], lazy_pred=lazy_pred)
         else:
             raise Exception, 'rate_model "%s" not implemented' % rate_type
     else:
         if include_covariates:
             vars.update(
-                covariate_model.mean_covariate_model(name, [], data, parameters, model, reference_area, reference_sex, reference_year, zero_re=zero_re)
+                covariate_model.mean_covariate_model(name, [], data, parameters, model, reference_area, reference_sex, reference_year, zero_re=zero_re,
+                                                     design_cache=design_cache, vectorized_re=vectorized_re)
                 )
     if include_covariates:
         vars.update(expert_prior_model.covariate_level_constraints(name, model, vars, ages))
@@ -227,7 +241,8 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
         if include_covariates:
 
             vars['lb'].update(
-                covariate_model.mean_covariate_model('lb_%s'%name, vars['lb']['mu_interval'], lb_data, parameters, model, reference_area, reference_sex, reference_year, zero_re=zero_re)
+                covariate_model.mean_covariate_model('lb_%s'%name, vars['lb']['mu_interval'], lb_data, parameters, model, reference_area, reference_sex, reference_year, zero_re=zero_re,
+                                                     design_cache=design_cache, vectorized_re=vectorized_re)
                 )
         else:
             vars['lb'].update({'pi': vars['lb']['mu_interval']})
@@ -258,7 +273,82 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
     result[data_type] = vars
     return result
     
-def consistent(model, reference_area='all', reference_sex='total', reference_year='all', priors={}, zero_re=True):
+def backward_recurrence(a, b):
+    """ Solve the linear recurrence X[i] = a[i] * X[i+1] + b[i], with
+    X[N-1] = b[N-1], along the last axis by recursive doubling
+
+    :Parameters:
+      - `a, b` : arrays of the same shape, with N ages on the last axis
+
+    :Results:
+      - Returns array X, with the shape of b
+
+    .. note::
+      - each of the log2(N) passes composes the affine maps
+        X[i] = A[i] * X[i+d] + B[i] and X[i+d] = A[i+d] * X[i+2d] + B[i+d],
+        so that products of a that underflow go to zero harmlessly
+    """
+    A = pl.array(a, dtype=float)
+    B = pl.array(b, dtype=float)
+    A[..., -1] = 0.
+
+    N = B.shape[-1]
+    d = 1
+    while d < N:
+        B[..., :-d] += A[..., :-d] * B[..., d:]
+        A[..., :-d] *= A[..., d:]
+        d *= 2
+    return B
+
+def duration(r, m, f):
+    """ Expected time spent with the condition from each age, for
+    piecewise constant remission, without-condition mortality and excess
+    mortality on a one-year age grid
+
+    :Parameters:
+      - `r, m, f` : arrays of rates, with ages on the last axis; arrays
+        of posterior samples with shape (samples, ages) give one row of
+        durations for each sample
+
+    :Results:
+      - Returns array of durations, with the shape of r
+    """
+    hazard = r + m + f
+    pr_not_exit = pl.exp(-hazard)
+
+    # X[i] = pr_not_exit[i] * X[i+1] + (1 - pr_not_exit[i]) / hazard[i],
+    # and beyond the last age the hazard stays constant
+    b = (1 - pr_not_exit) / hazard
+    b[..., -1] = 1 / hazard[..., -1]
+    return backward_recurrence(pr_not_exit, b)
+
+def duration_vjp(adj, r, m, f):
+    """ Product of adj and the jacobian of duration(r, m, f) with
+    respect to the hazard r + m + f, which is the same for each of the
+    three rates
+
+    :Parameters:
+      - `adj` : array, with the shape of the durations
+      - `r, m, f` : arrays of rates on one age grid
+
+    :Results:
+      - Returns array with the shape of r
+    """
+    hazard = r + m + f
+    pr_not_exit = pl.exp(-hazard)
+    X = duration(r, m, f)
+
+    # the adjoint of X[i] = a[i] * X[i+1] + b[i] solves
+    # lam[i] = adj[i] + a[i-1] * lam[i-1], which runs up the ages
+    lam = backward_recurrence(pl.hstack((pr_not_exit[-2::-1], 0.)), adj[::-1])[::-1]
+
+    d_a = pl.hstack((lam[:-1] * X[1:], 0.))
+    d_b_d_h = (pr_not_exit*hazard - (1 - pr_not_exit)) / hazard**2
+    d_b_d_h[-1] = -1 / hazard[-1]**2
+    return -pr_not_exit*d_a + lam*d_b_d_h
+
+def consistent(model, reference_area='all', reference_sex='total', reference_year='all', priors={}, zero_re=True,
+               vectorized_spline=False, vectorized_re=False, lazy_pred=False, ode_solver='rk4', ode_tolerance=None, ode_cache_size=100):
     """ Generate PyMC objects for consistent model of epidemological data
     
     :Parameters:
@@ -267,6 +357,13 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
       - `root_area, root_sex, root_year` : the node of the model to fit consistently
       - `priors` : dictionary, with keys for data types for lists of priors on age patterns
       - `zero_re` : boolean, change one stoch from each set of siblings in area hierarchy to a 'sum to zero' deterministic
+      - `vectorized_spline` : boolean, use a single array-valued stoch for the knots of each age pattern, see age_pattern.spline;
+        fit.fit_consistent then steps all the knots of i, r and f in one block, instead of one block for each knot
+      - `vectorized_re` : boolean, keep the free random effects of each data type in a single array-valued stoch, see covariate_model.vectorized_random_effects
+      - `lazy_pred` : boolean, generate the posterior-predictive 'p_pred' of each data type from the traces after sampling, see rate_model.PosteriorPredictive
+      - `ode_solver` : str, optional. One of 'rk4', for the pycppad Runge-Kutta tape of dismod_ode, or 'closed_form', for closed_form_ode
+      - `ode_tolerance` : float, optional. For 'rk4', choose the number of steps in each age interval by step doubling at the initial rates, see dismod_ode.choose_num_step; the default takes 10 steps in every interval
+      - `ode_cache_size` : int, optional. The number of ODE solutions to keep in a least-recently-used cache, see ode_cache.MemoizedODE; 0 turns the cache off
  
     :Results:
       - Returns dict of dicts of PyMC objects, including 'i', 'p', 'r', 'f', the covariate adjusted predicted values for each row of data
@@ -286,10 +383,15 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
     rate = {}
     ages = model.parameters['ages']
 
+    # the covariate designs only depend on the data rows and the reference area/sex/year,
+    # so share them between all of the data types
+    design_cache = {}
+
     for t in 'irf':
         rate[t] = age_specific_rate(model, t, reference_area, reference_sex, reference_year,
                                     mu_age=None, mu_age_parent=priors.get((t, 'mu')), sigma_age_parent=priors.get((t, 'sigma')),
-                                    zero_re=zero_re)[t] # age_specific_rate()[t] is to create proper nesting of dict
+                                    zero_re=zero_re, vectorized_spline=vectorized_spline,
+                                    design_cache=design_cache, vectorized_re=vectorized_re, lazy_pred=lazy_pred)[t] # age_specific_rate()[t] is to create proper nesting of dict
 
         # set initial values from data
         if t in priors:
@@ -307,8 +409,7 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
                     end = row['age_end'] - rate[t]['ages'][0]
                     initial[start:end] = row['value']
 
-        for i,k in enumerate(rate[t]['knots']):
-            rate[t]['gamma'][i].value = pl.log(initial[k - rate[t]['ages'][0]]+1.e-9)
+        age_pattern.set_knot_values(rate[t], pl.log(initial[rate[t]['knots'] - rate[t]['ages'][0]]+1.e-9))
 
     m_all = .01*pl.ones(101)
     df = model.get_data('m_all')
@@ -337,13 +438,32 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
     logit_C0 = mc.Uniform('logit_C0', -15, 15, value=-10.)
 
 
-    # use Runge-Kutta 4 ODE solver
-    import dismod_ode
-
     N = len(m_all)
-    num_step = 10  # double until it works
     ages = pl.array(ages, dtype=float)
-    fun = dismod_ode.ode_function(num_step, ages, m_all)
+    if ode_solver == 'rk4':
+        # use Runge-Kutta 4 ODE solver
+        import dismod_ode
+
+        if ode_tolerance == None:
+            num_step = 10  # double until it works
+        else:
+            C0 = mc.invlogit(logit_C0.value)
+            x = pl.hstack((rate['i']['mu_age'].value, rate['r']['mu_age'].value, rate['f']['mu_age'].value, 1-C0, C0))
+            num_step, ode_error = dismod_ode.choose_num_step(ages, m_all, x, ode_tolerance)
+        fun = dismod_ode.ode_function(num_step, ages, m_all)
+    elif ode_solver == 'closed_form':
+        # use closed-form matrix exponentials for each age interval
+        import closed_form_ode
+
+        fun = closed_form_ode.ode_function(ages, m_all)
+    else:
+        raise Exception, 'ode_solver "%s" not implemented' % ode_solver
+
+    if ode_cache_size > 0:
+        # reuse the solution when optimization revisits the same rates
+        import ode_cache
+
+        fun = ode_cache.MemoizedODE(fun, ode_cache_size)
 
     @mc.deterministic
     def mu_age_p(logit_C0=logit_C0,
@@ -369,16 +489,40 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
         p[pl.isnan(p)] = 0.
         return p
 
+    def mu_age_p_vjp(adj, logit_C0, i, r, f):
+        if r.min() > 5.99:
+            hazard = r + m_all + f
+            return dict(i=adj/hazard, r=-adj*i/hazard**2, f=-adj*i/hazard**2)
+
+        C0 = mc.invlogit(logit_C0)
+
+        x = pl.hstack((i, r, f, 1-C0, C0))
+        y = fun.forward(0, x)
+
+        susceptible = y[:N]
+        condition = y[N:]
+
+        total = (susceptible + condition)**2
+        w = pl.hstack((-adj*condition/total, adj*susceptible/total))
+        w[pl.isnan(w)] = 0.
+        d_x = fun.reverse(1, w)
+        return dict(i=d_x[:N], r=d_x[N:2*N], f=d_x[2*N:3*N],
+                    logit_C0=(d_x[3*N+1] - d_x[3*N]) * C0 * (1-C0))
+    if ode_solver == 'rk4':
+        # the gradient of the log-posterior uses the reverse mode of the pycppad tape
+        mu_age_p.vjp = mu_age_p_vjp
+
     p = age_specific_rate(model, 'p',
                           reference_area, reference_sex, reference_year,
                           mu_age_p,
                           mu_age_parent=priors.get(('p', 'mu')),
                           sigma_age_parent=priors.get(('p', 'sigma')),
-                          zero_re=zero_re)['p']
+                          zero_re=zero_re, design_cache=design_cache, vectorized_re=vectorized_re, lazy_pred=lazy_pred)['p']
 
     @mc.deterministic
     def mu_age_pf(p=p['mu_age'], f=rate['f']['mu_age']):
         return p*f
+    mu_age_pf.vjp = lambda adj, p, f: dict(p=adj*f, f=adj*p)
     pf = age_specific_rate(model, 'pf',
                            reference_area, reference_sex, reference_year,
                            mu_age_pf,
@@ -386,21 +530,23 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
                            sigma_age_parent=priors.get(('pf', 'sigma')),
                            lower_bound='csmr',
                            include_covariates=False,
-                           zero_re=zero_re)['pf']
+                           zero_re=zero_re, design_cache=design_cache, vectorized_re=vectorized_re, lazy_pred=lazy_pred)['pf']
 
     @mc.deterministic
     def mu_age_m(pf=pf['mu_age'], m_all=m_all):
         return (m_all - pf).clip(1.e-6, 1.e6)
+    mu_age_m.vjp = lambda adj, pf, m_all: dict(pf=-adj*((m_all - pf >= 1.e-6) & (m_all - pf <= 1.e6)))
     rate['m'] = age_specific_rate(model, 'm_wo',
                                   reference_area, reference_sex, reference_year,
                                   mu_age_m,
                                   None, None,
                                   include_covariates=False,
-                                  zero_re=zero_re)['m_wo']
+                                  zero_re=zero_re, design_cache=design_cache, vectorized_re=vectorized_re, lazy_pred=lazy_pred)['m_wo']
 
     @mc.deterministic
     def mu_age_rr(m=rate['m']['mu_age'], f=rate['f']['mu_age']):
         return (m+f) / m
+    mu_age_rr.vjp = lambda adj, m, f: dict(m=-adj*f/m**2, f=adj/m)
     rr = age_specific_rate(model, 'rr',
                            reference_area, reference_sex, reference_year,
                            mu_age_rr,
@@ -408,11 +554,12 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
                            sigma_age_parent=priors.get(('rr', 'sigma')),
                            rate_type='log_normal',
                            include_covariates=False,
-                           zero_re=zero_re)['rr']
+                           zero_re=zero_re, design_cache=design_cache, vectorized_re=vectorized_re, lazy_pred=lazy_pred)['rr']
 
     @mc.deterministic
     def mu_age_smr(m=rate['m']['mu_age'], f=rate['f']['mu_age'], m_all=m_all):
         return (m+f) / m_all
+    mu_age_smr.vjp = lambda adj, m, f, m_all: dict(m=adj/m_all, f=adj/m_all)
     smr = age_specific_rate(model, 'smr',
                             reference_area, reference_sex, reference_year,
                             mu_age_smr,
@@ -420,29 +567,29 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
                             sigma_age_parent=priors.get(('smr', 'sigma')),
                             rate_type='log_normal',
                             include_covariates=False,
-                            zero_re=zero_re)['smr']
+                            zero_re=zero_re, design_cache=design_cache, vectorized_re=vectorized_re, lazy_pred=lazy_pred)['smr']
 
     @mc.deterministic
     def mu_age_m_with(m=rate['m']['mu_age'], f=rate['f']['mu_age']):
         return m+f
+    mu_age_m_with.vjp = lambda adj, m, f: dict(m=adj, f=adj)
     m_with = age_specific_rate(model, 'm_with',
                                reference_area, reference_sex, reference_year,
                                mu_age_m_with,
                                mu_age_parent=priors.get(('m_with', 'mu')),
                                sigma_age_parent=priors.get(('m_with', 'sigma')),
                                include_covariates=False,
-                               zero_re=zero_re)['m_with']
+                               zero_re=zero_re, design_cache=design_cache, vectorized_re=vectorized_re, lazy_pred=lazy_pred)['m_with']
     
     # duration = E[time in bin C]
     @mc.deterministic
     def mu_age_X(r=rate['r']['mu_age'], m=rate['m']['mu_age'], f=rate['f']['mu_age']):
-        hazard = r + m + f
-        pr_not_exit = pl.exp(-hazard)
-        X = pl.empty(len(hazard))
-        X[-1] = 1 / hazard[-1]
-        for i in reversed(range(len(X)-1)):
-            X[i] = pr_not_exit[i] * (X[i+1] + 1) + 1 / hazard[i] * (1 - pr_not_exit[i]) - pr_not_exit[i]
-        return X
+        return duration(r, m, f)
+
+    def mu_age_X_vjp(adj, r, m, f):
+        d_hazard = duration_vjp(adj, r, m, f)
+        return dict(r=d_hazard, m=d_hazard, f=d_hazard)
+    mu_age_X.vjp = mu_age_X_vjp
     X = age_specific_rate(model, 'X',
                           reference_area, reference_sex, reference_year,
                           mu_age_X,
@@ -450,10 +597,14 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
                           sigma_age_parent=priors.get(('X', 'sigma')),
                           rate_type='normal',
                           include_covariates=True,
-                          zero_re=zero_re)['X']
+                          zero_re=zero_re, design_cache=design_cache, vectorized_re=vectorized_re, lazy_pred=lazy_pred)['X']
 
     vars = rate
     vars.update(logit_C0=logit_C0, p=p, pf=pf, rr=rr, smr=smr, m_with=m_with, X=X)
+    if ode_solver == 'rk4' and ode_tolerance != None:
+        vars['p'].update(ode_num_step=num_step, ode_error=ode_error)
+    if ode_cache_size > 0:
+        vars['p']['ode_cache'] = fun
     return vars
 
 
@@ -486,12 +637,10 @@ def effect_priors(model, type):
     
     prior_vals['new_alpha'] = {}
     if 'alpha' in vars:
-        for n, col in zip(vars['alpha'], vars['U'].columns):
-            if isinstance(n, mc.Node):
-                stats = n.stats()
-                if stats:
-                    #prior_vals['new_alpha'][col] = dict(dist='TruncatedNormal', mu=stats['mean'], sigma=stats['standard deviation'], lower=-5., upper=5.)
-                    prior_vals['new_alpha'][col] = dict(dist='Constant', mu=stats['mean'], sigma=stats['standard deviation'])
+        for (stats, value), col in zip(covariate_model.alpha_stats(vars), vars['U'].columns):
+            if stats:
+                #prior_vals['new_alpha'][col] = dict(dist='TruncatedNormal', mu=stats['mean'], sigma=stats['standard deviation'], lower=-5., upper=5.)
+                prior_vals['new_alpha'][col] = dict(dist='Constant', mu=stats['mean'], sigma=stats['standard deviation'])
 
         # uncomment below to save empirical prior on sigma_alpha, the dispersion of the random effects
         for n in vars['sigma_alpha']:
@@ -0,0 +1,174 @@
+""" Gradient of the log-probability of a PyMC model, by reverse mode
+over the nodes between its stochs and its logp terms
+
+Each node on the way gets its derivatives from a rule, which is a
+function of the values of its parents, with the same argument names
+as the function of the node:
+
+  - a stoch or potential has a logp_grad attribute, with
+    stoch.logp_grad(value, **parents) or potential.logp_grad(**parents)
+    returning a dict with the derivative of its logp with respect to
+    its value (key 'value') and to each parent
+  - a deterministic has a vjp attribute, with
+    deterministic.vjp(adj, **parents) returning a dict with the product
+    of adj, the derivative of the logp with respect to its value, and
+    its jacobian with respect to each parent
+
+The model modules set these attributes when they create their nodes,
+and normal, uniform and uninformative stochs have the rules below.
+A parent that is a list of nodes and constants gets entry k of the
+derivative for its k-th element.
+"""
+
+import pylab as pl
+import pymc as mc
+
+
+def normal_grad(x, mu, tau):
+    """ Derivatives of mc.normal_like(x, mu, tau), elementwise
+
+    :Parameters:
+      - `x, mu, tau` : arrays, which are broadcast together
+
+    :Results:
+      - Returns d_x, d_mu, d_tau, arrays with the broadcast shape
+    """
+    x, mu, tau = pl.broadcast_arrays(*[pl.array(y, dtype=float) for y in [x, mu, tau]])
+    r = x - mu
+    return -tau*r, tau*r, .5/tau - .5*r**2
+
+def normal_logp_grad(value, mu, tau):
+    d_x, d_mu, d_tau = normal_grad(value, mu, tau)
+    return dict(value=d_x, mu=d_mu, tau=d_tau)
+
+def uniform_logp_grad(value, lower, upper):
+    value, lower, upper = pl.broadcast_arrays(*[pl.array(y, dtype=float) for y in [value, lower, upper]])
+    return dict(value=pl.zeros(value.shape), lower=1./(upper-lower), upper=-1./(upper-lower))
+
+def uninformative_logp_grad(value):
+    return dict(value=pl.zeros(pl.shape(value)))
+
+builtin_rules = [(mc.Normal, normal_logp_grad),
+                 (mc.Uniform, uniform_logp_grad),
+                 (mc.Uninformative, uninformative_logp_grad)]
+
+def rule(node):
+    """ The gradient rule of a node, or None if it has none"""
+    if isinstance(node, mc.Deterministic):
+        return getattr(node, 'vjp', None)
+    if hasattr(node, 'logp_grad'):
+        return node.logp_grad
+    for cls, func in builtin_rules:
+        if isinstance(node, cls):
+            return func
+    return None
+
+def reduce_to_shape(g, shape):
+    """ Sum the derivative g with respect to a broadcast value down to
+    the shape of the value"""
+    g = pl.array(g, dtype=float)
+    while g.ndim > len(shape):
+        g = g.sum(0)
+    for axis, n in enumerate(shape):
+        if n == 1 and g.shape[axis] != 1:
+            g = g.sum(axis, keepdims=True)
+    return g.reshape(shape)
+
+def parent_nodes(node):
+    """ List the (key, node, k) triples for the parents of node, with
+    k the position of the parent in a list, or None"""
+    results = []
+    for key, parent in node.parents.items():
+        if isinstance(parent, mc.Node):
+            results.append((key, parent, None))
+        elif isinstance(parent, mc.ListContainer):
+            for k, element in enumerate(parent):
+                if isinstance(element, mc.Node):
+                    results.append((key, element, k))
+    return results
+
+class LogpGradient:
+    """ Gradient of the sum of the logp of terms with respect to the
+    values of stochs
+
+    :Parameters:
+      - `stochs` : list of pymc.Stochastics
+      - `terms` : set of pymc.Stochastics and pymc.Potentials, as for pymc.Model.logp
+
+    :Results:
+      - Calling the object returns a list with the derivative for the
+        value of each stoch, with the shape of the value, at the
+        current values of the stochs
+
+    .. note::
+      - only the deterministics that depend on the stochs and the
+        terms that depend on them are visited; the missing attribute
+        lists the names of those which have no rule, and then the
+        gradient is not available
+    """
+    def __init__(self, stochs, terms):
+        self.stochs = list(stochs)
+
+        # the deterministics whose values depend on the stochs
+        dets = set()
+        frontier = list(stochs)
+        while frontier:
+            for child in frontier.pop().children:
+                if isinstance(child, mc.Deterministic) and child not in dets:
+                    dets.add(child)
+                    frontier.append(child)
+        self.depends = set(stochs) | dets
+
+        self.terms = [t for t in terms
+                      if t in self.depends or any([p in self.depends for key, p, k in parent_nodes(t)])]
+
+        # the deterministics in order from the stochs to the terms
+        self.order = []
+        visited = set()
+        def visit(node):
+            for key, p, k in parent_nodes(node):
+                if p in dets and p not in visited:
+                    visited.add(p)
+                    visit(p)
+                    self.order.append(p)
+        for t in self.terms:
+            visit(t)
+
+        # nodes inside containers other than flat lists are not supported
+        self.missing = []
+        for n in self.terms + self.order:
+            hidden = []
+            for p in n.parents.values():
+                for e in isinstance(p, mc.ListContainer) and p or [p]:
+                    if not isinstance(e, mc.Node):
+                        hidden += [v for v in getattr(e, 'variables', []) if v in self.depends]
+            if rule(n) is None or hidden:
+                self.missing.append(n.__name__)
+
+    def __call__(self):
+        assert not self.missing, 'no gradient rule for %s' % ', '.join(self.missing)
+        adj = {}
+        def add(node, g):
+            adj[node] = adj.get(node, 0.) + reduce_to_shape(g, pl.shape(node.value))
+        def send(node, grads):
+            for key, p, k in parent_nodes(node):
+                if p in self.depends:
+                    g = grads[key]
+                    if k is not None:
+                        g = pl.atleast_1d(g)[k]
+                    add(p, g)
+
+        for t in self.terms:
+            if isinstance(t, mc.Stochastic):
+                grads = rule(t)(t.value, **t.parents.value)
+                if t in self.depends:
+                    add(t, grads['value'])
+            else:
+                grads = rule(t)(**t.parents.value)
+            send(t, grads)
+
+        for d in reversed(self.order):
+            if d in adj:
+                send(d, rule(d)(adj[d], **d.parents.value))
+
+        return [adj.get(s, pl.zeros(pl.shape(s.value))) for s in self.stochs]
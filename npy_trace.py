@@ -0,0 +1,314 @@
+""" PyMC database backend that appends the samples of each node in
+chunks to a .npy file, and reads them back through memory maps
+
+Use it as the db of an MCMC, with a directory as the dbname::
+
+    m = mc.MCMC(vars, db=npy_trace, dbname=dir + '/trace')
+
+Each chain is a directory of .npy files, one for each tallied node::
+
+    dbname/
+      Chain_0/
+        <node name>.npy
+        ...
+
+The header of each file is rewritten with the number of samples after
+every chunk, so the files can be loaded with numpy.load at any time,
+and only one chunk of each node is held in memory while sampling
+
+The state of the sampler is saved in dbname/state.pickle at the end of
+each call to sample, and every save_interval iterations, as a
+checkpoint to resume sampling from with load
+"""
+
+import os
+import struct
+import cPickle as pickle
+
+import numpy as np
+from pymc.database import base
+
+import array_trace
+
+CHAIN_NAME = 'Chain_%d'
+STATE_NAME = 'state.pickle'
+
+## fixed size of the .npy header, so that it can be rewritten in place
+HEADER_SIZE = 256
+
+
+def npy_header(dtype, shape):
+    """ Version 1.0 .npy header for an array, padded to HEADER_SIZE
+    bytes, whatever its shape"""
+    d = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), tuple(shape))
+    magic = np.lib.format.magic(1, 0)
+    pad = HEADER_SIZE - len(magic) - 2 - len(d) - 1
+    assert pad >= 0, 'shape too long for .npy header'
+    return magic + struct.pack('<H', len(d) + pad + 1) + d + ' '*pad + '\n'
+
+
+class Trace(base.Trace):
+    """ Trace of one node, stored in one .npy file for each chain"""
+    def _initialize(self, chain, length):
+        base.Trace._initialize(self, chain, length)
+
+        if not hasattr(self, '_buffer'):
+            self._buffer = {}
+            self._length = {}
+        value = np.asarray(self._getfunc())
+        assert value.dtype != object, 'cannot store trace of %s in .npy file' % self.name
+        self._dtype = value.dtype
+        self._shape = value.shape
+
+        self._buffer[chain] = []
+        self._length[chain] = 0
+        f = open(self._path(chain), 'wb')
+        f.write(npy_header(self._dtype, (0,) + self._shape))
+        f.close()
+
+    def _path(self, chain):
+        return os.path.join(self.db._directory, CHAIN_NAME % chain, self.name + '.npy')
+
+    def tally(self, chain):
+        """ Store the current value of the node, and append the chunk of
+        stored values to the file of the chain if it is full"""
+        self._buffer[chain].append(np.array(self._getfunc(), dtype=self._dtype))
+        if len(self._buffer[chain]) >= self.db.chunk:
+            self._flush(chain)
+
+    def _flush(self, chain):
+        buffer = self._buffer[chain]
+        if len(buffer) == 0:
+            return
+
+        f = open(self._path(chain), 'r+b')
+        f.seek(HEADER_SIZE + self._length[chain] * self._itemsize())
+        f.write(np.array(buffer, dtype=self._dtype).tostring())
+        self._length[chain] += len(buffer)
+        f.seek(0)
+        f.write(npy_header(self._dtype, (self._length[chain],) + self._shape))
+        f.close()
+        self._buffer[chain] = []
+
+    def _itemsize(self):
+        return self._dtype.itemsize * int(np.prod(self._shape))
+
+    def _finalize(self, chain):
+        self._flush(chain)
+
+    def _load(self, chain, length=None):
+        """ Set up the trace of a chain from its file, keeping at most
+        length samples"""
+        if not hasattr(self, '_buffer'):
+            self._buffer = {}
+            self._length = {}
+        f = open(self._path(chain), 'rb')
+        version = np.lib.format.read_magic(f)
+        shape, fortran_order, self._dtype = np.lib.format.read_array_header_1_0(f)
+        f.close()
+        self._shape = shape[1:]
+
+        self._buffer[chain] = []
+        self._length[chain] = shape[0]
+        if length is not None and length < shape[0]:
+            self.truncate(length, chain)
+
+    def truncate(self, index, chain):
+        """ Remove the samples after index from the file of a chain"""
+        self._flush(chain)
+        self._length[chain] = min(index, self._length[chain])
+        f = open(self._path(chain), 'r+b')
+        f.write(npy_header(self._dtype, (self._length[chain],) + self._shape))
+        f.truncate(HEADER_SIZE + self._length[chain] * self._itemsize())
+        f.close()
+
+    def _chain_array(self, chain):
+        """ Return the samples of a chain as a read-only memory map"""
+        self._flush(chain)
+        if self._length[chain] == 0:
+            # an empty file cannot be memory mapped
+            return np.zeros((0,) + self._shape, self._dtype)
+        return np.load(self._path(chain), mmap_mode='r')
+
+    def gettrace(self, burn=0, thin=1, chain=-1, slicing=None):
+        """ Return the samples, see pymc.database.ram.Trace.gettrace
+
+        :Results:
+          - a memory map of the samples of one chain, or an array of all
+            chains if chain is None and there is more than one chain
+        """
+        if slicing is None:
+            slicing = slice(burn, None, thin)
+        if chain is None and self.db.chains == 1:
+            chain = 0
+        if chain is not None:
+            chain = range(self.db.chains)[chain]
+            return self._chain_array(chain)[slicing]
+        return np.concatenate([self._chain_array(c) for c in range(self.db.chains)])[slicing]
+
+    def __call__(self, burn=0, thin=1, chain=-1, slicing=None):
+        """ Return the samples of the chain the trace was fetched for,
+        as in m.trace('x', chain=0)(), unless another chain is given"""
+        if chain == -1:
+            chain = self._chain
+        return self.gettrace(burn, thin, chain, slicing)
+
+    def __getitem__(self, index):
+        return self.gettrace(chain=self._chain)[index]
+
+    def stats(self, alpha=0.05, start=0, batches=100, chain=None, quantiles=(2.5, 25, 50, 75, 97.5)):
+        """ Generate posterior statistics of the samples, see
+        pymc.Node.stats
+
+        Only the samples from index start on, counted through the chains
+        in order, are copied out of the memory maps
+        """
+        if chain is not None:
+            chains = [range(self.db.chains)[chain]]
+        else:
+            chains = range(self.db.chains)
+
+        trace = []
+        for c in chains:
+            x = self._chain_array(c)
+            trace.append(x[start:])
+            start = max(0, start - len(x))
+        if len(trace) == 1:
+            trace = trace[0]
+        else:
+            trace = np.concatenate(trace)
+        return array_trace.trace_stats(trace, alpha=alpha, batches=batches, quantiles=quantiles)
+
+    def length(self, chain=-1):
+        if chain is not None:
+            chain = range(self.db.chains)[chain]
+            return self._length[chain] + len(self._buffer[chain])
+        return sum([self.length(c) for c in range(self.db.chains)])
+
+
+class Database(base.Database):
+    """ Database of traces stored in .npy files in the directory dbname
+
+    :Parameters:
+      - `dbname` : str, the directory, which is created if it does not exist
+      - `dbchunk` : int, optional, the number of samples of each node to
+        hold in memory before appending them to its file
+    """
+    def __init__(self, dbname, dbchunk=100):
+        self.__Trace__ = Trace
+        self.__name__ = 'npy_trace'
+        self.dbname = dbname
+        self._directory = dbname
+        self.chunk = dbchunk
+        self.trace_names = []
+        self._traces = {}
+        self.chains = 0
+        self._resume = False
+
+        ## the iterations, burn-in and thinning of the run, saved with
+        ## each checkpoint, see fit_model.resume_sampling
+        self.run = None
+
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory)
+
+    def _initialize(self, funs_to_tally, length=None):
+        """ Create the directory of a new chain, and initialize its
+        traces, or continue the last chain, if it was loaded from a
+        checkpoint"""
+        if self._resume:
+            self._resume = False
+            for name, fun in funs_to_tally.items():
+                self._traces[name]._getfunc = fun
+            return
+
+        path = os.path.join(self._directory, CHAIN_NAME % self.chains)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        base.Database._initialize(self, funs_to_tally, length)
+
+    def savestate(self, state):
+        """ Save a checkpoint of the sampler, with the number of samples
+        of each trace of the last chain, which are flushed to their
+        files first, and the state of the numpy random number
+        generator"""
+        state = dict(state)
+        state['rng'] = np.random.get_state()
+        state['run'] = self.run
+        if self.chains > 0:
+            chain = self.chains - 1
+            for name in self.trace_names[chain]:
+                self._traces[name]._flush(chain)
+            state['chain'] = chain
+            state['length'] = dict([[name, self._traces[name]._length[chain]] for name in self.trace_names[chain]])
+        self._state_ = state
+
+        # write the whole file before replacing the last checkpoint
+        path = os.path.join(self._directory, STATE_NAME)
+        f = open(path + '.tmp', 'wb')
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(path + '.tmp', path)
+
+    def discard_chains(self, start):
+        """ Remove the chains from index start on, and their files"""
+        for chain in range(start, self.chains):
+            for trace in self._traces.values():
+                if chain in trace._length:
+                    os.remove(trace._path(chain))
+                    trace._buffer.pop(chain)
+                    trace._length.pop(chain)
+            path = os.path.join(self._directory, CHAIN_NAME % chain)
+            if os.path.exists(path) and not os.listdir(path):
+                os.rmdir(path)
+        del self.trace_names[start:]
+        self.chains = start
+
+
+def has_checkpoint(dbname):
+    """ Check if a directory has a checkpoint to resume sampling from"""
+    return os.path.exists(os.path.join(dbname, STATE_NAME))
+
+def load(dbname, dbchunk=100):
+    """ Load a database from the files of a directory, with the
+    traces and sampler state of its last checkpoint
+
+    :Parameters:
+      - `dbname` : str, a directory with a checkpoint, see has_checkpoint
+      - `dbchunk` : int, optional, see Database
+
+    :Results:
+      - Returns a Database, which the MCMC it is given to will restore
+        the state of its stochs and step methods from, and which will
+        continue the checkpointed chain the next time it is sampled
+
+    .. note::
+      - samples saved after the checkpoint are removed from the files,
+        so that the traces match the state of the sampler
+      - chains after the checkpointed one are discarded
+      - the state of the random number generator is in
+        db.getstate()['rng'], and is not restored here
+    """
+    assert has_checkpoint(dbname), 'no checkpoint in %s' % dbname
+    db = Database(dbname, dbchunk)
+    f = open(os.path.join(dbname, STATE_NAME), 'rb')
+    db._state_ = pickle.load(f)
+    f.close()
+    db.run = db._state_.get('run')
+
+    last = db._state_.get('chain', -1)
+    for chain in range(last + 1):
+        path = os.path.join(dbname, CHAIN_NAME % chain)
+        names = sorted([f[:-4] for f in os.listdir(path) if f.endswith('.npy')])
+        for name in names:
+            if name not in db._traces:
+                db._traces[name] = Trace(name=name, db=db)
+            if chain == last:
+                db._traces[name]._load(chain, db._state_['length'].get(name, 0))
+            else:
+                db._traces[name]._load(chain)
+        db.trace_names.append(names)
+        db.chains += 1
+
+    db._resume = db.chains > 0
+    return db
@@ -0,0 +1,69 @@
+""" Bounded cache of ODE solutions"""
+
+import collections
+
+import pylab as pl
+
+
+class MemoizedODE:
+    """ Least-recently-used cache around the zero order forward mode of
+    an ODE function object, such as the one from
+    dismod_ode.ode_function or closed_form_ode.ode_function
+
+    :Parameters:
+      - `fun` : function object with a forward(p, x) method, and a
+        reverse(p, w) method for the first order reverse mode
+      - `maxsize` : int, the number of solutions to keep
+
+    .. note::
+      - the cache is keyed on the bytes of x, so only identical rate
+        vectors are hits, and the hits and misses attributes count the
+        forward calls that were and were not found in the cache
+      - a pycppad function object keeps the Taylor coefficients of the
+        last forward call, and a hit does not update them, so only zero
+        order forward mode is cached, and reverse runs fun forward again
+        at the last x first if a hit left the coefficients stale
+    """
+    def __init__(self, fun, maxsize=100):
+        self.fun = fun
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        """ Empty the cache and reset the counters"""
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.x = None
+        self.x_taped = None
+
+    def forward(self, p, x):
+        """ Zero order forward mode, y = f(x)"""
+        assert p == 0, 'only zero order forward mode is cached'
+
+        key = pl.array(x, dtype=float).tostring()
+        self.x = key
+        if key in self.cache:
+            self.hits += 1
+            y = self.cache.pop(key)
+        else:
+            self.misses += 1
+            y = pl.array(self.fun.forward(0, x))
+            self.x_taped = key
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(last=False)
+
+        # most recently used at the end
+        self.cache[key] = y
+        return y.copy()
+
+    def reverse(self, p, w):
+        """ First order reverse mode, w^T times the jacobian of f at the
+        x of the last forward call"""
+        assert p == 1, 'only first order reverse mode is available'
+        assert self.x is not None, 'reverse needs a forward call first'
+
+        if self.x_taped != self.x:
+            self.fun.forward(0, pl.frombuffer(self.x, dtype=float))
+            self.x_taped = self.x
+        return pl.array(self.fun.reverse(1, w))
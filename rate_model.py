@@ -1,10 +1,278 @@
 """ Several rate models"""
 
+import inspect
+
 import pylab as pl
 import pymc as mc
+import scipy.special
+
+import array_trace
+import logp_gradient
+
+
+def observed_index(mask):
+    """ Index selecting the rows where mask is True, or a full slice
+    if the mask keeps every row (which avoids a copy in the likelihood)
+
+    :Parameters:
+      - `mask` : array of bools
+
+    :Results:
+      - Returns a slice or an array of row indices
+    """
+    mask = pl.array(mask, dtype=bool)
+    if pl.all(mask):
+        return slice(None)
+    return pl.where(mask)[0]
+
+
+def factln(x):
+    """ Log of x factorial, as used in the pymc likelihoods"""
+    return scipy.special.gammaln(pl.array(x, dtype=float) + 1.)
+
+
+def normal_loglik(x, mu, tau, c):
+    """ Fused normal log-likelihood, equivalent to mc.normal_like(x, mu, tau)
+
+    :Parameters:
+      - `x` : array, observed values
+      - `mu` : array, expected values
+      - `tau` : array, precisions
+      - `c` : float, the constant -.5*len(x)*log(2*pi), computed once at model build
+
+    :Results:
+      - Returns the log-likelihood, or -inf if any precision is non-positive or infinite
+    """
+    if pl.any(tau <= 0.) or pl.any(pl.isinf(tau)):
+        return -pl.inf
+    return -.5*pl.dot(tau, (x-mu)**2.) + .5*pl.log(tau).sum() + c
+
+
+def binomial_counts(p, n):
+    """ Observed successes and failures of the rows with n>0, with
+    counts truncated to integers as pymc does
+
+    :Parameters:
+      - `p` : array, observed values of rates
+      - `n` : array, effective sample sizes of rates
+
+    :Results:
+      - Returns (i, k, k_c, c), the row index, successes, failures
+        and the data-only binomial coefficients sum(factln(n) - factln(k) - factln(n-k))
+    """
+    n = pl.array(n, dtype=int)
+    i = observed_index(n != 0)
+    k = pl.array(pl.array(p, dtype=float)[i]*n[i], dtype=int)
+    k_c = n[i] - k
+    return i, k, k_c, (factln(n[i]) - factln(k) - factln(k_c)).sum()
+
+
+def binomial_loglik(k, k_c, q, c):
+    """ Fused binomial log-likelihood, equivalent to mc.binomial_like(k, k+k_c, q)
+
+    :Parameters:
+      - `k` : array of ints, observed successes
+      - `k_c` : array of ints, observed failures
+      - `q` : array, probabilities of success
+      - `c` : float, the data-only binomial coefficients sum(factln(n) - factln(k) - factln(n-k))
+
+    :Results:
+      - Returns the log-likelihood
+
+    :Notes:
+      - When any q is outside (0,1) this defers to pymc, which
+        handles the boundary cases
+    """
+    if pl.any(q <= 0.) or pl.any(q >= 1.):
+        return mc.binomial_like(k, k+k_c, q)
+    return pl.dot(k, pl.log(q)) + pl.dot(k_c, pl.log(1.-q)) + c
+
+
+def beta_binomial_loglik(k, k_c, alpha, beta, c):
+    """ Fused beta-binomial log-likelihood, equivalent to
+    mc.betabin_like(k, alpha, beta, k+k_c)
+
+    :Parameters:
+      - `k` : array of ints, observed successes
+      - `k_c` : array of ints, observed failures
+      - `alpha`, `beta` : arrays, parameters of the beta distributed success probabilities
+      - `c` : float, the data-only binomial coefficients sum(factln(n) - factln(k) - factln(n-k))
+
+    :Results:
+      - Returns the log-likelihood
+
+    :Notes:
+      - When any alpha or beta is non-positive this defers to pymc,
+        which handles the boundary cases
+    """
+    if pl.any(alpha <= 0.) or pl.any(beta <= 0.):
+        return mc.betabin_like(k, alpha, beta, k+k_c)
+    gammaln = scipy.special.gammaln
+    return (gammaln(alpha + k) + gammaln(beta + k_c) - gammaln(alpha) - gammaln(beta)
+            + gammaln(alpha + beta) - gammaln(alpha + beta + k + k_c)).sum() + c
+
+
+class BetaBinomialGibbs(mc.Gibbs):
+    """ Blocked Gibbs step for the array of latent rates in a
+    beta-binomial model, which draws every row from its conjugate
+    posterior, Beta(pi*p_n + k, (1-pi)*p_n + n - k), in a single
+    vectorized call
+
+    :Parameters:
+      - `stochastic` : pymc.Stochastic, the latent rates
+      - `pi` : pymc.Node, expected values of rates
+      - `p_n` : pymc.Node, precision of the latent rates
+      - `p_obs` : pymc.Stochastic, the binomial observations of the latent rates
+    """
+    def __init__(self, stochastic, pi, p_n, p_obs, verbose=-1):
+        mc.Gibbs.__init__(self, stochastic, verbose=verbose)
+        self.conjugate = True
+        self.pi = pi
+        self.p_n = p_n
 
+        n = pl.array(p_obs.parents['n'], dtype=int)
+        self.k = pl.array(pl.array(p_obs.value, dtype=float)*n, dtype=int)
+        self.k_c = n - self.k
 
-def binom(name, pi, p, n):
+    def propose(self):
+        pi = pl.array(mc.utils.value(self.pi), dtype=float)
+        p_n = mc.utils.value(self.p_n)
+        self.stochastic.value = mc.np.random.beta(pi*p_n + self.k, (1.-pi)*p_n + self.k_c)
+
+
+def normal_constant(x):
+    """ Data-only part of the normal log-likelihood of observations x"""
+    return -.5*len(x)*pl.log(2.*pl.pi)
+
+
+def negative_binomial_loglik(x, mu, alpha, c):
+    """ Fused negative binomial log-likelihood, equivalent to
+    mc.negative_binomial_like(x, mu, alpha)
+
+    :Parameters:
+      - `x` : array of ints, observed counts
+      - `mu` : array, expected counts
+      - `alpha` : float or array, dispersion parameters
+      - `c` : float, the data-only term sum(factln(x)), computed once at model build
+
+    :Results:
+      - Returns the log-likelihood, or -inf if any mu or alpha is non-positive
+
+    :Notes:
+      - When any alpha exceeds 1.e10 this defers to pymc, which
+        switches to the poisson likelihood for those rows
+    """
+    if pl.any(mu <= 0.) or pl.any(alpha <= 0.):
+        return -pl.inf
+    if pl.any(alpha > 1.e10):
+        return mc.negative_binomial_like(x, mu, alpha)
+
+    r = mu / alpha
+    log1p_r = pl.log1p(r)
+    if pl.shape(alpha) == ():
+        alpha_terms = -len(x)*scipy.special.gammaln(alpha) - alpha*log1p_r.sum()
+    else:
+        alpha_terms = -scipy.special.gammaln(alpha).sum() - pl.dot(alpha, log1p_r)
+    return scipy.special.gammaln(x + alpha).sum() + pl.dot(x, pl.log(r) - log1p_r) + alpha_terms - c
+
+
+def negative_binomial_grad(x, mu, alpha):
+    """ Derivatives of mc.negative_binomial_like(x, mu, alpha), elementwise
+
+    :Parameters:
+      - `x` : array of ints, observed counts
+      - `mu` : array, expected counts
+      - `alpha` : float or array, dispersion parameters
+
+    :Results:
+      - Returns d_mu, d_alpha, arrays with the broadcast shape
+
+    .. note::
+      - rows with alpha exceeding 1.e10 have the derivatives of the
+        poisson likelihood, as pymc switches to it for those rows
+    """
+    x, mu, alpha = pl.broadcast_arrays(*[pl.array(y, dtype=float) for y in [x, mu, alpha]])
+    poisson = alpha > 1.e10
+    alpha = pl.where(poisson, 1., alpha)
+    d_mu = pl.where(poisson, x/mu - 1., x/mu - (x+alpha)/(alpha+mu))
+    d_alpha = pl.where(poisson, 0., scipy.special.psi(x+alpha) - scipy.special.psi(alpha)
+                       - pl.log1p(mu/alpha) + (mu-x)/(alpha+mu))
+    return d_mu, d_alpha
+
+
+class PosteriorPredictive:
+    """ Posterior-predictive draws of a rate model, generated in one
+    vectorized pass over the saved traces of the parents after
+    sampling, instead of by a deterministic at every MCMC iteration
+
+    Supports the parts of the pymc.Node interface used after fitting:
+    .trace() returns an array with one row per saved sample, and
+    .stats() summarizes it like pymc.Node.stats
+
+    :Parameters:
+      - `name` : str
+      - `func` : function drawing predictions elementwise from its
+        parents, which are given as default values of its arguments
+    """
+    def __init__(self, name, func):
+        self.__name__ = name
+        self.func = func
+
+        args, varargs, varkw, defaults = inspect.getargspec(func)
+        self.parents = dict(zip(args, defaults))
+
+        self.draws = None
+        self.draws_key = None
+
+    def __repr__(self):
+        return '<PosteriorPredictive %s>' % self.__name__
+
+    def trace(self, *args, **kwargs):
+        """ Return array of posterior-predictive draws, one row for
+        each saved sample of the parents; arguments are passed on to
+        the trace of each parent node"""
+        values = {}
+        fingerprint = []
+        for key, parent in self.parents.items():
+            if isinstance(parent, mc.Node):
+                t = pl.array(parent.trace(*args, **kwargs), dtype=float)
+                fingerprint.append((key, id(parent), t.shape, hash(t.tostring())))
+                # one column per sample, so scalar parents broadcast across rows
+                values[key] = t.reshape((len(t), -1))
+            else:
+                values[key] = pl.atleast_1d(parent)
+
+        # draws are random, so reuse them while the traces of the
+        # parents are unchanged, to keep .trace() and .stats()
+        # consistent; the key is the content of the traces, not the
+        # arguments, so a refit with the same number of samples
+        # draws again, and trace() and stats(chain=None) of a single
+        # chain share their draws
+        key = tuple(sorted(fingerprint))
+        if key != self.draws_key:
+            keys = values.keys()
+            broadcast = pl.broadcast_arrays(*[values[k] for k in keys])
+            shape = broadcast[0].shape
+            flat = dict([[k, pl.ravel(b)] for k, b in zip(keys, broadcast)])
+            self.draws = pl.reshape(self.func(**flat), shape)
+            self.draws_key = key
+        return self.draws
+
+    def stats(self, alpha=0.05, start=0, batches=100, chain=None, quantiles=(2.5, 25, 50, 75, 97.5)):
+        """ Generate posterior statistics of the draws, see pymc.Node.stats"""
+        return array_trace.trace_stats(self.trace(chain=chain), alpha=alpha, start=start,
+                                       batches=batches, quantiles=quantiles)
+
+
+def predictive(name, lazy_pred=False):
+    """ Decorator for the p_pred of a rate model, which makes either a
+    pymc deterministic or a PosteriorPredictive"""
+    if lazy_pred:
+        return lambda func: PosteriorPredictive(name, func)
+    return mc.deterministic(name=name)
+
+
+def binom(name, pi, p, n, lazy_pred=False):
     """ Generate PyMC objects for a binomial model
 
     :Parameters:
@@ -12,6 +280,8 @@ def binom(name, pi, p, n):
       - `pi` : pymc.Node, expected values of rates
       - `p` : array, observed values of rates
       - `n` : array, effective sample sizes of rates
+      - `lazy_pred` : bool, optional, if True 'p_pred' is a PosteriorPredictive, which draws
+        from the saved traces after sampling, instead of a deterministic drawn at every iteration
 
     :Results:
       - Returns dict of PyMC objects, including 'p_obs' and 'p_pred' the observed stochastic likelihood and data predicted stochastic
@@ -20,21 +290,30 @@ def binom(name, pi, p, n):
     assert pl.all(p >= 0), 'observed values must be non-negative'
     assert pl.all(n >= 0), 'effective sample size must non-negative'
 
+    # precompute the integer counts (truncated, as pymc does), and the
+    # data-only binomial coefficients; rows with n=0 contribute
+    # nothing as long as pi is in [0,1]
+    i, k_i, k_c_i, c = binomial_counts(p, n)
+    valid_data = pl.all(k_c_i >= 0)
+
     @mc.observed(name='p_obs_%s'%name)
     def p_obs(value=p, pi=pi, n=n):
-        return mc.binomial_like(value*n, n, pi+1.e-9)
+        q = pi + 1.e-9
+        if not valid_data or pl.any(q < 0.) or pl.any(q > 1.):
+            return -pl.inf
+        return binomial_loglik(k_i, k_c_i, q[i], c)
 
     # for any observation with n=0, make predictions for n=1.e6, to use for predictive validity
     n_nonzero = pl.array(n.copy(), dtype=int)
     n_nonzero[n==0] = 1.e6
-    @mc.deterministic(name='p_pred_%s'%name)
+    @predictive('p_pred_%s'%name, lazy_pred)
     def p_pred(pi=pi, n=n_nonzero):
         return mc.rbinomial(n, pi+1.e-9) / (1.*n)
 
     return dict(p_obs=p_obs, p_pred=p_pred)
 
 
-def beta_binom(name, pi, p, n):
+def beta_binom(name, pi, p, n, collapsed=False, lazy_pred=False):
     """ Generate PyMC objects for a beta-binomial model
 
     :Parameters:
@@ -42,34 +321,61 @@ def beta_binom(name, pi, p, n):
       - `pi` : pymc.Node, expected values of rates
       - `p` : array, observed values of rates
       - `n` : array, effective sample sizes of rates
+      - `collapsed` : bool, optional, if True integrate out the latent
+        rates and use the beta-binomial likelihood directly
+      - `lazy_pred` : bool, optional, if True 'p_pred' is a PosteriorPredictive, which draws
+        from the saved traces after sampling, instead of a deterministic drawn at every iteration
 
     :Results:
       - Returns dict of PyMC objects, including 'p_obs' and 'p_pred' the observed stochastic likelihood and data predicted stochastic
 
+    :Notes:
+      - Unless `collapsed` is True, the latent rates are a single
+        array-valued stochastic 'pi_latent', which should be sampled
+        with the blocked step method BetaBinomialGibbs
+
     """
     assert pl.all(p >= 0), 'observed values must be non-negative'
     assert pl.all(n >= 0), 'effective sample size must non-negative'
 
     p_n = mc.Uniform('p_n_%s'%name, lower=1.e4, upper=1.e9, value=1.e4)  # convergence requires getting these bounds right
-    pi_latent = [mc.Beta('pi_latent_%s_%d'%(name,i), pi[i]*p_n, (1-pi[i])*p_n, value=pi_i) for i, pi_i in enumerate(pi.value)]
 
-    i_nonzero = (n!=0.)
-    @mc.observed(name='p_obs_%s'%name)
-    def p_obs(value=p, pi=pi_latent, n=n):
-        pi_flat = pl.array(pi)
-        return mc.binomial_like((value*n)[i_nonzero], n[i_nonzero], pi_flat[i_nonzero])
+    i, k_i, k_c_i, c = binomial_counts(p, n)
+    valid_data = pl.all(k_c_i >= 0)
 
     # for any observation with n=0, make predictions for n=1.e6, to use for predictive validity
     n_nonzero = pl.array(n.copy(), dtype=int)
     n_nonzero[n==0] = 1.e6
-    @mc.deterministic(name='p_pred_%s'%name)
+
+    if collapsed:
+        @mc.observed(name='p_obs_%s'%name)
+        def p_obs(value=p, pi=pi, p_n=p_n, n=n):
+            if not valid_data:
+                return -pl.inf
+            return beta_binomial_loglik(k_i, k_c_i, pi[i]*p_n, (1.-pi[i])*p_n, c)
+
+        @predictive('p_pred_%s'%name, lazy_pred)
+        def p_pred(pi=pi, p_n=p_n, n=n_nonzero):
+            return mc.rbinomial(n, mc.np.random.beta(pi*p_n, (1.-pi)*p_n)) / (1.*n)
+
+        return dict(p_n=p_n, p_obs=p_obs, p_pred=p_pred)
+
+    pi_latent = mc.Beta('pi_latent_%s'%name, pi*p_n, (1-pi)*p_n, value=pi.value)
+
+    @mc.observed(name='p_obs_%s'%name)
+    def p_obs(value=p, pi=pi_latent, n=n):
+        if not valid_data:
+            return -pl.inf
+        return binomial_loglik(k_i, k_c_i, pi[i], c)
+
+    @predictive('p_pred_%s'%name, lazy_pred)
     def p_pred(pi=pi_latent, n=n_nonzero):
         return mc.rbinomial(n, pi) / (1.*n)
 
     return dict(p_n=p_n, pi_latent=pi_latent, p_obs=p_obs, p_pred=p_pred)
 
 
-def poisson(name, pi, p, n):
+def poisson(name, pi, p, n, lazy_pred=False):
     """ Generate PyMC objects for a poisson model
 
     :Parameters:
@@ -77,6 +383,8 @@ def poisson(name, pi, p, n):
       - `pi` : pymc.Node, expected values of rates
       - `p` : array, observed values of rates
       - `n` : array, effective sample sizes of rates
+      - `lazy_pred` : bool, optional, if True 'p_pred' is a PosteriorPredictive, which draws
+        from the saved traces after sampling, instead of a deterministic drawn at every iteration
 
     :Results:
       - Returns dict of PyMC objects, including 'p_obs' and 'p_pred' the observed stochastic likelihood and data predicted stochastic
@@ -85,22 +393,30 @@ def poisson(name, pi, p, n):
     assert pl.all(p >= 0), 'observed values must be non-negative'
     assert pl.all(n >= 0), 'effective sample size must non-negative'
 
-    i_nonzero = (n!=0.)
+    # precompute the observed counts (truncated, as pymc does) and sum(factln(k))
+    i = observed_index(n != 0.)
+    n_i = pl.array(n, dtype=float)[i]
+    k_i = pl.array(pl.array(p, dtype=float)[i]*n_i, dtype=int)
+    c = factln(k_i).sum()
+
     @mc.observed(name='p_obs_%s'%name)
     def p_obs(value=p, pi=pi, n=n):
-        return mc.poisson_like((value*n)[i_nonzero], (pi*n)[i_nonzero])
+        mu = pi[i]*n_i
+        if pl.any(mu <= 0.):
+            return mc.poisson_like(k_i, mu)
+        return pl.dot(k_i, pl.log(mu)) - mu.sum() - c
 
     # for any observation with n=0, make predictions for n=1.e6, to use for predictive validity
     n_nonzero = pl.array(n.copy(), dtype=float)
     n_nonzero[n==0.] = 1.e6
-    @mc.deterministic(name='p_pred_%s'%name)
+    @predictive('p_pred_%s'%name, lazy_pred)
     def p_pred(pi=pi, n=n_nonzero):
         return mc.rpoisson((pi*n).clip(1.e-9, pl.inf)) / (1.*n)
 
     return dict(p_obs=p_obs, p_pred=p_pred)
 
 
-def neg_binom(name, pi, delta, p, n):
+def neg_binom(name, pi, delta, p, n, lazy_pred=False):
     """ Generate PyMC objects for a negative binomial model
 
     :Parameters:
@@ -109,6 +425,8 @@ def neg_binom(name, pi, delta, p, n):
       - `delta` : pymc.Node, dispersion parameters of rates
       - `p` : array, observed values of rates
       - `n` : array, effective sample sizes of rates
+      - `lazy_pred` : bool, optional, if True 'p_pred' is a PosteriorPredictive, which draws
+        from the saved traces after sampling, instead of a deterministic drawn at every iteration
 
     :Results:
       - Returns dict of PyMC objects, including 'p_obs' and 'p_pred' the observed stochastic likelihood and data predicted stochastic
@@ -119,20 +437,41 @@ def neg_binom(name, pi, delta, p, n):
 
     i_zero = (n==0.)
 
+    # precompute the observed counts (truncated, as pymc does) and sum(factln(k))
+    i = observed_index(~i_zero)
+    n_i = pl.array(n, dtype=float)[i]
+    k_i = pl.array(pl.array(p, dtype=float)[i]*n_i, dtype=int)
+    c = factln(k_i).sum()
+
     if (isinstance(delta, mc.Node) and pl.shape(delta.value) == ()) \
             or (not isinstance(delta, mc.Node) and pl.shape(delta) == ()): # delta is a scalar
         @mc.observed(name='p_obs_%s'%name)
         def p_obs(value=p, pi=pi, delta=delta, n=n):
-            return mc.negative_binomial_like(value[~i_zero]*n[~i_zero], pi[~i_zero]*n[~i_zero]+1.e-9, delta)
+            return negative_binomial_loglik(k_i, pi[i]*n_i+1.e-9, delta, c)
+
+        def p_obs_grad(value, pi, delta, n):
+            d_mu, d_delta = negative_binomial_grad(k_i, pi[i]*n_i+1.e-9, delta)
+            d_pi = pl.zeros(len(pi))
+            d_pi[i] = d_mu * n_i
+            return dict(pi=d_pi, delta=d_delta.sum())
     else:
         @mc.observed(name='p_obs_%s'%name)
         def p_obs(value=p, pi=pi, delta=delta, n=n):
-            return mc.negative_binomial_like(value[~i_zero]*n[~i_zero], pi[~i_zero]*n[~i_zero]+1.e-9, delta[~i_zero])
+            return negative_binomial_loglik(k_i, pi[i]*n_i+1.e-9, delta[i], c)
+
+        def p_obs_grad(value, pi, delta, n):
+            d_mu, d_delta_i = negative_binomial_grad(k_i, pi[i]*n_i+1.e-9, delta[i])
+            d_pi = pl.zeros(len(pi))
+            d_pi[i] = d_mu * n_i
+            d_delta = pl.zeros(len(delta))
+            d_delta[i] = d_delta_i
+            return dict(pi=d_pi, delta=d_delta)
+    p_obs.logp_grad = p_obs_grad
 
     # for any observation with n=0, make predictions for n=1.e9, to use for predictive validity
     n_nonzero = n.copy()
     n_nonzero[i_zero] = 1.e9
-    @mc.deterministic(name='p_pred_%s'%name)
+    @predictive('p_pred_%s'%name, lazy_pred)
     def p_pred(pi=pi, delta=delta, n=n_nonzero):
         return mc.rnegative_binomial(pi*n+1.e-9, delta) / pl.array(n+1.e-9, dtype=float)
 
@@ -162,10 +501,17 @@ def neg_binom_lower_bound_model(name, pi, delta, p, n):
     def p_obs(value=p, pi=pi, delta=delta, n=n):
         return mc.negative_binomial_like(pl.maximum(value*n, pi*n), pi*n+1.e-9, delta)
 
+    # pymc truncates the counts to integers, so they do not add to the derivative for pi
+    def p_obs_grad(value, pi, delta, n):
+        x = pl.array(pl.maximum(value*n, pi*n), dtype=int)
+        d_mu, d_delta = negative_binomial_grad(x, pi*n+1.e-9, delta)
+        return dict(pi=d_mu * n, delta=d_delta)
+    p_obs.logp_grad = p_obs_grad
+
     return dict(p_obs=p_obs)
 
 
-def normal_model(name, pi, sigma, p, s):
+def normal_model(name, pi, sigma, p, s, lazy_pred=False):
     """ Generate PyMC objects for a normal model
 
     :Parameters:
@@ -174,6 +520,8 @@ def normal_model(name, pi, sigma, p, s):
       - `sigma` : pymc.Node, dispersion parameters of rates
       - `p` : array, observed values of rates
       - `s` : array, standard error of rates
+      - `lazy_pred` : bool, optional, if True 'p_pred' is a PosteriorPredictive, which draws
+        from the saved traces after sampling, instead of a deterministic drawn at every iteration
 
     :Results:
       - Returns dict of PyMC objects, including 'p_obs' and 'p_pred' the observed stochastic likelihood and data predicted stochastic
@@ -182,20 +530,33 @@ def normal_model(name, pi, sigma, p, s):
     assert pl.all(s >= 0), 'standard error must be non-negative'
 
     i_inf = pl.isinf(s)
+    i = observed_index(~i_inf)
+    x_i = pl.array(p, dtype=float)[i]
+    s2_i = pl.array(s, dtype=float)[i]**2.
+    c = normal_constant(x_i)
+
     @mc.observed(name='p_obs_%s'%name)
     def p_obs(value=p, pi=pi, sigma=sigma, s=s):
-        return mc.normal_like(value[~i_inf], pi[~i_inf], 1./(sigma**2. + s[~i_inf]**2.))
+        return normal_loglik(x_i, pi[i], 1./(sigma**2. + s2_i), c)
+
+    def p_obs_grad(value, pi, sigma, s):
+        tau = 1./(sigma**2. + s2_i)
+        d_x, d_mu, d_tau = logp_gradient.normal_grad(x_i, pi[i], tau)
+        d_pi = pl.zeros(len(pi))
+        d_pi[i] = d_mu
+        return dict(pi=d_pi, sigma=pl.sum(d_tau * -2.*sigma*tau**2.))
+    p_obs.logp_grad = p_obs_grad
 
     s_noninf = s.copy()
     s_noninf[i_inf] = 0.    
-    @mc.deterministic(name='p_pred_%s'%name)
+    @predictive('p_pred_%s'%name, lazy_pred)
     def p_pred(pi=pi, sigma=sigma, s=s_noninf):
         return mc.rnormal(pi, 1./(sigma**2. + s**2.))
 
     return dict(p_obs=p_obs, p_pred=p_pred)
 
 # FIXME: negative ESS
-def log_normal_model(name, pi, sigma, p, s):
+def log_normal_model(name, pi, sigma, p, s, lazy_pred=False):
     """ Generate PyMC objects for a lognormal model
 
     :Parameters:
@@ -204,6 +565,8 @@ def log_normal_model(name, pi, sigma, p, s):
       - `sigma` : pymc.Node, dispersion parameters of rates
       - `p` : array, observed values of rates
       - `s` : array, standard error sizes of rates
+      - `lazy_pred` : bool, optional, if True 'p_pred' is a PosteriorPredictive, which draws
+        from the saved traces after sampling, instead of a deterministic drawn at every iteration
 
     :Results:
       - Returns dict of PyMC objects, including 'p_obs' and 'p_pred' the observed stochastic likelihood and data predicted stochastic
@@ -213,21 +576,34 @@ def log_normal_model(name, pi, sigma, p, s):
     assert pl.all(s >= 0), 'standard error must be non-negative'
 
     i_inf = pl.isinf(s)
+    i = observed_index(~i_inf)
+    p_i = pl.array(p, dtype=float)[i]
+    log_p_i = pl.log(p_i)
+    s2_i = (pl.array(s, dtype=float)[i] / p_i)**2.
+    c = normal_constant(log_p_i)
+
     @mc.observed(name='p_obs_%s'%name)
     def p_obs(value=p, pi=pi, sigma=sigma, s=s):
-        return mc.normal_like(pl.log(value[~i_inf]), pl.log(pi[~i_inf]+1.e-9),
-                              1./(sigma**2. + (s[~i_inf]/value[~i_inf])**2.))
+        return normal_loglik(log_p_i, pl.log(pi[i]+1.e-9), 1./(sigma**2. + s2_i), c)
+
+    def p_obs_grad(value, pi, sigma, s):
+        tau = 1./(sigma**2. + s2_i)
+        d_x, d_mu, d_tau = logp_gradient.normal_grad(log_p_i, pl.log(pi[i]+1.e-9), tau)
+        d_pi = pl.zeros(len(pi))
+        d_pi[i] = d_mu / (pi[i]+1.e-9)
+        return dict(pi=d_pi, sigma=pl.sum(d_tau * -2.*sigma*tau**2.))
+    p_obs.logp_grad = p_obs_grad
 
     s_noninf = s.copy()
     s_noninf[i_inf] = 0.    
-    @mc.deterministic(name='p_pred_%s'%name)
+    @predictive('p_pred_%s'%name, lazy_pred)
     def p_pred(pi=pi, sigma=sigma, s=s_noninf):
         return pl.exp(mc.rnormal(pl.log(pi+1.e-9), 1./(sigma**2. + (s/(pi+1.e-9))**2)))
 
     return dict(p_obs=p_obs, p_pred=p_pred)
 
 
-def offset_log_normal(name, pi, sigma, p, s):
+def offset_log_normal(name, pi, sigma, p, s, lazy_pred=False):
     """ Generate PyMC objects for an offset log-normal model
     
     :Parameters:
@@ -236,6 +612,8 @@ def offset_log_normal(name, pi, sigma, p, s):
       - `sigma` : pymc.Node, dispersion parameters of rates
       - `p` : array, observed values of rates
       - `s` : array, standard error sizes of rates
+      - `lazy_pred` : bool, optional, if True 'p_pred' is a PosteriorPredictive, which draws
+        from the saved traces after sampling, instead of a deterministic drawn at every iteration
 
     :Results:
       - Returns dict of PyMC objects, including 'p_obs' and 'p_pred' the observed stochastic likelihood and data predicted stochastic
@@ -247,14 +625,19 @@ def offset_log_normal(name, pi, sigma, p, s):
     p_zeta = mc.Uniform('p_zeta_%s'%name, 1.e-9, 10., value=1.e-6)
 
     i_inf = pl.isinf(s)
+    i = observed_index(~i_inf)
+    p_i = pl.array(p, dtype=float)[i]
+    s_i = pl.array(s, dtype=float)[i]
+    c = normal_constant(p_i)
+
     @mc.observed(name='p_obs_%s'%name)
     def p_obs(value=p, pi=pi, sigma=sigma, s=s, p_zeta=p_zeta):
-        return mc.normal_like(pl.log(value[~i_inf]+p_zeta), pl.log(pi[~i_inf]+p_zeta),
-                              1./(sigma**2. + (s/(value+p_zeta))[~i_inf]**2.))
+        return normal_loglik(pl.log(p_i+p_zeta), pl.log(pi[i]+p_zeta),
+                             1./(sigma**2. + (s_i/(p_i+p_zeta))**2.), c)
 
     s_noninf = s.copy()
     s_noninf[i_inf] = 0.
-    @mc.deterministic(name='p_pred_%s'%name)
+    @predictive('p_pred_%s'%name, lazy_pred)
     def p_pred(pi=pi, sigma=sigma, s=s_noninf, p_zeta=p_zeta):
         return pl.exp(mc.rnormal(pl.log(pi+p_zeta), 1./(sigma**2. + (s/(pi+p_zeta))**2.))) - p_zeta
 
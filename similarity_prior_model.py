@@ -5,6 +5,8 @@ import pymc as mc
 import pandas
 import networkx as nx
 
+import logp_gradient
+
 def similar(name, mu_child, mu_parent, sigma_parent, sigma_difference, offset=1.e-9):
     """ Generate PyMC objects encoding a simliarity prior on mu_child
     to mu_parent
@@ -34,4 +36,14 @@ def similar(name, mu_child, mu_parent, sigma_parent, sigma_difference, offset=1.
         log_mu_parent = pl.log(mu_parent.clip(offset, pl.inf))
         return mc.normal_like(log_mu_child, log_mu_parent, tau)
 
+    def parent_similarity_grad(mu_child, mu_parent, tau):
+        mu_child = mu_child.clip(offset, pl.inf)
+        mu_parent = mu_parent.clip(offset, pl.inf)
+        d_child, d_parent, d_tau = logp_gradient.normal_grad(pl.log(mu_child), pl.log(mu_parent), tau)
+        # the clipped entries do not change the logp
+        return dict(mu_child=d_child / mu_child * (mu_child > offset),
+                    mu_parent=d_parent / mu_parent * (mu_parent > offset),
+                    tau=d_tau)
+    parent_similarity.logp_grad = parent_similarity_grad
+
     return dict(parent_similarity=parent_similarity)
@@ -0,0 +1,69 @@
+""" Benchmark Age Pattern Model
+
+Compare the time to evaluate mu_age and to take MCMC steps for the
+one-stoch-per-knot spline and the vectorized spline
+"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import time
+
+import pylab as pl
+import pymc as mc
+
+import rate_model
+import age_pattern
+reload(age_pattern)
+
+def quadratic(a):
+    return .0001 * (a * (100. - a) + 100.)
+
+def time_mu_age(vars, reps):
+    gamma = [n for n in vars['gamma']]
+    start = time.time()
+    for r in range(reps):
+        for n in gamma:
+            n.value = n.value + 1.e-6
+        vars['mu_age'].value
+    return (time.time() - start) / reps
+
+def time_mcmc(vars, a, p, sigma, iter):
+    vars = dict(vars)
+    vars['pi'] = mc.Lambda('pi', lambda mu=vars['mu_age'], a=a: mu[a])
+    vars.update(rate_model.normal_model('test', vars['pi'], 0., p, sigma))
+
+    m = mc.MCMC(vars)
+    m.use_step_method(mc.AdaptiveMetropolis, vars['gamma'])
+    start = time.time()
+    m.sample(iter, progress_bar=False)
+    return (time.time() - start) / iter
+
+def benchmark_age_pattern(interpolation_method='linear', reps=1000, iter=2000):
+    ages = pl.arange(101)
+    knots = pl.arange(0, 101, 5)
+
+    a = pl.arange(0, 100, 5)
+    pi_true = quadratic(a)
+    sigma_true = .025*pl.ones_like(pi_true)
+    p = pl.maximum(0., mc.rnormal(pi_true, 1./sigma_true**2.))
+
+    results = {}
+    for vectorized in [False, True]:
+        vars = age_pattern.age_pattern('test', ages=ages, knots=knots, smoothing=pl.inf,
+                                       interpolation_method=interpolation_method, vectorized=vectorized)
+        age_pattern.set_knot_values(vars, pl.log(quadratic(knots)))
+
+        results[vectorized] = dict(mu_age=time_mu_age(vars, reps),
+                                   mcmc=time_mcmc(vars, a, p, sigma_true, iter))
+
+    print '%-10s  %12s  %12s  %8s' % (interpolation_method, 'per knot', 'vectorized', 'speedup')
+    for k in ['mu_age', 'mcmc']:
+        print '%-10s  %10.1fus  %10.1fus  %7.1fx' % (k, results[False][k]*1.e6, results[True][k]*1.e6,
+                                                    results[False][k] / results[True][k])
+    return results
+
+if __name__ == '__main__':
+    for interpolation_method in ['linear', 'zero', 'cubic']:
+        benchmark_age_pattern(interpolation_method)
@@ -0,0 +1,71 @@
+""" Benchmark MAP Optimizers
+
+Compare the wall time and the log-probability reached by the initial
+value and MAP fits of fit.fit_asr and fit.fit_consistent, using
+Powell's method and L-BFGS-B, and starting from the sequential MAP
+fits or from a single weighted least squares pass
+"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import time
+
+import pylab as pl
+import pymc as mc
+import pandas
+
+import data
+import data_simulation
+import ism
+import fit_model
+reload(fit_model)
+
+def simulated_model(data_types, n=50):
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+
+    model = data.ModelData()
+    model.input_data = pandas.concat([data_simulation.simulated_age_intervals(t, n, a, pi_age_true, .025) for t in data_types],
+                                 ignore_index=True)
+    model.hierarchy, model.output_template = data_simulation.small_output()
+    return model
+
+def time_asr(method, init, tol=.001):
+    mc.np.random.seed(1234567)
+    model = simulated_model(['p'])
+    vars = ism.age_specific_rate(model, 'p')['p']
+    map = mc.MAP(vars)
+
+    start = time.time()
+    fit_model.find_asr_initial_vals(vars, method, tol, False, init)
+    fit_model.map_fit(map, method, tol, False)
+    return time.time() - start, map.logp
+
+def time_consistent(method, init, tol=.001):
+    mc.np.random.seed(1234567)
+    model = simulated_model(['p', 'i'])
+    vars = ism.consistent(model)
+    map = mc.MAP(vars)
+
+    start = time.time()
+    if init == 'wls':
+        for t in fit_model.param_types:
+            fit_model.find_wls_initial_vals(vars[t], False)
+    else:
+        fit_model.find_consistent_spline_initial_vals(vars, method, tol, False)
+        for t in fit_model.param_types:
+            fit_model.find_re_initial_vals(vars[t], method, tol, False)
+            fit_model.find_fe_initial_vals(vars[t], method, tol, False)
+            fit_model.find_dispersion_initial_vals(vars[t], method, tol, False)
+    fit_model.map_fit(map, method, tol, False)
+    return time.time() - start, map.logp
+
+if __name__ == '__main__':
+    print '%-12s  %-14s  %-10s  %10s  %12s' % ('model', 'method', 'init', 'time (s)', 'logp')
+    for name, func in [['asr', time_asr], ['consistent', time_consistent]]:
+        for method in ['fmin_powell', 'fmin_l_bfgs_b']:
+            for init in ['sequential', 'wls']:
+                t, logp = func(method, init)
+                print '%-12s  %-14s  %-10s  %10.1f  %12.2f' % (name, method, init, t, logp)
@@ -0,0 +1,85 @@
+""" Benchmark ODE Solvers
+
+Compare the time and accuracy of the pycppad RK4 tape from dismod_ode
+and the closed-form solver from closed_form_ode, with rates taken
+from the data in the disease models in tests/
+"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import time
+
+import pylab as pl
+
+import data
+import dismod_ode
+import closed_form_ode
+reload(closed_form_ode)
+
+def rate_from_data(model, t, default):
+    """ piecewise constant rate from mean of data in each age group, as
+    in the initial values of ism.consistent"""
+    rate = default * pl.ones(101)
+    df = model.get_data(t)
+    if len(df.index) > 0:
+        mean_data = df.groupby(['age_start', 'age_end']).mean().delevel()
+        for i, row in mean_data.T.iteritems():
+            rate[row['age_start']:row['age_end']+1] = row['value']
+    return rate
+
+def time_forward(fun, x, reps):
+    start = time.time()
+    for r in range(reps):
+        y = fun.forward(0, x)
+    return (time.time() - start) / reps, y
+
+def prevalence(y):
+    N = len(y) / 2
+    return y[N:] / (y[:N] + y[N:])
+
+def benchmark_ode(fname, reps=100):
+    model = data.ModelData.from_gbd_json(fname)
+    ages = pl.arange(101, dtype=float)
+
+    i = rate_from_data(model, 'i', .01)
+    r = rate_from_data(model, 'r', .0001)
+    f = rate_from_data(model, 'f', .0001)
+    m_all = rate_from_data(model, 'm_all', .01)
+    x = pl.hstack((i, r, f, 1-1.e-4, 1.e-4))
+
+    t_rk, y_rk = time_forward(dismod_ode.ode_function(10, ages, m_all), x, reps)
+    t_cf, y_cf = time_forward(closed_form_ode.ode_function(ages, m_all), x, reps)
+
+    # accuracy relative to a tape with 10 times as many steps
+    y_ref = dismod_ode.ode_function(100, ages, m_all).forward(0, x)
+
+    print '%-28s  %10.1fus  %10.1fus  %7.1fx  %10.2e  %10.2e' % (
+        fname.split('/')[-1], t_rk*1.e6, t_cf*1.e6, t_rk / t_cf,
+        pl.absolute(prevalence(y_rk) - prevalence(y_ref)).max(),
+        pl.absolute(prevalence(y_cf) - prevalence(y_ref)).max())
+
+def benchmark_batch(draws=1000):
+    ages = pl.arange(101, dtype=float)
+    N = len(ages)
+    m_all = .001 * pl.exp(ages / 15.)
+    X = pl.hstack((pl.rand(draws, N)*.05, pl.rand(draws, N)*.5, pl.rand(draws, N)*.3,
+                   .99*pl.ones((draws, 1)), .01*pl.ones((draws, 1))))
+
+    print '\n%d draws' % draws
+    fun = dismod_ode.ode_function(10, ages, m_all)
+    for name, func in [['rk4 tape, one call per draw', lambda: [fun.forward(0, x) for x in X]],
+                       ['rk4 batch', lambda: dismod_ode.forward_batch(10, ages, m_all, X)],
+                       ['closed form batch', lambda: closed_form_ode.ode_function(ages, m_all).forward_batch(X)]]:
+        start = time.time()
+        func()
+        print '%-28s  %10.3fs' % (name, time.time() - start)
+
+if __name__ == '__main__':
+    print '%-28s  %12s  %12s  %8s  %10s  %10s' % ('disease model', 'rk4 tape', 'closed form', 'speedup',
+                                                'rk4 p err', 'cf p err')
+    for fname in ['dismoditis.json', 'hep_c_europe_western.json', 'ihd.json', 'opi.json',
+                  'single_low_noise.json', 'test_disease_1.json']:
+        benchmark_ode('tests/' + fname)
+    benchmark_batch()
@@ -0,0 +1,85 @@
+""" Benchmark Rate Model
+
+Compare the time to evaluate the observed likelihood of each rate
+model family with the fused, constant-folded kernels in rate_model
+and with the pymc likelihood evaluated on the raw data
+"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import time
+
+import pylab as pl
+import pymc as mc
+
+import rate_model
+reload(rate_model)
+
+def simulate_data(N):
+    pi = pl.exp(mc.rnormal(pl.log(.01), 4., size=N))
+    n = pl.array(pl.exp(mc.rnormal(8, 1**-2, size=N)), dtype=int)
+    p = pl.array(mc.rpoisson(pi*n), dtype=float) / n + 1.e-6
+    s = 1./pl.sqrt(n)
+
+    # some rows without sample size or standard error, as in real data
+    n[::20] = 0
+    s[::20] = pl.inf
+    return pi, p, pl.array(n, dtype=float), s
+
+def families(pi, p, n, s):
+    """ Return a dict of (fused p_obs, direct pymc likelihood) for each family"""
+    i_zero = (n==0.)
+    i_inf = pl.isinf(s)
+    zeta = 1.e-6
+    return {
+        'binom': (rate_model.binom('bm', pi, p, n)['p_obs'],
+                  lambda pi: mc.binomial_like(p*n, n, pi+1.e-9)),
+        'poisson': (rate_model.poisson('bm', pi, p, n)['p_obs'],
+                    lambda pi: mc.poisson_like((p*n)[~i_zero], (pi*n)[~i_zero])),
+        'neg_binom': (rate_model.neg_binom('bm', pi, 50., p, n)['p_obs'],
+                      lambda pi: mc.negative_binomial_like(p[~i_zero]*n[~i_zero], pi[~i_zero]*n[~i_zero]+1.e-9, 50.)),
+        'normal': (rate_model.normal_model('bm', pi, .1, p, s)['p_obs'],
+                   lambda pi: mc.normal_like(p[~i_inf], pi[~i_inf], 1./(.1**2. + s[~i_inf]**2.))),
+        'log_normal': (rate_model.log_normal_model('bm', pi, .1, p, s)['p_obs'],
+                       lambda pi: mc.normal_like(pl.log(p[~i_inf]), pl.log(pi[~i_inf]+1.e-9),
+                                                 1./(.1**2. + (s[~i_inf]/p[~i_inf])**2.))),
+        'offset_log_normal': (rate_model.offset_log_normal('bm', pi, .1, p, s)['p_obs'],
+                              lambda pi: mc.normal_like(pl.log(p[~i_inf]+zeta), pl.log(pi[~i_inf]+zeta),
+                                                        1./(.1**2. + (s/(p+zeta))[~i_inf]**2.))),
+        }
+
+def time_logp(p_obs, pi, reps):
+    start = time.time()
+    for r in range(reps):
+        pi.value = pi.value * (1. + 1.e-9)
+        p_obs.logp
+    return (time.time() - start) / reps
+
+def time_direct(like, pi, reps):
+    start = time.time()
+    for r in range(reps):
+        pi.value = pi.value * (1. + 1.e-9)
+        like(pi.value)
+    return (time.time() - start) / reps
+
+def benchmark_rate_model(N, reps=100):
+    pi_true, p, n, s = simulate_data(N)
+    pi = mc.Uniform('pi', 0., 1., value=pi_true)
+
+    results = {}
+    for family, (p_obs, like) in sorted(families(pi, p, n, s).items()):
+        results[family] = dict(fused=time_logp(p_obs, pi, reps),
+                               direct=time_direct(like, pi, reps))
+
+    print '%-18s  %8s  %12s  %12s  %8s' % ('family', 'rows', 'pymc', 'fused', 'speedup')
+    for family in sorted(results):
+        r = results[family]
+        print '%-18s  %8d  %10.1fus  %10.1fus  %7.1fx' % (family, N, r['direct']*1.e6, r['fused']*1.e6,
+                                                         r['direct'] / r['fused'])
+    return results
+
+if __name__ == '__main__':
+    for N in [1000, 10000, 100000]:
+        benchmark_rate_model(N)
@@ -32,7 +32,7 @@ def run_all():
     names = []
 
     for data_type in ['schiz', 'epilepsy', 'binom']:
-        for rate_type in 'poisson neg_binom binom beta_binom normal log_normal offset_log_normal'.split():
+        for rate_type in 'poisson neg_binom binom beta_binom beta_binom_collapsed normal log_normal offset_log_normal'.split():
             for replicate in range(100):
                 o = '%s/%s/log/%s-%s-%d.txt' % (output_dir, validation_name, rate_type, data_type, replicate)
                 name_str = '%s-%s-%s-%d' % (validation_name, rate_type, data_type, replicate)
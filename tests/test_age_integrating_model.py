@@ -43,6 +43,67 @@ def test_age_standardizing_approx():
     m = mc.MCMC(vars)
     m.sample(3)
 
+def test_age_standardizing_approx_matrix():
+    ages = pl.arange(101)
+    age_weights = mc.runiform(.1, 1., size=len(ages))
+    age_start = pl.array([0, 0, 5, 15, 80, 100, 50])
+    age_end = pl.array([4, 0, 9, 49, 120, 100, 51])
+
+    vars = age_pattern.age_pattern('test', ages, knots=pl.arange(0,101,5), smoothing=pl.inf)
+    age_pattern.set_knot_values(vars, mc.rnormal(-5., 1., size=len(vars['knots'])))
+    vars.update(age_integrating_model.age_standardize_approx('test', age_weights, vars['mu_age'], age_start, age_end, ages))
+
+    mu_age = vars['mu_age'].value
+    for i, (a0, a1) in enumerate(zip(age_start, age_end.clip(0, 100))):
+        if a0 == a1:
+            expected = mu_age[a0]
+        else:
+            expected = pl.dot(age_weights[a0+1:a1+1], mu_age[a0+1:a1+1]) / age_weights[a0+1:a1+1].sum()
+        assert pl.allclose(vars['mu_interval'].value[i], expected)
+
+def test_age_integrating_approx_matrix():
+    ages = pl.arange(101)
+    age_start = pl.array([0, 5, 15, 80])
+    age_end = pl.array([5, 10, 50, 100])
+    age_weights = [';'.join(['%f'%w for w in mc.runiform(.1, 1., size=a1-a0+1)]) for a0, a1 in zip(age_start, age_end)]
+
+    vars = age_pattern.age_pattern('test', ages, knots=pl.arange(0,101,5), smoothing=pl.inf)
+    age_pattern.set_knot_values(vars, mc.rnormal(-5., 1., size=len(vars['knots'])))
+    vars.update(age_integrating_model.age_integrate_approx('test', age_weights, vars['mu_age'], age_start, age_end, ages))
+
+    mu_age = vars['mu_age'].value
+    for i, (a0, a1) in enumerate(zip(age_start, age_end)):
+        w_i = pl.array([1.e-9+float(w) for w in age_weights[i].split(';')][:a1-a0])
+        assert pl.allclose(vars['mu_interval'].value[i], pl.dot(w_i, mu_age[a0:a1]) / w_i.sum())
+
+def test_age_integrating_approx_clipped_interval():
+    # the interval is clipped to end at age 100, so the weights for
+    # the ages after that are not used
+    ages = pl.arange(101)
+    age_start = pl.array([80])
+    age_end = pl.array([120])
+    age_weights = [';'.join(['%f'%w for w in mc.runiform(.1, 1., size=41)])]
+
+    vars = age_pattern.age_pattern('test', ages, knots=pl.arange(0,101,5), smoothing=pl.inf)
+    age_pattern.set_knot_values(vars, mc.rnormal(-5., 1., size=len(vars['knots'])))
+    vars.update(age_integrating_model.age_integrate_approx('test', age_weights, vars['mu_age'], age_start, age_end, ages))
+
+    mu_age = vars['mu_age'].value
+    w = pl.array([1.e-9+float(w) for w in age_weights[0].split(';')][:20])
+    assert pl.allclose(vars['mu_interval'].value[0], pl.dot(w, mu_age[80:100]) / w.sum())
+
+def test_age_standardizing_approx_unique_intervals():
+    ages = pl.arange(101)
+    age_start = pl.array([0, 5, 0, 5, 15, 0, 15])
+    age_end = pl.array([4, 9, 4, 9, 49, 4, 49])
+
+    vars = age_pattern.age_pattern('test', ages, knots=pl.arange(0,101,5), smoothing=pl.inf)
+    vars.update(age_integrating_model.age_standardize_approx('test', pl.ones(len(ages)), vars['mu_age'], age_start, age_end, ages))
+
+    assert vars['W'].shape == (3, len(ages))
+    assert len(vars['mu_interval'].value) == len(age_start)
+    assert pl.all(vars['mu_interval'].value[[0,2,5]] == vars['mu_interval'].value[0])
+
 def test_age_integrating_midpoint_approx():
     # simulate data
     n = 50
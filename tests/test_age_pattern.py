@@ -36,6 +36,45 @@ def test_age_pattern_model_sim():
     m = mc.MCMC(vars)
     m.sample(2)
 
+def test_age_pattern_vectorized():
+    ages = pl.arange(101)
+    knots = pl.array([0, 5, 10, 20, 40, 60, 80, 100])
+    gamma = pl.log(.0001 * (knots * (100. - knots) + 100.))
+
+    for interpolation_method in ['linear', 'nearest', 'zero', 'slinear', 'quadratic', 'cubic']:
+        vars = age_pattern.age_pattern('test', ages=ages, knots=knots, smoothing=pl.inf,
+                                       interpolation_method=interpolation_method)
+        vec_vars = age_pattern.age_pattern('test', ages=ages, knots=knots, smoothing=pl.inf,
+                                           interpolation_method=interpolation_method, vectorized=True)
+        assert len(vec_vars['gamma']) == 1
+        assert vec_vars['basis'].shape == (len(ages), len(knots))
+
+        age_pattern.set_knot_values(vars, gamma)
+        age_pattern.set_knot_values(vec_vars, gamma)
+        assert pl.allclose(vars['mu_age'].value, vec_vars['mu_age'].value), \
+            'vectorized spline should match interpolation for method %s' % interpolation_method
+
+def test_age_pattern_vectorized_sim():
+    # simulate normal data
+    a = pl.arange(0, 100, 5)
+    pi_true = .0001 * (a * (100. - a) + 100.)
+    sigma_true = .025*pl.ones_like(pi_true)
+
+    p = pl.maximum(0., mc.rnormal(pi_true, 1./sigma_true**2.))
+
+    # create model and priors
+    vars = {}
+
+    vars.update(age_pattern.age_pattern('test', ages=pl.arange(101), knots=pl.arange(0,101,5), smoothing=.1,
+                                        vectorized=True))
+
+    vars['pi'] = mc.Lambda('pi', lambda mu=vars['mu_age'], a=a: mu[a])
+    vars.update(rate_model.normal_model('test', vars['pi'], 0., p, sigma_true))
+
+    # fit model
+    m = mc.MCMC(vars)
+    m.sample(2)
+
 
 if __name__ == '__main__':
     import nose
@@ -0,0 +1,102 @@
+""" Test closed-form solver of the Dismod ODE"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+import scipy.linalg
+
+import closed_form_ode
+reload(closed_form_ode)
+import dismod_ode
+
+def test_sc_transition():
+    # rates spanning many orders of magnitude, including zeros
+    i = pl.array([0., .01, 1.e-6, .5, 10., 0.])
+    r = pl.array([0., .05, 0., 2., 0., 1.])
+    e = pl.array([.1, .01, 0., .2, 50., 0.])
+    h = pl.array([1., 1., 5., .5, 1., 2.])
+
+    E = closed_form_ode.sc_transition(i, r, e, h)
+    for j in range(len(i)):
+        expm = scipy.linalg.expm(pl.array([[-i[j], r[j]], [i[j], -(r[j]+e[j])]]) * h[j])
+        assert pl.allclose([E[0][j], E[1][j], E[2][j], E[3][j]], expm.ravel(), rtol=1.e-10, atol=1.e-14)
+
+def test_forward_matches_rk4():
+    # use rates that are constant in age
+    ages = pl.arange(101, dtype=float)
+    N = len(ages)
+    m_all = .01 * pl.ones(N)
+
+    for i, r, e in [[.01, .1, .05], [.1, 0., .5], [.001, 2., 0.]]:
+        x = pl.hstack((i*pl.ones(N), r*pl.ones(N), e*pl.ones(N), .99, .01))
+
+        y_cf = closed_form_ode.ode_function(ages, m_all).forward(0, x)
+        y_rk = dismod_ode.ode_function(10, ages, m_all).forward(0, x)
+
+        assert pl.allclose(y_cf, y_rk, rtol=1.e-4)
+
+def test_forward_batch(D=20):
+    ages = pl.arange(101, dtype=float)
+    N = len(ages)
+    m_all = .001 * pl.exp(ages / 15.)
+
+    X = pl.hstack((pl.rand(D, N)*.05, pl.rand(D, N)*.5, pl.rand(D, N)*.3,
+                   .99*pl.ones((D, 1)), .01*pl.ones((D, 1))))
+
+    # one row of solutions for each row of X, matching the single evaluations
+    fun = closed_form_ode.ode_function(ages, m_all)
+    Y = fun.forward_batch(X)
+    assert Y.shape == (D, 2*N)
+    for x, y in zip(X, Y):
+        assert pl.allclose(y, fun.forward(0, x))
+
+    # the batched RK4 takes the same steps as the tape
+    fun = dismod_ode.ode_function(10, ages, m_all)
+    Y = dismod_ode.forward_batch(10, ages, m_all, X)
+    assert Y.shape == (D, 2*N)
+    for x, y in zip(X, Y):
+        assert pl.allclose(y, fun.forward(0, x))
+
+def test_choose_num_step():
+    ages = pl.arange(101, dtype=float)
+    N = len(ages)
+    m_all = .001 * pl.exp(ages / 15.)
+    x = pl.hstack((.002*pl.exp(ages/20.), .1*pl.ones(N), .5*m_all, .99, .01))
+
+    y_cf = closed_form_ode.ode_function(ages, m_all).forward(0, x)
+    p_cf = y_cf[N:] / (y_cf[:N] + y_cf[N:])
+
+    for tol in [1.e-4, 1.e-6, 1.e-8]:
+        num_step, error = dismod_ode.choose_num_step(ages, m_all, x, tol)
+        assert len(num_step) == N-1 and pl.all(error <= tol)
+
+        # fewer steps than the default 10 per interval, with prevalence
+        # error of about the tolerance
+        assert num_step.sum() < 10*(N-1)
+        y = dismod_ode.forward_batch(num_step, ages, m_all, x)[0]
+        assert pl.allclose(y[N:] / (y[:N] + y[N:]), p_cf, rtol=0, atol=10*tol)
+
+        assert pl.allclose(dismod_ode.ode_function(num_step, ages, m_all).forward(0, x), y)
+
+def test_independent_tapes():
+    # tapes built one after another do not share any state, so each
+    # still matches the batched RK4 for its own mortality rate
+    ages = pl.arange(101, dtype=float)
+    N = len(ages)
+    m_male = .001 * pl.exp(ages / 15.)
+    m_female = .0005 * pl.exp(ages / 14.)
+
+    fun_male = dismod_ode.TapedODE(10, ages, m_male)
+    fun_female = dismod_ode.TapedODE(10, ages, m_female)
+
+    X = pl.hstack((pl.rand(2, N)*.05, pl.rand(2, N)*.5, pl.rand(2, N)*.3,
+                   .99*pl.ones((2, 1)), .01*pl.ones((2, 1))))
+    for x in X:
+        assert pl.allclose(fun_male.forward(0, x), dismod_ode.forward_batch(10, ages, m_male, x[None, :])[0])
+        assert pl.allclose(fun_female.forward(0, x), dismod_ode.forward_batch(10, ages, m_female, x[None, :])[0])
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
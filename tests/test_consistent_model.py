@@ -21,6 +21,8 @@ import data
 import ism
 reload(ism)
 import data_simulation
+import fit_model
+import logp_gradient
 
 def test_consistent_model_forward():
     m = data.ModelData()
@@ -45,6 +47,52 @@ def test_consistent_model_forward():
     print vars['p']['mu_age'].value[::10].round(3)
 
 
+def test_consistent_model_closed_form_ode():
+    m = data.ModelData()
+    vars = ism.consistent(m, 'all', 'total', 'all', {})
+    vars_cf = ism.consistent(m, 'all', 'total', 'all', {}, ode_solver='closed_form')
+
+    # prevalence from the closed-form solver should match the RK4 tape
+    for t, x in zip('irf', [.01, .1, .05]):
+        for vars_t in [vars[t], vars_cf[t]]:
+            for n in vars_t['gamma']:
+                n.value = pl.log(x)
+    assert pl.allclose(vars['p']['mu_age'].value, vars_cf['p']['mu_age'].value, rtol=1.e-4, atol=1.e-8)
+
+def test_duration():
+    # compare to the backward recursion, one age at a time
+    def duration_loop(r, m, f):
+        hazard = r + m + f
+        pr_not_exit = pl.exp(-hazard)
+        X = pl.empty(len(hazard))
+        X[-1] = 1 / hazard[-1]
+        for i in reversed(range(len(X)-1)):
+            X[i] = pr_not_exit[i] * (X[i+1] + 1) + 1 / hazard[i] * (1 - pr_not_exit[i]) - pr_not_exit[i]
+        return X
+
+    for N in [1, 2, 7, 101]:
+        for scale in [.01, 1., 50.]:
+            r, m, f = [scale*pl.rand(N) + 1.e-6 for t in 'rmf']
+            assert pl.allclose(ism.duration(r, m, f), duration_loop(r, m, f), rtol=1.e-10)
+
+    # one row of durations for each row of samples
+    r, m, f = [.3*pl.rand(20, 101) + 1.e-6 for t in 'rmf']
+    X = ism.duration(r, m, f)
+    assert X.shape == (20, 101)
+    for k in range(20):
+        assert pl.allclose(X[k], duration_loop(r[k], m[k], f[k]), rtol=1.e-10)
+
+def test_consistent_model_ode_tolerance():
+    m = data.ModelData()
+    vars = ism.consistent(m, 'all', 'total', 'all', {}, ode_tolerance=1.e-6)
+    vars_cf = ism.consistent(m, 'all', 'total', 'all', {}, ode_solver='closed_form')
+
+    # the chosen steps and their error are kept with the prevalence vars
+    assert len(vars['p']['ode_num_step']) == len(m.parameters['ages']) - 1
+    assert pl.all(vars['p']['ode_error'] <= 1.e-6)
+    assert pl.allclose(vars['p']['mu_age'].value, vars_cf['p']['mu_age'].value, rtol=0, atol=1.e-5)
+
+
 def test_consistent_model_sim():
     m = data.ModelData()
 
@@ -66,6 +114,40 @@ def test_consistent_model_sim():
 
     return vars
 
+def test_consistent_model_gradient():
+    m = data.ModelData()
+
+    # generate simulated data
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+    m.input_data = data_simulation.simulated_age_intervals('p', 50, a, pi_age_true, .025)
+    vars = ism.consistent(m, 'all', 'total', 'all', {})
+    for t, x in zip('irf', [.01, .1, .05]):
+        for n in vars[t]['gamma']:
+            n.value = pl.log(x) + .1*mc.rnormal(0., 1.)
+
+    # the reverse mode of the ODE tape should match finite differences of the log-posterior
+    map = mc.MAP(vars)
+    index = fit_model.map_index(map)
+    grad = logp_gradient.LogpGradient([s for s, i in index], map.stochastics | map.potentials | map.observed_stochastics)
+    assert grad.missing == []
+    g = pl.hstack([pl.ravel(g_i) for g_i in grad()])
+
+    x = pl.hstack([pl.ravel(s.value) for s, i in index])
+    eps = 1.e-6
+    g_fd = pl.zeros(len(x))
+    for k in range(len(x)):
+        e = pl.zeros(len(x))
+        e[k] = eps
+        fit_model.set_map_values(index, x + e)
+        logp_plus = map.logp
+        fit_model.set_map_values(index, x - e)
+        logp_minus = map.logp
+        g_fd[k] = (logp_plus - logp_minus) / (2*eps)
+    fit_model.set_map_values(index, x)
+
+    assert pl.allclose(g, g_fd, rtol=1.e-3, atol=1.e-3*pl.absolute(g_fd).max())
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
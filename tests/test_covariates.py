@@ -94,6 +94,28 @@ def test_covariate_model_sim_w_hierarchy():
     assert 'x_sex' in vars['X']
     assert len(vars['beta']) == 1
 
+def test_random_effect_design():
+    hierarchy, output_template = data_simulation.small_output()
+
+    input_data = pandas.DataFrame(dict(area=['all', 'USA', 'CAN', 'USA', 'CAN', 'USA']))
+
+    for root_area in ['all', 'NAHI']:
+        U = covariate_model.random_effect_design(input_data, hierarchy, root_area)
+
+        # compare to dense version, built directly from the hierarchy
+        U_dense = pandas.DataFrame(0., index=input_data.index, columns=U.columns)
+        for i in input_data.index:
+            for node in nx.shortest_path(hierarchy, 'all', input_data['area'][i]):
+                if node in U_dense:
+                    U_dense[node][i] = 1.
+        U_dense -= U.shift
+
+        assert 'CAN' in U and 'all' not in U
+        assert pl.allclose(U.to_dense(), U_dense)
+
+        alpha = mc.rnormal(0., 1., size=len(U.columns))
+        assert pl.allclose(U.dot(alpha), pl.dot(U_dense, alpha))
+
 def test_fixed_effect_priors():
     model = data.ModelData()
 
@@ -158,6 +180,52 @@ def test_random_effect_priors():
     assert vars['alpha'][1].parents['mu'] == .1
 
 
+def test_vectorized_random_effects():
+    model = data.ModelData()
+    parameters = dict(random_effects={'MEX': dict(dist='Constant', mu=.3, sigma=.1)})
+
+    # simulate normal data
+    n = 64
+    area_list = pl.array(['all', 'USA', 'CAN', 'MEX'])
+    area = area_list[mc.rcategorical([.1, .3, .3, .3], n)]
+    alpha_true = dict(all=0., USA=.1, CAN=-.2, MEX=.3)
+    pi_true = pl.exp([alpha_true[a] for a in area])
+    sigma_true = .05
+    p = mc.rnormal(pi_true, 1./sigma_true**2.)
+
+    model.input_data = pandas.DataFrame(dict(value=p, area=area))
+    model.input_data['sex'] = 'total'  # so that pi has no sex effect, and depends on alpha alone
+    model.input_data['year_start'] = 2010
+    model.input_data['year_end'] = 2010
+
+    model.hierarchy.add_edge('all', 'north_america')
+    model.hierarchy.add_edge('north_america', 'USA')
+    model.hierarchy.add_edge('north_america', 'CAN')
+    model.hierarchy.add_edge('north_america', 'MEX')
+
+    # create model and priors
+    vars = {}
+    vars.update(covariate_model.mean_covariate_model('test', 1, model.input_data, parameters, model,
+                                                     'all', 'total', 'all', zero_re=True, vectorized_re=True))
+    vars.update(rate_model.normal_model('test', vars['pi'], 0., p, sigma_true*pl.ones_like(p)))
+
+    assert isinstance(vars['alpha'], mc.Node)
+    assert len(vars['alpha_potentials']) == 1
+    assert len(vars['alpha_free'].value) == 1, 'CAN is free, north_america and USA are sum-to-zero, MEX is constant'
+
+    # fit model
+    m = mc.MCMC(vars)
+    m.sample(3)
+
+    alpha = pandas.Series(vars['alpha'].value, index=vars['U'].columns)
+    assert alpha['MEX'] == .3
+    assert pl.allclose(alpha['USA'] + alpha['CAN'] + alpha['MEX'], 0.)
+    assert pl.allclose(vars['pi'].value, pl.exp(pl.dot(vars['U'].to_dense(), alpha)))
+
+    stats = covariate_model.alpha_stats(vars)
+    assert stats[list(vars['U'].columns).index('MEX')][0] == None
+    assert stats[list(vars['U'].columns).index('CAN')][0] != None
+
 def test_covariate_model_dispersion():
     # simulate normal data
     n = 100
@@ -194,6 +262,32 @@ def test_covariate_model_dispersion():
     m = mc.MCMC(vars)
     m.sample(2)
 
+def test_covariate_design_cache():
+    model = data.ModelData()
+    model.hierarchy, model.output_template = data_simulation.small_output()
+    model.input_data = pandas.DataFrame(dict(value=[.1, .2, .3, .4], x_0=[.5, 1., 0., .5],
+                                             area=['USA', 'CAN', 'USA', 'CAN'], sex=['male', 'female', 'total', 'total'],
+                                             year_start=2000, year_end=2000))
+
+    design_cache = {}
+    vars = covariate_model.mean_covariate_model('test_1', 1, model.input_data, {}, model, 'all', 'total', 'all',
+                                                design_cache=design_cache)
+    vars_cached = covariate_model.mean_covariate_model('test_2', 1, model.input_data, {}, model, 'all', 'total', 'all',
+                                                       design_cache=design_cache)
+    vars_uncached = covariate_model.mean_covariate_model('test_3', 1, model.input_data, {}, model, 'all', 'total', 'all')
+
+    assert vars_cached['U'] is vars['U']
+    assert vars_cached['X'] is vars['X']
+    assert pl.all(vars_uncached['X'] == vars['X'])
+    assert pl.all(vars_uncached['X_shift'] == vars['X_shift'])
+
+    # a different set of rows uses the shared output_template aggregation, but gets its own design
+    vars_subset = covariate_model.mean_covariate_model('test_4', 1, model.input_data[:2], {}, model, 'all', 'total', 'all',
+                                                       design_cache=design_cache)
+    assert vars_subset['U'] is not vars['U']
+    assert len(vars_subset['X'].index) == 2
+    assert pl.all(vars_subset['X_shift'] == vars['X_shift'])
+
 def test_covariate_model_shift_for_root_consistency():
     # generate simulated data
     n = 50
@@ -10,6 +10,7 @@ sys.path += ['.']
 
 import pylab as pl
 import pymc as mc
+import networkx as nx
 
 import data
 reload(data)
@@ -78,6 +79,48 @@ def test_save_and_load():
     assert sorted(d.hierarchy.edges()) == sorted(d2.hierarchy.edges()), 'hierarchy should be equal before and after save'
     assert d.nodes_to_fit == d2.nodes_to_fit, 'nodess_to_fit should be equal before and after save'
 
+def test_check_convergence():
+    # x needs an observed child, or pymc draws it from its prior
+    # without the step method
+    x = mc.Normal('x', 0., 1., value=[0., 0.])
+    y = mc.Normal('y', x, 1., value=[0., 0.], observed=True)
+    m = mc.MCMC([x, y])
+    m.sample(2000)
+    assert data.check_convergence({'x': x})
+
+    # tiny untuned steps make a slowly drifting chain
+    m = mc.MCMC([x, y])
+    m.use_step_method(mc.Metropolis, x, proposal_sd=.001)
+    m.sample(2000, tune_throughout=False)
+    assert not data.check_convergence({'x': x})
+
+def test_hierarchy_index():
+    d = data.ModelData()
+    d.hierarchy.add_edge('all', 'super-region-1')
+    d.hierarchy.add_edge('super-region-1', 'NAHI')
+    d.hierarchy.add_edge('NAHI', 'CAN')
+    d.hierarchy.add_edge('NAHI', 'USA')
+    d.hierarchy.add_edge('all', 'super-region-2')
+
+    index = d.hierarchy_index()
+    for n in d.hierarchy:
+        assert index.path(n) == nx.shortest_path(d.hierarchy, 'all', n), 'path should match networkx shortest path'
+        assert index.level(n) == len(index.path(n)) - 1
+        assert sorted(index.children[n]) == sorted(d.hierarchy.successors(n))
+        for m in d.hierarchy:
+            assert index.is_ancestor(n, m) == (m in nx.descendants(d.hierarchy, n) or m == n)
+
+    assert sorted(index.leaves['all']) == ['CAN', 'USA', 'super-region-2']
+    assert index.leaves['USA'] == ['USA']
+    assert index.path('USA', start='NAHI') == ['NAHI', 'USA']
+    assert sorted(index.nodes_at_level(1)) == ['super-region-1', 'super-region-2']
+
+    # index is rebuilt when hierarchy changes
+    assert d.hierarchy_index() is index
+    d.hierarchy.add_edge('USA', 'Washington')
+    assert d.hierarchy_index() is not index
+    assert sorted(d.hierarchy_index().leaves['NAHI']) == ['CAN', 'Washington']
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
@@ -21,6 +21,7 @@ import data
 import ism
 import covariate_model
 import data_simulation
+import fit_model
 reload(ism)
 
 def test_data_model_sim():
@@ -80,6 +81,45 @@ def test_data_model_lower_bound():
     m = mc.MCMC(vars)
     m.sample(3)
 
+def test_data_model_wls_init():
+    # generate simulated data
+    data_type = 'p'
+    n = 100
+    sigma_true = .025
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+
+    d = data.ModelData()
+    d.input_data = data_simulation.simulated_age_intervals(data_type, n, a, pi_age_true, sigma_true)
+    d.hierarchy, d.output_template = data_simulation.small_output()
+
+    vars = ism.age_specific_rate(d, data_type,
+                                 reference_area='all', reference_sex='total', reference_year='all',
+                                 mu_age=None, mu_age_parent=None, sigma_age_parent=None)[data_type]
+
+    # a single weighted least squares pass should put the age pattern
+    # near the truth, at a point with positive probability
+    fit_model.find_wls_initial_vals(vars, False)
+    assert pl.median(pl.absolute(vars['mu_age'].value[5:95] / pi_age_true[5:95] - 1.)) < .2
+    assert pl.isfinite(mc.Model(vars).logp)
+
+def test_hessian_cov():
+    # for a normal posterior, the covariance is the inverse of the
+    # precision, scaled as the AdaptiveMetropolis updates are
+    tau = pl.array([[2., .5, 0.], [.5, 1., .3], [0., .3, 4.]]) * 100.
+    x = mc.Normal('x', 0., 1.e-6, value=1.)
+    y = mc.Normal('y', 0., 1.e-6, value=[-2., 3.])
+    @mc.potential
+    def quadratic(x=x, y=y):
+        d = pl.hstack((x, y)) - [1., -2., 3.]
+        return -.5 * pl.dot(d, pl.dot(tau, d))
+
+    cov = fit_model.hessian_cov([x, y])
+    assert pl.allclose(cov, pl.inv(tau) * 2.4**2 / 3., rtol=1.e-3)
+
+    # the values are restored
+    assert x.value == 1. and pl.all(y.value == [-2., 3.])
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
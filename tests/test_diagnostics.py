@@ -0,0 +1,155 @@
+""" Test convergence diagnostics and merged traces of parallel chains
+
+These tests are use randomized computation, so they might fail
+occasionally due to stochastic variation
+"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+import pymc as mc
+
+import array_trace
+import diagnostics
+reload(diagnostics)
+import fit_model
+
+def ar1(phi, chains, samples, columns):
+    x = pl.zeros((chains, samples, columns))
+    e = pl.randn(chains, samples, columns)
+    for t in range(1, samples):
+        x[:, t] = phi*x[:, t-1] + e[:, t]
+    return x
+
+def test_autocorrelation():
+    x = ar1(.5, 1, 10000, 1)[0]
+    rho = diagnostics.autocorrelation(x)
+    assert rho.shape == x.shape
+    assert pl.allclose(rho[:4, 0], .5**pl.arange(4), atol=.05)
+
+def test_effective_sample_size():
+    # the ess of an AR(1) chain is about n (1-phi)/(1+phi)
+    phi = .9
+    x = ar1(phi, 4, 5000, 2)
+    ess = diagnostics.effective_sample_size(x)
+    assert ess.shape == (2,)
+    assert pl.allclose(ess, 4*5000*(1-phi)/(1+phi), rtol=.25)
+
+    # independent samples are all effective
+    ess = diagnostics.effective_sample_size(pl.randn(4, 1000, 3, 2))
+    assert ess.shape == (3, 2)
+    assert pl.all(ess > 3000) and pl.all(ess <= 4000)
+
+def test_split_rhat():
+    x = pl.randn(4, 1000, 3)
+    assert pl.allclose(diagnostics.split_rhat(x), 1., atol=.02)
+
+    # chains centered at different values have not mixed
+    x += pl.arange(4)[:, None, None]
+    assert pl.all(diagnostics.split_rhat(x) > 1.2)
+
+    # a single chain that drifts has not converged
+    x = pl.randn(1, 1000) + pl.linspace(0, 5, 1000)
+    assert diagnostics.split_rhat(x) > 1.2
+
+def test_geweke():
+    # z-scores of independent samples are approximately standard normal
+    z = diagnostics.geweke(pl.randn(1, 1000, 100))
+    assert z.shape == (100,)
+    assert abs(z.mean()) < .5 and .7 < z.std() < 1.3
+
+    # a chain that drifts has a large z-score
+    x = pl.randn(1, 1000) + pl.linspace(0, 3, 1000)
+    assert abs(diagnostics.geweke(x)) > 3.
+
+def test_convergence_table():
+    x = mc.Normal('x', 0., 1., value=[0., 0.])
+    y = mc.Normal('y', x, 1., value=[1., -1.], observed=True)
+    z = mc.Uniform('z', 0., 1., value=.5)
+    m = mc.MCMC([x, y, z])
+    m.sample(1000)
+
+    t = diagnostics.convergence_table({'x': x, 'yz': [y, z], 'z': z})
+    assert list(t['node']) == ['x', 'x', 'z']
+    assert list(t['index']) == [0, 1, 0]
+    for col in 'mean sd iat ess geweke rhat'.split():
+        assert pl.all(pl.isfinite(t[col])), 'diagnostic %s should be finite' % col
+    assert pl.allclose(t['mean'], [x.stats()['mean'][0], x.stats()['mean'][1], z.stats()['mean']])
+
+def test_array_trace():
+    chains = [pl.randn(10, 3), pl.randn(10, 3)]
+    trace = array_trace.ArrayTrace('test', chains)
+
+    assert trace().shape == (20, 3)
+    assert pl.all(trace()[10:] == chains[1])
+    assert pl.all(trace(chain=-1) == trace())
+    assert trace(thin=2).shape == (10, 3)
+    assert trace.chain_array().shape == (2, 10, 3)
+    assert pl.allclose(trace.stats()['mean'], pl.vstack(chains).mean(0))
+
+def test_sample_chains():
+    x = mc.Normal('x', 0., 1., value=0.)
+    y = mc.Normal('y', x, 1., value=[1., -1.], observed=True)
+    m = mc.MCMC([x, y])
+
+    fit_model.sample_chains(m, 2, 400, 200, 2, 100, False)
+
+    # the node and the model return the samples of both chains
+    assert len(x.trace()) == 200
+    assert len(m.trace('x')[:]) == 200
+    assert 'mean' in x.stats()
+    assert pl.shape(m.rhat['x']) == () and m.ess['x'] > 0
+
+def test_sample_to_ess():
+    x = mc.Normal('x', 0., 1., value=0.)
+    y = mc.Normal('y', x, 1., value=[1., -1.], observed=True)
+
+    # an easy target stops early, at the end of a chunk
+    m = mc.MCMC([x, y])
+    fit_model.sample_to_ess(m, 50, 20000, 100, 2, 100, False, chunk=500)
+    assert m.ess_met
+    assert m.iter < 20000 and (m.iter - 100) % 500 == 0
+    assert len(x.trace()) == (m.iter - 100) / 2
+    assert m.ess['x'] >= 50
+
+    # an unreachable target runs out of iterations, and is flagged
+    m = mc.MCMC([x, y])
+    fit_model.sample_to_ess(m, 1.e6, 1100, 100, 2, 100, False, chunk=500)
+    assert not m.ess_met
+    assert m.iter == 1100 and len(x.trace()) == 500
+
+def test_find_burn_in():
+    # start far from the posterior, so the deviance falls during burn-in
+    x = mc.Normal('x', 0., 1.e-4, value=50.)
+    y = mc.Normal('y', x, 1., value=pl.zeros(10), observed=True)
+    m = mc.MCMC([x, y])
+
+    burn = fit_model.find_burn_in(m, 20000, 100, False, window=500)
+    assert m.burn_detected
+    assert 1000 <= burn < 20000 and burn % 500 == 0
+    assert abs(x.value) < 2.
+
+    # too short to test
+    assert fit_model.find_burn_in(m, 100, 100, False) == 0
+    assert not m.burn_detected
+
+def test_sample_posterior_auto_burn():
+    x = mc.Normal('x', 0., 1.e-4, value=50.)
+    y = mc.Normal('y', x, 1., value=pl.zeros(10), observed=True)
+    m = mc.MCMC([x, y])
+
+    # the number of samples saved does not depend on the burn-in found
+    fit_model.sample_posterior(m, 12000, 10000, 10, 100, False, auto_burn=True)
+    assert len(x.trace()) == 200
+    assert m.burn < 10000 and m.iter == m.burn + 2000
+
+    # the burn-in windows are not part of the posterior
+    assert m.db.chains == 1
+    assert x.stats()['n'] == 200
+    assert abs(x.stats()['mean']) < 1.
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
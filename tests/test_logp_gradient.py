@@ -0,0 +1,119 @@
+""" Test gradient of the log-posterior
+
+These tests are use randomized computation, so they might fail
+occasionally due to stochastic variation
+"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+import pymc as mc
+
+import data
+import data_simulation
+import age_pattern
+import age_integrating_model
+import covariate_model
+import rate_model
+import expert_prior_model
+import fit_model
+import logp_gradient
+reload(logp_gradient)
+reload(fit_model)
+
+def covariate_vars(vectorized):
+    # simulate age interval data from areas in the hierarchy
+    a = pl.arange(0, 101, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+    d = data_simulation.simulated_age_intervals('p', 50, a, pi_age_true, .01)
+    d['area'] = pl.array(['all', 'USA', 'CAN'])[mc.rcategorical([.3, .3, .4], len(d))]
+
+    model = data.ModelData()
+    model.input_data = d
+    model.hierarchy, model.output_template = data_simulation.small_output()
+
+    # create the spline, covariate and negative binomial model
+    ages = pl.array(a, dtype=float)
+    knots = pl.arange(0, 101, 20)
+    vars = age_pattern.spline('test', ages, knots, smoothing=.05, vectorized=vectorized)
+    vars.update(age_integrating_model.age_standardize_approx('test', pl.ones_like(ages), vars['mu_age'],
+                                                             d['age_start'], d['age_end'], ages))
+    vars.update(covariate_model.mean_covariate_model('test', vars['mu_interval'], d, {}, model, 'all', 'total', 'all',
+                                                     zero_re=True, vectorized_re=vectorized))
+
+    # move away from the initial values, which are at the center of the priors
+    age_pattern.set_knot_values(vars, pl.log(pi_age_true[knots]) + .1*mc.rnormal(0., 1., size=len(knots)))
+    return vars, d
+
+def neg_binom_vars(vectorized):
+    vars, d = covariate_vars(vectorized)
+    vars.update(covariate_model.dispersion_covariate_model('test', d, .1, 10.))
+    vars.update(rate_model.neg_binom('test', vars['pi'], vars['delta'], d['value'], d['effective_sample_size']))
+    return vars
+
+def check_gradient(vars):
+    m = mc.MAP(vars)
+    index = fit_model.map_index(m)
+    x = pl.hstack([pl.ravel(s.value) for s, i in index])
+    l, u = pl.array(fit_model.map_bounds(m), dtype=float).T
+    x = pl.where(pl.isnan(l), x + .1*mc.rnormal(0., 1., size=len(x)), .5*(l + u) + .1*(u - l)*mc.runiform(-1., 1., size=len(x)))
+    fit_model.set_map_values(index, x)
+
+    grad = logp_gradient.LogpGradient([s for s, i in index], m.stochastics | m.potentials | m.observed_stochastics)
+    assert grad.missing == []
+    g = pl.hstack([pl.ravel(g_i) for g_i in grad()])
+
+    # compare to central differences
+    eps = 1.e-6
+    g_fd = pl.zeros(len(x))
+    for k in range(len(x)):
+        e = pl.zeros(len(x))
+        e[k] = eps
+        fit_model.set_map_values(index, x + e)
+        logp_plus = m.logp
+        fit_model.set_map_values(index, x - e)
+        logp_minus = m.logp
+        g_fd[k] = (logp_plus - logp_minus) / (2*eps)
+    fit_model.set_map_values(index, x)
+
+    assert pl.allclose(g, g_fd, rtol=1.e-4, atol=1.e-4*pl.absolute(g_fd).max()), 'gradient should match finite differences'
+
+def test_neg_binom_gradient():
+    check_gradient(neg_binom_vars(vectorized=False))
+
+def test_vectorized_neg_binom_gradient():
+    check_gradient(neg_binom_vars(vectorized=True))
+
+def test_normal_gradient():
+    vars, d = covariate_vars(vectorized=True)
+    vars['sigma'] = mc.Uniform('sigma', 0., 1., value=.1)
+    vars.update(rate_model.normal_model('test', vars['pi'], vars['sigma'], d['value'], .01*pl.ones(len(d))))
+    check_gradient(vars)
+
+def test_expert_prior_gradient():
+    vars, d = covariate_vars(vectorized=True)
+    parameters = dict(level_value=dict(value=.001, age_before=10, age_after=90),
+                      level_bounds=dict(lower=.0005, upper=.2),
+                      increasing=dict(age_start=60, age_end=100),
+                      decreasing=dict(age_start=0, age_end=40))
+    ages = pl.arange(101)
+    vars.update(expert_prior_model.level_constraints('test', parameters, vars['mu_age'], ages))
+    vars.update(expert_prior_model.derivative_constraints('test', parameters, vars['mu_age'], ages))
+    vars['sigma'] = mc.Uniform('sigma', 0., 1., value=.1)
+    vars.update(rate_model.normal_model('test', vars['pi'], vars['sigma'], d['value'], .01*pl.ones(len(d))))
+    check_gradient(vars)
+
+def test_map_fit_uses_gradient():
+    vars = neg_binom_vars(vectorized=True)
+    m = mc.MAP(vars)
+    logp = m.logp
+
+    fit_model.map_fit(m, 'fmin_l_bfgs_b', tol=.01, verbose=0)
+    assert m.logp >= logp, 'fit should not decrease the log-posterior'
+    assert m.logp_at_max == m.logp
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
@@ -0,0 +1,122 @@
+""" Test storing traces in .npy files"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pylab as pl
+import pymc as mc
+
+import npy_trace
+reload(npy_trace)
+import fit_model
+
+def npy_vars():
+    x = mc.Normal('x', 0., 1., value=[0., 0., 0.])
+    @mc.deterministic
+    def y(x=x):
+        return x.sum()
+    return [x, y]
+
+def npy_model(dbname, dbchunk=7):
+    return mc.MCMC(npy_vars(), db=npy_trace, dbname=dbname, dbchunk=dbchunk)
+
+def test_sample():
+    dir = tempfile.mkdtemp()
+    try:
+        m = npy_model(dir)
+        m.sample(230, 100, 2)
+
+        # traces are memory maps of files with all samples, including
+        # the last partial chunk
+        x = m.trace('x')()
+        assert isinstance(x, np.memmap)
+        assert x.shape == (65, 3)
+        assert pl.all(np.load(dir + '/Chain_0/x.npy') == x)
+        assert pl.allclose(m.trace('y')(), x.sum(1))
+        assert pl.allclose(m.get_node('x').stats()['mean'], x.mean(0))
+        assert len(m.trace('deviance')[:]) == 65
+
+        # with one chain, all chains is the memory map of that chain
+        assert isinstance(m.get_node('x').trace(chain=None), np.memmap)
+
+        # a second chain has its own files
+        m.sample(20)
+        assert m.trace('x')().shape == (20, 3)
+        assert m.trace('x', chain=0)().shape == (65, 3)
+        assert m.get_node('x').trace(chain=None).shape == (85, 3)
+
+        # stats skip start samples through the chains in order
+        x_all = m.get_node('x').trace(chain=None)
+        for start in [0, 10, 70]:
+            s = m.get_node('x').stats(start=start)
+            assert s['n'] == 85 - start
+            assert pl.allclose(s['mean'], x_all[start:].mean(0))
+            assert pl.allclose(s['standard deviation'], x_all[start:].std(0))
+        s = m.get_node('x').stats(start=5, chain=0)
+        assert s['n'] == 60
+        assert pl.allclose(s['mean'], x[5:].mean(0))
+        assert os.path.exists(dir + '/Chain_1/y.npy')
+    finally:
+        shutil.rmtree(dir)
+
+def test_header():
+    # the header has the same size for any shape, so it can be rewritten in place
+    for shape in [(0,), (10,), (123456789, 101), (5, 6, 7)]:
+        h = npy_trace.npy_header(pl.dtype(float), shape)
+        assert len(h) == npy_trace.HEADER_SIZE
+
+def test_discard_chains():
+    dir = tempfile.mkdtemp()
+    try:
+        m = npy_model(dir)
+        m.sample(10)
+        m.sample(10)
+        fit_model.discard_chains(m, 1)
+        assert m.db.chains == 1
+        assert not os.path.exists(dir + '/Chain_1')
+
+        m.sample(5)
+        assert m.trace('x')().shape == (5, 3)
+        assert m.get_node('x').stats()['n'] == 15
+    finally:
+        shutil.rmtree(dir)
+
+def test_checkpoint():
+    dir = tempfile.mkdtemp()
+    try:
+        assert fit_model.load_checkpoint(npy_vars(), dir) == None
+
+        # a run of 230 iterations, stopped after 150
+        m = npy_model(dir)
+        m.db.run = dict(iter=230, burn=100, thin=2, done=0, warm_up=0)
+        m.sample(150, 100, 2, save_interval=50)
+        assert npy_trace.has_checkpoint(dir)
+        x = m.trace('x')()[:].copy()
+        assert x.shape == (25, 3)
+
+        m = fit_model.load_checkpoint(npy_vars(), dir)
+        assert pl.all(m.get_node('x').value == m.db.getstate()['stochastics']['x'])
+        fit_model.resume_sampling(m, 100, False, 50)
+
+        # the samples before the checkpoint are kept, in the same chain
+        assert m.db.chains == 1
+        assert m.trace('x')().shape == (65, 3)
+        assert pl.all(m.trace('x')()[:25] == x)
+        assert (m.iter, m.burn, m.thin) == (230, 100, 2)
+
+        # a finished run is not sampled again
+        m = fit_model.load_checkpoint(npy_vars(), dir)
+        fit_model.resume_sampling(m, 100, False, 50)
+        assert m.trace('x')().shape == (65, 3)
+    finally:
+        shutil.rmtree(dir)
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
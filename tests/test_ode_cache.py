@@ -0,0 +1,82 @@
+""" Test cache of ODE solutions"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+
+import closed_form_ode
+import ode_cache
+reload(ode_cache)
+
+def ode_x(N, i):
+    return pl.hstack((i*pl.ones(N), .1*pl.ones(N), .05*pl.ones(N), .99, .01))
+
+def test_hits_and_misses():
+    ages = pl.arange(101, dtype=float)
+    m_all = .001 * pl.exp(ages / 15.)
+    fun = closed_form_ode.ode_function(ages, m_all)
+    cached = ode_cache.MemoizedODE(fun)
+
+    x = ode_x(len(ages), .01)
+    y = cached.forward(0, x)
+    assert pl.all(y == fun.forward(0, x))
+    assert cached.hits == 0 and cached.misses == 1
+
+    # an equal rate vector is a hit, and changing the result does not
+    # change the cached value
+    y[:] = 0.
+    assert pl.all(cached.forward(0, x.copy()) == fun.forward(0, x))
+    assert cached.hits == 1 and cached.misses == 1
+
+    cached.forward(0, ode_x(len(ages), .02))
+    assert cached.hits == 1 and cached.misses == 2
+
+def test_lru_eviction():
+    ages = pl.arange(101, dtype=float)
+    m_all = .001 * pl.exp(ages / 15.)
+    cached = ode_cache.MemoizedODE(closed_form_ode.ode_function(ages, m_all), maxsize=2)
+
+    x1, x2, x3 = [ode_x(len(ages), i) for i in [.01, .02, .03]]
+    cached.forward(0, x1)
+    cached.forward(0, x2)
+    cached.forward(0, x1)  # x2 is now the least recently used
+    cached.forward(0, x3)
+    assert len(cached.cache) == 2
+
+    cached.forward(0, x1)
+    assert cached.hits == 2
+    cached.forward(0, x2)
+    assert cached.misses == 4
+
+class SquareTape:
+    """ y = x**2, which keeps the x of its last forward call for the
+    reverse mode, as a pycppad function object does"""
+    def forward(self, p, x):
+        self.x = pl.array(x, dtype=float)
+        return self.x**2
+
+    def reverse(self, p, w):
+        return 2. * self.x * w
+
+def test_reverse_after_hit():
+    cached = ode_cache.MemoizedODE(SquareTape())
+    x1, x2 = pl.array([1., 2.]), pl.array([3., 4.])
+    w = pl.array([1., -1.])
+
+    cached.forward(0, x1)
+    assert pl.all(cached.reverse(1, w) == [2., -4.])
+
+    # the hit on x1 leaves the tape at x2, so reverse must run forward again
+    cached.forward(0, x2)
+    cached.forward(0, x1)
+    assert cached.hits == 1
+    assert pl.all(cached.reverse(1, w) == [2., -4.])
+
+    cached.forward(0, x2)
+    assert pl.all(cached.reverse(1, w) == [6., -8.])
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
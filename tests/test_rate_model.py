@@ -73,6 +73,109 @@ def test_log_normal_model_sim(N=16):
     m = mc.MCMC(vars)
     m.sample(1)
 
+def test_fused_likelihoods(N=100):
+    # simulate data, including rows that the likelihoods skip
+    pi = pl.exp(mc.rnormal(pl.log(.01), 4., size=N))
+    n = pl.array(pl.exp(mc.rnormal(8, 1**-2, size=N)), dtype=int)
+    p = pl.array(mc.rpoisson(pi*n), dtype=float) / n
+    s = 1./pl.sqrt(n)
+    n[:3] = 0
+    s[3:6] = pl.inf
+    i = n != 0
+    j = ~pl.isinf(s)
+
+    # each fused kernel must agree with the pymc likelihood it replaces
+    vars = rate_model.binom('fused', pi, p, n)
+    assert pl.allclose(vars['p_obs'].logp, mc.binomial_like(p*n, n, pi+1.e-9))
+
+    vars = rate_model.poisson('fused', pi, p, n)
+    assert pl.allclose(vars['p_obs'].logp, mc.poisson_like((p*n)[i], (pi*n)[i]))
+
+    for delta in [50., 50.*pl.ones(N), 1.e12]:
+        vars = rate_model.neg_binom('fused', pi, delta, p, n)
+        assert pl.allclose(vars['p_obs'].logp,
+                           mc.negative_binomial_like((p*n)[i], (pi*n)[i]+1.e-9, (pl.ones(N)*delta)[i]))
+
+    vars = rate_model.normal_model('fused', pi, .1, p, s)
+    assert pl.allclose(vars['p_obs'].logp, mc.normal_like(p[j], pi[j], 1./(.1**2 + s[j]**2)))
+
+    vars = rate_model.log_normal_model('fused', pi, .1, p+.001, s)
+    assert pl.allclose(vars['p_obs'].logp, mc.normal_like(pl.log(p[j]+.001), pl.log(pi[j]+1.e-9),
+                                                          1./(.1**2 + (s[j]/(p[j]+.001))**2)))
+
+    vars = rate_model.offset_log_normal('fused', pi, .1, p, s)
+    zeta = vars['p_zeta'].value
+    assert pl.allclose(vars['p_obs'].logp, mc.normal_like(pl.log(p[j]+zeta), pl.log(pi[j]+zeta),
+                                                          1./(.1**2 + (s[j]/(p[j]+zeta))**2)))
+
+def test_beta_binom_model_sim(N=100):
+    # simulate binomial data
+    pi_true = .01
+    n = pl.array(pl.exp(mc.rnormal(8, 1**-2, size=N)), dtype=int)
+    k = pl.array(mc.rbinomial(n, pi_true), dtype=float)
+    p = k/n
+    n[:3] = 0
+
+    # create latent beta-binomial model, with one stoch for all latent rates
+    vars = dict(mu_age=mc.Uniform('mu_age', 0., 1., value=.01))
+    vars['mu_interval'] = mc.Lambda('mu_interval', lambda mu=vars['mu_age']: mu*pl.ones(N))
+    vars.update(rate_model.beta_binom('sim', vars['mu_interval'], p, n))
+    assert isinstance(vars['pi_latent'], mc.Stochastic)
+    assert pl.shape(vars['pi_latent'].value) == (N,)
+
+    # fit with blocked gibbs step for the latent rates
+    m = mc.MCMC(vars)
+    m.use_step_method(rate_model.BetaBinomialGibbs, vars['pi_latent'], vars['mu_interval'], vars['p_n'], vars['p_obs'])
+    m.sample(2)
+    assert pl.all((vars['pi_latent'].value > 0) & (vars['pi_latent'].value < 1))
+
+    # create collapsed model, which matches the pymc beta-binomial likelihood
+    vars = dict(mu_age=mc.Uniform('mu_age', 0., 1., value=.01))
+    vars['mu_interval'] = mc.Lambda('mu_interval', lambda mu=vars['mu_age']: mu*pl.ones(N))
+    vars.update(rate_model.beta_binom('sim', vars['mu_interval'], p, n, collapsed=True))
+    assert 'pi_latent' not in vars
+
+    i = n != 0
+    pi = vars['mu_interval'].value[i]
+    p_n = vars['p_n'].value
+    assert pl.allclose(vars['p_obs'].logp, mc.betabin_like((p*n)[i], pi*p_n, (1-pi)*p_n, n[i]))
+
+    m = mc.MCMC(vars)
+    m.sample(2)
+
+def test_lazy_pred(N=16):
+    # simulate negative binomial data
+    pi_true = .01
+    delta_true = 50
+
+    n = pl.array(pl.exp(mc.rnormal(10, 1**-2, size=N)), dtype=int)
+    k = pl.array(mc.rnegative_binomial(n*pi_true, delta_true, size=N), dtype=float)
+    p = k/n
+
+    # create NB model with posterior-predictive draws generated after sampling
+    vars = dict(mu_age=mc.Uniform('mu_age', 0., 1000., value=.01),
+                delta=mc.Uniform('delta', 0., 1000., value=50.))
+    vars['mu_interval'] = mc.Lambda('mu_interval', lambda mu=vars['mu_age']: mu*pl.ones(N))
+    vars.update(rate_model.neg_binom('sim', vars['mu_interval'], vars['delta'], p, n, lazy_pred=True))
+
+    m = mc.MCMC(vars)
+    assert 'p_pred_sim' not in [d.__name__ for d in m.deterministics]
+
+    m.sample(10)
+    assert vars['p_pred'].trace().shape == (10, N)
+
+    stats = vars['p_pred'].stats(batches=5)
+    assert stats['n'] == 10
+    assert stats['mean'].shape == (N,)
+    assert pl.allclose(stats['mean'], vars['p_pred'].trace().mean(0))
+
+    # a second run with the same number of samples draws from its own traces
+    draws = vars['p_pred'].trace().copy()
+    m.sample(10)
+    assert vars['p_pred'].trace().shape == (10, N)
+    assert not pl.all(vars['p_pred'].trace() == draws)
+    assert pl.all(vars['p_pred'].trace() == vars['p_pred'].trace())
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
@@ -0,0 +1,59 @@
+""" Validate Hessian proposal covariance
+
+Fit simulated age-specific rate models with the default
+AdaptiveMetropolis starting covariance and with the covariance from
+fit_model.hessian_cov, and report the burn-in each one needs
+"""
+
+# matplotlib will open windows during testing unless you do the following
+import matplotlib
+matplotlib.use("AGG")
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+import pymc as mc
+
+import data
+import data_simulation
+import ism
+import fit
+reload(fit)
+
+def burn_in(deviance, window=100):
+    """ First iteration where the moving average of the deviance is
+    within one standard deviation of the mean of the second half of the
+    chain"""
+    deviance = pl.array(deviance, dtype=float)
+    ref = deviance[len(deviance)/2:]
+    running = pl.convolve(deviance, pl.ones(window)/window, mode='valid')
+    settled = pl.where(pl.absolute(running - ref.mean()) <= ref.std())[0]
+    if len(settled) == 0:
+        return len(deviance)
+    return settled[0]
+
+def validate_hessian_cov(n, sigma_true, iter=5000, seed=1234567):
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+
+    results = {}
+    for hessian_cov in [False, True]:
+        mc.np.random.seed(seed)
+        model = data.ModelData()
+        model.input_data = data_simulation.simulated_age_intervals('p', n, a, pi_age_true, sigma_true)
+        model.hierarchy, model.output_template = data_simulation.small_output()
+        model.vars += ism.age_specific_rate(model, 'p')
+
+        map, m = fit.fit_asr(model, 'p', iter=iter, burn=0, thin=1, hessian_cov=hessian_cov)
+        results[hessian_cov] = burn_in(m.trace('deviance')[:]), m.wall_time
+    return results
+
+if __name__ == '__main__':
+    print '%6s  %8s  %14s  %14s  %8s' % ('n', 'sigma', 'default burn', 'hessian burn', 'saved')
+    for n in [50, 200]:
+        for sigma_true in [.025, .1]:
+            results = validate_hessian_cov(n, sigma_true)
+            print '%6d  %8.3f  %14d  %14d  %8d' % (n, sigma_true, results[False][0], results[True][0],
+                                                  results[False][0] - results[True][0])